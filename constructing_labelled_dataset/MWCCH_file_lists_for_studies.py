@@ -1,11 +1,15 @@
 # %%
 import numpy as np
 import os
+import datetime
 import sys
 sys.path.append("..")
 import readers.read_processed_MWCC_H as mwcch_read
 import matching_data.collect_matching_files as match
-from data_buckets_IO.data_buckets_read_and_write import Initialize_s3_client, list_objects_within_study_period, download_file
+from data_buckets_IO.data_buckets_read_and_write import Initialize_s3_client, list_objects_within_study_period
+from data_buckets_IO.object_cache import ObjectCache
+from data_buckets_IO.prefetch import iter_bucket_datasets
+from data_buckets_IO.ranged_reader import RangeReadStats
 # get current directory
 dir_name = os.path.dirname(__file__)
 
@@ -34,13 +38,22 @@ def get_list_filename(years, months, days, area_threshold):
 
     return output_file_name
 
-def create_file_list_per_area_thresholds(mwcch_bucket, years, months, days, area_thresholds=[10, 20, 30, 40, 50, 60]):
+def create_file_list_per_area_thresholds(mwcch_bucket, years, months, days, area_thresholds=[10, 20, 30, 40, 50, 60], cache=None, 
+                                         prefetch=16, workers=8, ranged=True):
     """collect all files with overpass area larger than area_threshold and save to txt files
 
     Parameters
     ----------
     area_threshold : list of int, optional
         _description_, by default 30
+    cache : ObjectCache, optional
+        local cache of the MWCC-H files, files that did not change are not downloaded again, by default None
+    prefetch : int, optional
+        number of files that are downloaded and decoded ahead, by default 16
+    workers : int, optional
+        number of threads downloading and decoding the files, by default 8
+    ranged : bool, optional
+        if no cache is given, read only the parts of the files needed for hail_class with ranged requests, by default True
     """
     # create txt file for each threshold
     for t in area_thresholds:
@@ -50,24 +63,28 @@ def create_file_list_per_area_thresholds(mwcch_bucket, years, months, days, area
 
     # get all files within study period
     s3 = Initialize_s3_client()
-    mwcch_files = list_objects_within_study_period(s3, mwcch_bucket, years, months, days)
+    mwcch_objects = list_objects_within_study_period(s3, mwcch_bucket, years, months, days, with_metadata=True)
 
-    # create temp local path
-    local_path = f"{dir_name}/temp_mwcch_files"
-    if not os.path.exists(local_path):
-        os.makedirs(local_path)
-    local_tmp_file = f"{local_path}/temp_file.nc"
+    # with the ETags from the listing, unchanged files are read from the cache without any request
+    mwcch_files = [obj["Key"] for obj in mwcch_objects]
+    etags = {obj["Key"]: obj["ETag"] for obj in mwcch_objects}
 
-    # loop over files
-    for f, file in enumerate(mwcch_files):
-        # download from bucket
-        download_file(s3, file, mwcch_bucket, local_tmp_file)
-        
-        # open as dataset
-        mwcch_data = mwcch_read.read(local_tmp_file, variables=["hail_class"]).hail_class.values
+    # without cache, only the chunks of hail_class are downloaded instead of the whole files
+    ranged = ranged and cache is None
+    range_stats = RangeReadStats()
 
-        # get covered area percentage
-        area_perc = mwcch_read.area_percentage_covered_by_overpass(mwcch_data)
+    # loop over files, the next files are downloaded and decoded while the current one is processed
+    datasets = iter_bucket_datasets(s3, mwcch_bucket, mwcch_files, variables=["hail_class"], 
+                                    prefetch=prefetch, workers=workers, etags=etags, cache=cache, 
+                                    ranged=ranged, range_stats=range_stats)
+    for f, (file, mwcch_ds, error) in enumerate(datasets):
+        if error is not None:
+            print(f"Could not read {file}: {error}", flush=True)
+            continue
+        mwcch_data = mwcch_ds.hail_class.values
+
+        # get covered area percentage, counted together with the pixels per hail class
+        area_perc = mwcch_read.hail_class_stats(mwcch_data)["area_percentage"]
 
         # check if area is larger than threshold
         for t in area_thresholds:
@@ -79,17 +96,20 @@ def create_file_list_per_area_thresholds(mwcch_bucket, years, months, days, area
         if f % 1000 == 0:
             print(f"{f}", flush=True)
 
-    # delete temp file and folder
-    os.remove(local_tmp_file)
-    os.rmdir(local_path)
+    if ranged:
+        print(range_stats, flush=True)
 
 
-def read_mwcch_files_for_study_settings(mwcch_bucket, years, months, days, area_threshold):
+def read_mwcch_files_for_study_settings(mwcch_bucket, years, months, days, area_threshold, use_inventory=False,
+                                        inventory_max_age=datetime.timedelta(days=1)):
 
     # if area threshold is 0, return all files
     if area_threshold == 0:
         s3 = Initialize_s3_client()
-        files = list_objects_within_study_period(s3, mwcch_bucket, years, months, days)
+        # list the bucket, or take the files from the local inventory of the bucket if use_inventory,
+        # days synced longer ago than inventory_max_age are listed again to find files uploaded since then
+        files = list_objects_within_study_period(s3, mwcch_bucket, years, months, days, use_inventory=use_inventory,
+                                                 inventory_max_age=inventory_max_age)
         return files
 
     filename = get_list_filename(years, months, days, area_threshold)
@@ -108,13 +128,15 @@ if __name__ == "__main__":
     # years = np.arange(2006, 2024, 1)
     # months = np.arange(4, 10, 1)
     mwcch_bucket = "mwcch-hail-regrid-msg"
+    # local cache of the MWCC-H files shared by the study sweeps
+    cache = ObjectCache(f"{dir_name}/mwcch_cache")
     # years = np.arange(2013, 2024, 1)
     months = np.arange(4, 10, 1)
     days = np.arange(1, 32, 1)
     area_thresholds = np.arange(0, 70, 10)
 
     for years in [np.arange(2013, 2024, 1), np.arange(2006, 2024, 1)]:
-        create_file_list_per_area_thresholds(mwcch_bucket, years, months, days, area_thresholds=area_thresholds)
+        create_file_list_per_area_thresholds(mwcch_bucket, years, months, days, area_thresholds=area_thresholds, cache=cache)
 
     # for area_threshold in area_thresholds[2:3]:
     #     files = read_mwcch_files_for_study_settings(mwcch_bucket, years, months, days, area_threshold)
@@ -26,7 +26,8 @@ def chunk_files_by_timerange(files, n_frames, msg_res, gap=15, start_match="foll
     - chunks: list of lists, where each sublist contains file paths that belong to the same time series chunk
     """
     # Parse timestamps of scanning end time
-    files_with_timestamps = [(file, mwcch_read.get_scan_datetime_from_mwcch_filepath(file, which="end")) for file in files]
+    end_times = mwcch_read.parse_mwcch_paths(files)["end"].values.astype("datetime64[m]")
+    files_with_timestamps = list(zip(files, end_times))
 
     # sort files by timestamp in descending order
     files_with_timestamps.sort(key=lambda x: x[1], reverse=True)
@@ -11,12 +11,18 @@ import chunk_MWCCH_files as mwcch_chunk
 import crop_over_hail_or_overpass as mwcch_crop
 import readers.read_processed_MWCC_H as mwcch_read
 import readers.read_MSG as msg_read
+from readers.dataset_pool import DatasetPool
+from readers.msg_grid import get_msg_grid
 import matching_data.collect_matching_files as match
 import helpers.datetime_helper as hlp
+from data_buckets_IO.data_buckets_read_and_write import Initialize_s3_client
+from data_buckets_IO.object_cache import ObjectCache
+from helpers.crop_encoding import save_crop
 
+MWCCH_BUCKET = "mwcch-hail-regrid-msg"
 
 # %%
-def collect_MSG_timeseries(overpass_end_time, msg_res, n_frames):
+def collect_MSG_timeseries(overpass_end_time, msg_res, n_frames, msg_pool=None, crop_isel=None):
 
     # get MSG timestamp following the overpass end time
     last_msg_dt = match.get_closest_MSG_timestamps(overpass_end_time, 
@@ -29,6 +35,9 @@ def collect_MSG_timeseries(overpass_end_time, msg_res, n_frames):
     # find all MSG days that this timeseries covers
     days_in_time_series = time_series_dt.normalize().unique().values
 
+    # index ranges of the crop, the whole domain if not given
+    crop_isel = crop_isel or {}
+
     msg_time_series = []
     # loop over MSG days
     for msg_day in days_in_time_series:
@@ -36,11 +45,9 @@ def collect_MSG_timeseries(overpass_end_time, msg_res, n_frames):
         # find corresponding msg daily file
         msg_day_file = msg_read.get_MSG_file_from_timestamp(msg_day)
 
-        # read MSG data
-        msg_data = msg_read.read(msg_day_file)
-
-        # select only timestamps that are covered by time series
-        msg_time_series.append(msg_data.where(msg_data.time.isin(time_series_dt), drop=True))
+        # read only the timestamps of the time series within the crop extent, from the pool of open daily files if given
+        msg_time_series.append(msg_read.read_window(msg_day_file, times=time_series_dt.values, 
+                                                    lon_idx=crop_isel.get("lon"), lat_idx=crop_isel.get("lat"), pool=msg_pool))
 
     # merge separate days into one dataset
     msg_time_series = xr.merge(msg_time_series)
@@ -68,7 +75,7 @@ def add_attributes(msg_timeseries, cg_lon, cg_lat, cg_lon_recentered=None, cg_la
                                                  # recentered_lon=recentered_lon, recentered_lat=recentered_lat)
     return msg_timeseries
     
-def crop_MSG_timeseries_over_hail_and_save(msg_timeseries, mwcch_data, cropsize, filepath, recenter=None):
+def crop_MSG_timeseries_over_hail_and_save(msg_timeseries, mwcch_data, cropsize, filepath, recenter=None, encoding="default"):
 
     # get extent of crop over max hail class area
     cg_lon, cg_lat, minlon, maxlon, minlat, maxlat = \
@@ -87,8 +94,8 @@ def crop_MSG_timeseries_over_hail_and_save(msg_timeseries, mwcch_data, cropsize,
                                     cg_lon_recentered=None if recenter is None else cg_lon_recentered, 
                                     cg_lat_recentered=None if recenter is None else cg_lat_recentered)
 
-    # save to given filepath
-    msg_timeseries.to_netcdf(filepath)
+    # save to given filepath with the encoding profile, see helpers.crop_encoding
+    save_crop(msg_timeseries, filepath, profile=encoding)
 
 def folder_from_study_settings(output_path, years, months, area_threshold, msg_res, n_frames, gap, cropsize, min_pix):
     folder_path = f"{output_path}/{years[0]}-{years[-1]}_{months[0]}-{months[-1]}_areathresh{area_threshold}_" + \
@@ -96,10 +103,20 @@ def folder_from_study_settings(output_path, years, months, area_threshold, msg_r
     return folder_path
 
 # %%
-def construct_labelled_MSG_timeseries(path, years, months, area_threshold, msg_res, n_frames, gap, cropsize, min_pix):
+def construct_labelled_MSG_timeseries(path, years, months, area_threshold, msg_res, n_frames, gap, cropsize, min_pix, mwcch_cache=None, 
+                                      msg_pool_size=3, encoding="default"):
     # mwcch_path = "/net/merisi/pbigalke/data/MWCC-H/netcdf"
     mwcch_path = mwcch_read.MWCCH_MSGGRID_PATH
 
+    # if a cache is given, the MWCC-H files are read from the bucket through the local cache
+    s3 = Initialize_s3_client() if mwcch_cache is not None else None
+
+    # the timeseries are sorted in time, so keeping the last daily MSG files open
+    # lets all timeseries of the same day share one opened file
+    msg_pool = DatasetPool(max_open=msg_pool_size)
+    # grid of the MSG and regridded MWCC-H files, to select the crops by index
+    msg_grid = get_msg_grid()
+
     output_path = folder_from_study_settings(path, years, months, area_threshold, msg_res, n_frames, gap, cropsize, min_pix)
     if not os.path.exists(output_path):
         os.makedirs(output_path)
@@ -123,7 +140,10 @@ def construct_labelled_MSG_timeseries(path, years, months, area_threshold, msg_r
         try:
             # ------------------------------------------------------------ read last MWCC-H
             # read in mwcch_file of last frame
-            mwcch_last_frame = mwcch_read.read(group[0], variables=["POH", "hail_class"])
+            mwcch_file = group[0]
+            if mwcch_cache is not None:
+                mwcch_file = mwcch_cache.get(s3, MWCCH_BUCKET, mwcch_file)
+            mwcch_last_frame = mwcch_read.read(mwcch_file, variables=["POH", "hail_class"])
             
             # ------------------------------------------------------------ get label
             # set label to maximum hail class within domain
@@ -134,23 +154,19 @@ def construct_labelled_MSG_timeseries(path, years, months, area_threshold, msg_r
             if not os.path.exists(path_label):
                 os.makedirs(path_label)
 
+            # ------------------------------------------------------------ get crop extent
+            # get center of mass of max hail class area and the index ranges of the crop on the MSG grid
+            cg_lon, cg_lat, crop_isel = mwcch_crop.get_crop_isel_over_maxhailarea(mwcch_last_frame, cropsize, 
+                                                                                  min_pixel=min_pix, grid=msg_grid)
+
             # ------------------------------------------------------------ create MSG timeseries
             # read in MSG time series ending in mwcc-h timestamp
 
             # get end time of overpass
             mwcch_end = mwcch_last_frame.end_scan
 
-            # get corresponding MSG time series
-            msg_timeseries = collect_MSG_timeseries(mwcch_end, msg_res, n_frames)
-
-            # ------------------------------------------------------------ get crop extent
-            # get center of mass of max hail class area
-            cg_lon, cg_lat, minlon, maxlon, minlat, maxlat = \
-                mwcch_crop.get_crop_extent_over_maxhailarea(mwcch_last_frame, cropsize, min_pixel=min_pix)
-
-            # ------------------------------------------------------------ crop over hail area or overpass
-            # crop dataset over hail area or overpass area
-            msg_timeseries = msg_timeseries.sel(lon=slice(minlon, maxlon), lat=slice(minlat, maxlat))
+            # get corresponding MSG time series, only the crop over hail area is read from the daily files
+            msg_timeseries = collect_MSG_timeseries(mwcch_end, msg_res, n_frames, msg_pool=msg_pool, crop_isel=crop_isel)
             
             # add global attributes describing the data
             msg_timeseries = add_attributes(msg_timeseries, cg_lon, cg_lat)
@@ -160,13 +176,17 @@ def construct_labelled_MSG_timeseries(path, years, months, area_threshold, msg_r
             dt_end = msg_timeseries.end_time
             filepath = os.path.join(path_label, f"{dt_end}_res{msg_res}min_{n_frames}frames_cropsize{cropsize}.nc")
 
-            # save to given filepath
-            msg_timeseries.to_netcdf(filepath)
+            # save to given filepath with the encoding profile, see helpers.crop_encoding
+            save_crop(msg_timeseries, filepath, profile=encoding)
         
         except:
             print(f"Error processing timeseries {g}/{len(mwcch_chunks)}")
             continue
 
+    # close the daily MSG files
+    print(f"MSG daily files: {msg_pool.stats()}", flush=True)
+    msg_pool.close()
+
 
 # %%
 if __name__ == "__main__":
@@ -195,7 +215,11 @@ if __name__ == "__main__":
 
     # construct dataset
     path = f"/net/merisi/pbigalke/data/labelled_MSG_timeseries"
-    construct_labelled_MSG_timeseries(path, years, months, area_threshold, msg_res, n_frames, gap, cropsize, min_pix)
+    mwcch_cache = ObjectCache(f"{os.path.dirname(__file__)}/mwcch_cache")
+    # encoding profile of the crop files: default, fast, archive or compact
+    encoding = "archive"
+    construct_labelled_MSG_timeseries(path, years, months, area_threshold, msg_res, n_frames, gap, cropsize, min_pix, 
+                                      mwcch_cache=mwcch_cache, encoding=encoding)
 
     print("total runtime: ", datetime.datetime.now() - start_script_at)
 
@@ -3,6 +3,7 @@ import numpy as np
 import sys
 sys.path.append('..')
 import readers.read_processed_MWCC_H as mwcch_read
+from readers.msg_grid import get_msg_grid
 
 
 # %%
@@ -42,21 +43,15 @@ def add_padding_at_data_edge(idx, data_dim, padding):
         idx = int(data_dim-1 - padding)
     return idx
 
-def get_crop_extent_from_center_choords(msg_lon, msg_lat, loc_lon, loc_lat, cropsize):
-    
-    # find center of crop
-    idx_lon_c = get_closest_index(msg_lon, loc_lon)
-    idx_lat_c = get_closest_index(msg_lat, loc_lat)
-
-    # shift center position away from edge to fit crop into domain
-    idx_lon_c= add_padding_at_data_edge(idx_lon_c, len(msg_lon), cropsize/2.)
-    idx_lat_c = add_padding_at_data_edge(idx_lat_c, len(msg_lat), cropsize/2.)
+def get_crop_extent_from_center_choords(msg_lon, msg_lat, loc_lon, loc_lat, cropsize, grid=None):
+    # the MSG grid is loaded once per process, msg_lon and msg_lat need to be its coordinates
+    if grid is None:
+        grid = get_msg_grid()
 
-    # get indices of edges of crop
-    idx_lon_min = idx_lon_c - int(cropsize/2.)
-    idx_lon_max = idx_lon_min + int(cropsize) - 1
+    # get indices of edges of crop, shifted away from edge to fit crop into domain
+    idx_lon_min, idx_lat_min = grid.crop_indices(loc_lon, loc_lat, cropsize)
     # need to substract 1 as xr.dataset.sel(lon=slice(minlon, maxlon)) includes the edges
-    idx_lat_min = idx_lat_c - int(cropsize/2.)
+    idx_lon_max = idx_lon_min + int(cropsize) - 1
     idx_lat_max = idx_lat_min + int(cropsize) - 1
 
     # get corresponding lon lat extent
@@ -67,7 +62,7 @@ def get_crop_extent_from_center_choords(msg_lon, msg_lat, loc_lon, loc_lat, crop
 
     return lon_min, lon_max, lat_min, lat_max
 
-def get_crop_extent_over_maxhailarea(mwcch_data, cropsize, min_pixel=1):
+def get_center_of_maxhailarea(mwcch_data, min_pixel=1):
     ###### does only work for MSG-regridded MWCC-H data ######
     
     # get max hail class in mwcch data
@@ -80,7 +75,13 @@ def get_crop_extent_over_maxhailarea(mwcch_data, cropsize, min_pixel=1):
     masked_data['hail_class'] = masked_data.hail_class.where(np.isnan(masked_data.hail_class), 1)
 
     # calculate center of mass for variable
-    cg_lon, cg_lat = get_center_of_mass_for_variable(masked_data.lon, masked_data.lat, masked_data.hail_class.values)
+    return get_center_of_mass_for_variable(masked_data.lon, masked_data.lat, masked_data.hail_class.values)
+
+def get_crop_extent_over_maxhailarea(mwcch_data, cropsize, min_pixel=1):
+    ###### does only work for MSG-regridded MWCC-H data ######
+
+    # calculate center of mass of max hail class area
+    cg_lon, cg_lat = get_center_of_maxhailarea(mwcch_data, min_pixel=min_pixel)
 
     # get extent of crop over hail area
     minlon, maxlon, minlat, maxlat = get_crop_extent_from_center_choords(mwcch_data.lon.values, mwcch_data.lat.values, 
@@ -88,6 +89,19 @@ def get_crop_extent_over_maxhailarea(mwcch_data, cropsize, min_pixel=1):
 
     return cg_lon, cg_lat, minlon, maxlon, minlat, maxlat
 
+def get_crop_isel_over_maxhailarea(mwcch_data, cropsize, min_pixel=1, grid=None):
+    """get center of mass of max hail class area and the integer index ranges of the crop around it,
+    the crop can then be selected with isel from any dataset on the MSG grid
+    """
+    ###### does only work for MSG-regridded MWCC-H data ######
+    if grid is None:
+        grid = get_msg_grid()
+
+    # calculate center of mass of max hail class area
+    cg_lon, cg_lat = get_center_of_maxhailarea(mwcch_data, min_pixel=min_pixel)
+
+    return cg_lon, cg_lat, grid.crop_isel(cg_lon, cg_lat, cropsize)
+
 def get_crop_extent_over_overpassarea(mwcch_data, cropsize):
     ###### does only work for MSG-regridded MWCC-H data ######
     
@@ -0,0 +1,239 @@
+# benchmark of listing, download and upload throughput of data_buckets_IO against the local S3 stand-in
+
+# %%
+import os
+import json
+import time
+import tarfile
+import tempfile
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from data_buckets_IO.bucket_information import get_bucket_prefix
+from data_buckets_IO.data_buckets_read_and_write import list_objects_within_study_period, read_file, download_file, upload_file
+from data_buckets_IO.bulk_upload import upload_files_concurrently, MB
+from data_buckets_IO.tar_streaming import upload_tar_stream
+from data_buckets_IO.s3_standin import S3StandIn
+
+# %%
+# synthetic bucket layouts
+def get_synthetic_object_names(bucket, years, months, days, files_per_day):
+    """Get object names following the folder structure and file names of the bucket
+    :param bucket: Name of the S3 bucket, see bucket_information.get_bucket_prefix
+    :param years: Years of the synthetic data
+    :param months: Months of the synthetic data
+    :param days: Days of the synthetic data
+    :param files_per_day: Number of files per day
+    :return: List of object names
+    """
+    names = []
+    for year in years:
+        for month in months:
+            for day in days:
+                prefix = get_bucket_prefix(bucket, year, month, day)
+                for i in range(files_per_day):
+                    hour, minute = divmod(i * 15 % 1440, 60)
+                    if bucket == "mwcch-hail-regrid-msg":
+                        names.append(f"{prefix}S{hour:02d}{minute:02d}_E{hour:02d}{minute:02d}_MHS_NOAA19_{i:04d}.nc")
+                    else:
+                        names.append(f"{prefix}{hour:02d}{minute:02d}_crop{i % 4}_{i:04d}.nc")
+    return names
+
+def populate_bucket(standin, bucket, object_names, object_size, seed=0):
+    """Fill a bucket of the stand-in with random objects of the given size
+    :return: total size of the objects in bytes
+    """
+    rng = np.random.default_rng(seed)
+    body = rng.integers(0, 256, object_size, dtype=np.uint8).tobytes()
+    standin.create_bucket(bucket)
+    for name in object_names:
+        # identical bodies are fine for throughput, the ETags are the same
+        standin.put(bucket, name, body)
+    return len(object_names) * object_size
+
+# %%
+class _LatencyRecorder:
+    """Record the latency of every S3 call of a client, including the retried attempts"""
+
+    def __init__(self, s3):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.events = s3.meta.events
+        self.events.register("before-call.s3", self._before_call, unique_id="benchmark-latency-before")
+        self.events.register("after-call.s3", self._after_call, unique_id="benchmark-latency-after")
+        self.events.register("after-call-error.s3", self._after_call, unique_id="benchmark-latency-error")
+
+    def close(self):
+        # the clients are shared, so the handlers are removed after the benchmark
+        self.events.unregister("before-call.s3", unique_id="benchmark-latency-before")
+        self.events.unregister("after-call.s3", unique_id="benchmark-latency-after")
+        self.events.unregister("after-call-error.s3", unique_id="benchmark-latency-error")
+
+    def _before_call(self, context, **kwargs):
+        context["benchmark_start_time"] = time.perf_counter()
+
+    def _after_call(self, context, **kwargs):
+        if "benchmark_start_time" in context:
+            with self.lock:
+                self.latencies.append(time.perf_counter() - context["benchmark_start_time"])
+
+    def reset(self):
+        with self.lock:
+            self.latencies = []
+
+def _result(name, workers, n_objects, n_bytes, seconds, latencies, standin):
+    latencies_ms = np.array(latencies) * 1000 if len(latencies) > 0 else np.array([np.nan])
+    return {
+        "benchmark": name,
+        "workers": workers,
+        "objects": n_objects,
+        "MB": n_bytes / MB,
+        "seconds": seconds,
+        "objects_per_s": n_objects / max(seconds, 1e-9),
+        "MB_per_s": n_bytes / MB / max(seconds, 1e-9),
+        "requests": len(latencies),
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+        "injected_errors": standin.injected_errors,
+    }
+
+def _run(name, workers, function, standin, recorder):
+    """Run one benchmark, function returns the number of objects and bytes it transferred"""
+    recorder.reset()
+    standin.reset_counts()
+    start_time = time.perf_counter()
+    n_objects, n_bytes = function()
+    seconds = time.perf_counter() - start_time
+    return _result(name, workers, n_objects, n_bytes, seconds, recorder.latencies, standin)
+
+# %%
+# benchmarks of the single methods
+def benchmark_listing(s3, standin, recorder, bucket, years, months, days, workers):
+    def run():
+        objects = list_objects_within_study_period(s3, bucket, years, months, days, with_metadata=True, max_workers=workers)
+        return len(objects), 0
+    return _run("list_objects_within_study_period", workers, run, standin, recorder)
+
+def benchmark_read_file(s3, standin, recorder, bucket, object_names, workers):
+    def run():
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            bodies = list(executor.map(lambda name: read_file(s3, name, bucket), object_names))
+        return sum(body is not None for body in bodies), sum(len(body) for body in bodies if body is not None)
+    return _run("read_file", workers, run, standin, recorder)
+
+def benchmark_download_file(s3, standin, recorder, bucket, object_names, workers, local_dir):
+    def run():
+        def download(i_name):
+            i, name = i_name
+            local_path = f"{local_dir}/{i}.nc"
+            return os.path.getsize(local_path) if download_file(s3, name, bucket, local_path) else None
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            sizes = list(executor.map(download, enumerate(object_names)))
+        return sum(size is not None for size in sizes), sum(size for size in sizes if size is not None)
+    return _run("download_file", workers, run, standin, recorder)
+
+def benchmark_upload_file(s3, standin, recorder, bucket, files, object_names, workers):
+    def run():
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            uploaded = list(executor.map(lambda args: upload_file(s3, args[0], bucket, f"upload_file/{args[1]}"),
+                                         zip(files, object_names)))
+        return sum(uploaded), sum(os.path.getsize(f) for f, ok in zip(files, uploaded) if ok)
+    return _run("upload_file", workers, run, standin, recorder)
+
+def benchmark_bulk_upload(s3, standin, recorder, bucket, files, object_names, workers):
+    def run():
+        summary = upload_files_concurrently(s3, files, bucket, [f"bulk/{name}" for name in object_names],
+                                            check_bucket=False, max_workers=workers)
+        return summary["uploaded"], summary["bytes"]
+    return _run("upload_files_concurrently", workers, run, standin, recorder)
+
+def benchmark_tar_stream(s3, standin, recorder, bucket, tar_path, workers):
+    def run():
+        with open(tar_path, "rb") as f:
+            counts = upload_tar_stream(s3, f, bucket, lambda name: f"tar/{name}", max_workers=workers)
+        return counts["uploaded"], counts["bytes"]
+    return _run("upload_tar_stream", workers, run, standin, recorder)
+
+# %%
+def run_benchmarks(bucket="mwcch-hail-regrid-msg", years=[2020], months=[5, 6], days=range(1, 31), files_per_day=40,
+                   object_size=1*MB, n_transfer=200, workers_list=[1, 4, 16, 64], latency=0.02, jitter=0.01,
+                   error_rate=0.0, bandwidth=None, output_file=None):
+    """Run all benchmarks against a stand-in with a synthetic bucket, for each number of workers
+    :param bucket: Bucket whose layout is used for the synthetic objects
+    :param years: Years of the synthetic bucket
+    :param months: Months of the synthetic bucket
+    :param days: Days of the synthetic bucket
+    :param files_per_day: Number of objects per day
+    :param object_size: Size of the objects in bytes
+    :param n_transfer: Number of objects downloaded and uploaded in the transfer benchmarks
+    :param workers_list: Numbers of concurrent workers (threads) to compare
+    :param latency: Latency of every request of the stand-in in seconds
+    :param jitter: Maximum additional random latency in seconds
+    :param error_rate: Fraction of requests that fail with 503 SlowDown and are retried
+    :param bandwidth: Bandwidth per connection of the stand-in in bytes per second. If None, unlimited
+    :param output_file: json file to save the results to
+    :return: List of dicts with the results
+    """
+    results = []
+    with S3StandIn(latency=latency, jitter=jitter, error_rate=error_rate, bandwidth=bandwidth, seed=0) as standin, \
+         tempfile.TemporaryDirectory() as tmp_dir:
+
+        object_names = get_synthetic_object_names(bucket, years, months, days, files_per_day)
+        populate_bucket(standin, bucket, object_names, object_size)
+        transfer_names = object_names[:n_transfer]
+        print(f"stand-in at {standin.endpoint_url} with {len(object_names)} objects of {object_size/MB:.2f} MB", flush=True)
+
+        # local files for the upload benchmarks
+        files = []
+        for i, name in enumerate(transfer_names):
+            files.append(f"{tmp_dir}/upload_{i}.nc")
+            with open(files[-1], "wb") as f:
+                f.write(standin.get(bucket, name))
+        tar_path = f"{tmp_dir}/upload.tar"
+        with tarfile.open(tar_path, "w") as tar:
+            for file_name in files:
+                tar.add(file_name, arcname=os.path.basename(file_name))
+        local_dir = f"{tmp_dir}/downloads"
+        os.makedirs(local_dir)
+
+        for workers in workers_list:
+            # one client per concurrency setting, with a pool large enough for all workers
+            s3 = standin.client(max_pool_connections=max(workers, 10))
+            recorder = _LatencyRecorder(s3)
+
+            results.append(benchmark_listing(s3, standin, recorder, bucket, years, months, days, workers))
+            results.append(benchmark_read_file(s3, standin, recorder, bucket, transfer_names, workers))
+            results.append(benchmark_download_file(s3, standin, recorder, bucket, transfer_names, workers, local_dir))
+            results.append(benchmark_upload_file(s3, standin, recorder, bucket, files, transfer_names, workers))
+            results.append(benchmark_bulk_upload(s3, standin, recorder, bucket, files, transfer_names, workers))
+            results.append(benchmark_tar_stream(s3, standin, recorder, bucket, tar_path, workers))
+            recorder.close()
+
+    print_results(results)
+    if output_file is not None:
+        with open(output_file, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+def print_results(results):
+    print(f"{'benchmark':<34}{'workers':>8}{'objects':>9}{'objects/s':>11}{'MB/s':>9}{'requests':>10}{'p50 ms':>9}{'p99 ms':>9}{'errors':>8}")
+    for r in results:
+        print(f"{r['benchmark']:<34}{r['workers']:>8}{r['objects']:>9}{r['objects_per_s']:>11.1f}{r['MB_per_s']:>9.2f}" + \
+              f"{r['requests']:>10}{r['p50_ms']:>9.1f}{r['p99_ms']:>9.1f}{r['injected_errors']:>8}", flush=True)
+
+# %%
+if __name__ == "__main__":
+    # latency, errors and bandwidth of the stand-in, roughly those of the production object store
+    latency = 0.02
+    jitter = 0.01
+    error_rate = 0.01
+    bandwidth = 50 * MB
+
+    # compare the number of concurrent workers
+    workers_list = [1, 4, 16, 64]
+
+    run_benchmarks(bucket="mwcch-hail-regrid-msg", years=[2020], months=[5, 6], days=range(1, 31), files_per_day=40,
+                   object_size=1*MB, n_transfer=200, workers_list=workers_list, latency=latency, jitter=jitter,
+                   error_rate=error_rate, bandwidth=bandwidth, output_file="benchmark_bucket_IO.json")
+
+# %%
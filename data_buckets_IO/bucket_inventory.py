@@ -0,0 +1,187 @@
+# local inventory of the objects in S3 buckets, stored as parquet file and refreshed incrementally
+
+# %%
+import os
+import json
+import datetime
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from data_buckets_IO.bucket_information import get_bucket_prefix
+from data_buckets_IO.data_buckets_read_and_write import list_objects_with_prefix
+
+INVENTORY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "inventories")
+
+COLUMNS = ["key", "size", "etag", "last_modified", "prefix", "year", "month", "day", "date",
+           "start_time", "end_time", "detector", "satellite", "crop"]
+
+# patterns of the object names in the buckets
+DATE_FOLDER_PATTERN = r"(?P<year>\d{4})/(?P<month>\d{2})/(?P<day>\d{2})/"
+MWCCH_NAME_PATTERN = r"(?P<date>\d{8})_S(?P<start>\d{4})_E(?P<end>\d{4})_(?P<detector>[A-Za-z]+)_(?P<satellite>[A-Za-z0-9]+)"
+CROP_NAME_PATTERN = r"_(?P<date>\d{4}-\d{2}-\d{2})_(?P<time>\d{4})_crop(?P<crop>\d+)\.nc$"
+
+# %%
+# methods to read and write the inventory
+def get_inventory_files(bucket, inventory_path=INVENTORY_PATH):
+    """Get the parquet file of the inventory and the json file with the sync state of the prefixes
+    :param bucket: Name of the S3 bucket
+    :param inventory_path: Directory of the inventories
+    :return: path to parquet file, path to sync state file
+    """
+    return f"{inventory_path}/{bucket}.parquet", f"{inventory_path}/{bucket}_sync.json"
+
+def load_inventory(bucket, inventory_path=INVENTORY_PATH):
+    """Load the inventory of a bucket
+    :param bucket: Name of the S3 bucket
+    :param inventory_path: Directory of the inventories
+    :return: pd.DataFrame with one row per object, empty if no inventory exists yet
+    """
+    parquet_file, _ = get_inventory_files(bucket, inventory_path)
+    if not os.path.exists(parquet_file):
+        return pd.DataFrame(columns=COLUMNS)
+    return pd.read_parquet(parquet_file)
+
+def load_sync_state(bucket, inventory_path=INVENTORY_PATH):
+    """Load the time of the last sync of each prefix
+    :param bucket: Name of the S3 bucket
+    :param inventory_path: Directory of the inventories
+    :return: dict mapping prefixes to the time of their last sync (isoformat)
+    """
+    _, sync_file = get_inventory_files(bucket, inventory_path)
+    if not os.path.exists(sync_file):
+        return {}
+    with open(sync_file, "r") as f:
+        return json.load(f)
+
+def _save(inventory, sync_state, bucket, inventory_path):
+    parquet_file, sync_file = get_inventory_files(bucket, inventory_path)
+    os.makedirs(inventory_path, exist_ok=True)
+
+    # write to temporary files first, so an interrupted refresh does not corrupt the inventory
+    inventory.to_parquet(f"{parquet_file}.tmp", index=False)
+    with open(f"{sync_file}.tmp", "w") as f:
+        json.dump(sync_state, f)
+    os.replace(f"{parquet_file}.tmp", parquet_file)
+    os.replace(f"{sync_file}.tmp", sync_file)
+
+# %%
+def parse_objects(objects, prefix_of_key=None):
+    """Create the inventory table from the listed objects, parsing the fields from the object names
+    :param objects: List of dicts with Key, Size, ETag and LastModified of the objects
+    :param prefix_of_key: dict mapping keys to the listed prefix they were found with
+    :return: pd.DataFrame with one row per object
+    """
+    if len(objects) == 0:
+        return pd.DataFrame(columns=COLUMNS)
+
+    table = pd.DataFrame({
+        "key": [obj["Key"] for obj in objects],
+        "size": np.array([obj["Size"] for obj in objects], dtype=np.int64),
+        "etag": [obj["ETag"] for obj in objects],
+        "last_modified": pd.to_datetime([obj["LastModified"] for obj in objects], utc=True).tz_localize(None),
+    })
+    table["prefix"] = table.key.map(prefix_of_key) if prefix_of_key is not None else None
+
+    # date from the folder structure year/month/day
+    date_parts = table.key.str.extract(DATE_FOLDER_PATTERN)
+    for part in ["year", "month", "day"]:
+        table[part] = pd.to_numeric(date_parts[part]).astype("Int16")
+    table["date"] = pd.to_datetime(date_parts.year + date_parts.month + date_parts.day, format="%Y%m%d", errors="coerce")
+
+    # scan times, detector and satellite of MWCC-H files
+    mwcch = table.key.str.extract(MWCCH_NAME_PATTERN)
+    table["start_time"] = pd.to_datetime(mwcch.date + mwcch.start, format="%Y%m%d%H%M", errors="coerce")
+    table["end_time"] = pd.to_datetime(mwcch.date + mwcch.end, format="%Y%m%d%H%M", errors="coerce")
+    table["detector"] = mwcch.detector
+    table["satellite"] = mwcch.satellite.str.lower()
+
+    # start time and crop number of MSG timeseries crops
+    crops = table.key.str.extract(CROP_NAME_PATTERN)
+    crop_time = pd.to_datetime(crops.date + crops.time, format="%Y-%m-%d%H%M", errors="coerce")
+    table["start_time"] = table.start_time.fillna(crop_time)
+    table["crop"] = pd.to_numeric(crops.crop).astype("Int8")
+
+    return table[COLUMNS]
+
+# %%
+def refresh_inventory(s3, bucket, years, months, days, inventory_path=INVENTORY_PATH, max_age=None, force=False, max_workers=16):
+    """Refresh the inventory of a bucket for the study period
+
+    S3 can not list objects by modification time, so only the prefixes that changed since they
+    were last synced are listed: prefixes that were never synced, and prefixes with a sync older
+    than max_age (for data that is still being uploaded). All other prefixes are taken from the inventory.
+
+    :param s3: Initialized S3 client object
+    :param bucket: Name of the S3 bucket
+    :param years: Years of the study period
+    :param months: Months of the study period
+    :param days: Days of the study period
+    :param inventory_path: Directory of the inventories
+    :param max_age: datetime.timedelta after which a synced prefix is listed again. If None, synced prefixes are kept
+    :param force: If True, list all prefixes of the study period again
+    :param max_workers: Number of prefixes that are listed concurrently
+    :return: pd.DataFrame with the whole inventory of the bucket
+    """
+    inventory = load_inventory(bucket, inventory_path)
+    sync_state = load_sync_state(bucket, inventory_path)
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    # find prefixes of the study period that need to be listed
+    prefixes = []
+    for year in years:
+        for month in months:
+            for day in days:
+                prefix = get_bucket_prefix(bucket, year, month, day)
+                last_sync = sync_state.get(prefix)
+                if force or last_sync is None or \
+                   (max_age is not None and now - datetime.datetime.fromisoformat(last_sync) > max_age):
+                    prefixes.append(prefix)
+
+    if len(prefixes) == 0:
+        return inventory
+
+    # list the prefixes concurrently
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        listings = list(executor.map(lambda prefix: list_objects_with_prefix(s3, bucket, prefix), prefixes))
+
+    objects = [obj for listing in listings for obj in listing]
+    prefix_of_key = {obj["Key"]: prefix for prefix, listing in zip(prefixes, listings) for obj in listing}
+
+    # replace the rows of the listed prefixes by the new listing
+    inventory = inventory[~inventory.prefix.isin(prefixes)]
+    new_rows = parse_objects(objects, prefix_of_key)
+    inventory = pd.concat([inventory, new_rows], ignore_index=True) if len(inventory) > 0 else new_rows
+    inventory = inventory.sort_values("key", ignore_index=True)
+
+    for prefix in prefixes:
+        sync_state[prefix] = now.isoformat()
+
+    _save(inventory, sync_state, bucket, inventory_path)
+    return inventory
+
+# %%
+# methods to query the inventory without requests to the bucket
+def query_study_period(inventory, years, months, days, with_metadata=False):
+    """Get all objects of the inventory within the study period
+    :param inventory: pd.DataFrame of the inventory
+    :param years: Years of the study period
+    :param months: Months of the study period
+    :param days: Days of the study period
+    :param with_metadata: If True, return the rows of the inventory instead of the keys only
+    :return: list of keys sorted by key, or pd.DataFrame if with_metadata
+    """
+    in_period = inventory.year.isin(list(years)) & inventory.month.isin(list(months)) & inventory.day.isin(list(days))
+    selection = inventory[in_period.fillna(False).astype(bool)]
+    if with_metadata:
+        return selection
+    return selection.key.tolist()
+
+def count_files(inventory, by=("year", "month", "day")):
+    """Count the files in the inventory per year, month and/or day
+    :param inventory: pd.DataFrame of the inventory
+    :param by: Columns to group by
+    :return: pd.Series with the number of files per group
+    """
+    return inventory.groupby(list(by)).size()
+
+# %%
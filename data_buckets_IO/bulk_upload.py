@@ -0,0 +1,184 @@
+# methods to upload many files concurrently to S3 buckets and to resume interrupted uploads
+
+# %%
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from data_buckets_IO.data_buckets_read_and_write import list_objects_with_prefix
+
+MB = 1024 * 1024
+
+# %%
+# methods for the local manifest of uploaded objects
+def load_manifest(manifest_path, bucket):
+    """Load the manifest of objects that were already uploaded to the bucket
+    :param manifest_path: Path to the manifest file (one json entry per line)
+    :param bucket: Bucket the objects were uploaded to
+    :return: dict mapping object names to their entry with key, size and checksum
+    """
+    manifest = {}
+    if manifest_path is None or not os.path.exists(manifest_path):
+        return manifest
+
+    with open(manifest_path, "r") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line might be incomplete if a previous run was killed while writing
+                continue
+            if entry.get("bucket") == bucket:
+                manifest[entry["key"]] = entry
+    return manifest
+
+class _ManifestWriter:
+    """Append entries to the manifest file from several upload threads"""
+
+    def __init__(self, manifest_path, bucket):
+        self.bucket = bucket
+        self.lock = threading.Lock()
+        self.file = None
+        if manifest_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(manifest_path)), exist_ok=True)
+            self.file = open(manifest_path, "a")
+
+    def add(self, key, size, checksum):
+        if self.file is None:
+            return
+        entry = json.dumps({"bucket": self.bucket, "key": key, "size": size, "checksum": checksum})
+        with self.lock:
+            self.file.write(entry + "\n")
+            # flush after every entry so that an interrupted run still knows what was uploaded
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+def get_existing_object_sizes(s3, bucket, object_names, max_workers=16):
+    """Get the sizes of objects that already exist in the bucket in the folders of the given object names
+    :param s3: Initialized S3 client object
+    :param bucket: Bucket to check
+    :param object_names: Object names that should be uploaded
+    :param max_workers: Number of folders that are listed concurrently
+    :return: dict mapping existing object names to their size in bytes
+    """
+    # list each folder only once
+    prefixes = sorted({name.rsplit("/", 1)[0] + "/" if "/" in name else "" for name in object_names})
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        listings = executor.map(lambda prefix: list_objects_with_prefix(s3, bucket, prefix, suffix=None), prefixes)
+        return {obj["Key"]: obj["Size"] for objects in listings for obj in objects}
+
+# %%
+# method to upload a single file
+def _upload_one(s3, file_name, bucket, object_name, transfer_config):
+    """Upload a single file and return its size and md5 checksum"""
+    size = os.path.getsize(file_name)
+
+    if size < transfer_config.multipart_threshold:
+        # small files are read once and sent with a single request, which is
+        # cheaper than the managed transfer for the many small crop files
+        with open(file_name, "rb") as f:
+            body = f.read()
+        s3.put_object(Bucket=bucket, Key=object_name, Body=body)
+        checksum = hashlib.md5(body).hexdigest()
+    else:
+        # large files are uploaded in concurrent parts by the managed transfer
+        s3.upload_file(file_name, bucket, object_name, Config=transfer_config)
+        md5 = hashlib.md5()
+        with open(file_name, "rb") as f:
+            for chunk in iter(lambda: f.read(8 * MB), b""):
+                md5.update(chunk)
+        checksum = md5.hexdigest()
+
+    return size, checksum
+
+# %%
+# method to upload many files
+def upload_files_concurrently(s3, files, bucket, object_names=None, manifest_path=None, check_bucket=True,
+                              max_workers=32, multipart_threshold=64*MB, multipart_chunksize=16*MB, verbose=False):
+    """Upload many files concurrently to an S3 bucket, skipping files that were already uploaded
+
+    The client should allow at least max_workers connections (max_pool_connections),
+    otherwise the upload threads wait for free connections.
+
+    :param s3: Initialized S3 client object
+    :param files: List of files to upload
+    :param bucket: Bucket to upload to
+    :param object_names: List of S3 object names. If not specified the basenames of the files are used
+    :param manifest_path: Path to the local manifest recording uploaded objects. If None, no manifest is used
+    :param check_bucket: If True, skip files that already exist in the bucket with the same size
+    :param max_workers: Number of files that are uploaded concurrently
+    :param multipart_threshold: Files larger than this (in bytes) are uploaded in parts
+    :param multipart_chunksize: Size of the parts (in bytes) of multipart uploads
+    :param verbose: If True, print each uploaded object name
+    :return: dict with number of uploaded, skipped and failed files, uploaded bytes and runtime in seconds
+    """
+    start_time = time.time()
+
+    # If S3 object_names were not specified, use the basenames of the files
+    if object_names is None:
+        object_names = [os.path.basename(file_name) for file_name in files]
+
+    # find files that were already uploaded in a previous run
+    manifest = load_manifest(manifest_path, bucket)
+    existing = {}
+    if check_bucket:
+        existing = get_existing_object_sizes(s3, bucket, [name for name in object_names if name not in manifest])
+
+    to_upload = []
+    n_skipped = 0
+    for file_name, object_name in zip(files, object_names):
+        size = os.path.getsize(file_name)
+        if object_name in manifest and manifest[object_name]["size"] == size:
+            n_skipped += 1
+        elif existing.get(object_name) == size:
+            n_skipped += 1
+        else:
+            to_upload.append((file_name, object_name))
+
+    if s3.meta.config.max_pool_connections < max_workers:
+        logging.warning(f"S3 client allows only {s3.meta.config.max_pool_connections} connections for {max_workers} upload threads")
+
+    transfer_config = TransferConfig(multipart_threshold=multipart_threshold, multipart_chunksize=multipart_chunksize)
+    manifest_writer = _ManifestWriter(manifest_path, bucket)
+
+    n_uploaded, n_failed, n_bytes = 0, 0, 0
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(_upload_one, s3, file_name, bucket, object_name, transfer_config): object_name
+                       for file_name, object_name in to_upload}
+
+            for future in as_completed(futures):
+                object_name = futures[future]
+                try:
+                    size, checksum = future.result()
+                except (ClientError, OSError) as e:
+                    logging.error(f"Failed to upload {object_name}: {e}")
+                    n_failed += 1
+                    continue
+
+                manifest_writer.add(object_name, size, checksum)
+                n_uploaded += 1
+                n_bytes += size
+                if verbose:
+                    print("uploaded: ", object_name, flush=True)
+    finally:
+        manifest_writer.close()
+
+    # summarize throughput of this upload
+    runtime = time.time() - start_time
+    summary = {"uploaded": n_uploaded, "skipped": n_skipped, "failed": n_failed, "bytes": n_bytes, "seconds": runtime}
+    print(f"uploaded {n_uploaded} files ({n_bytes/MB:.1f} MB), skipped {n_skipped}, failed {n_failed} " + \
+          f"in {runtime:.1f} s: {n_uploaded/max(runtime, 1e-9):.1f} files/s, {n_bytes/MB/max(runtime, 1e-9):.2f} MB/s", flush=True)
+
+    return summary
+
+# %%
@@ -1,56 +1,106 @@
 # methods to read and write data from and to S3 buckets
 
 # %%
-import boto3
+import io
+import xarray as xr
 import os
+import shutil
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ClientError
 from data_buckets_IO.bucket_information import get_bucket_prefix
-from data_buckets_IO.s3_bucket_credentials import S3_ACCESS_KEY, S3_SECRET_ACCESS_KEY, S3_ENDPOINT_URL
+from data_buckets_IO.s3_transport import get_s3_client, get_transfer_metrics, dump_transfer_metrics, reset_transfer_metrics, \
+    merge_transfer_metrics
 
 # %%
 # method to initialize the S3 client
-def Initialize_s3_client():
+def Initialize_s3_client(S3_ENDPOINT_URL=None, S3_ACCESS_KEY=None, S3_SECRET_ACCESS_KEY=None, max_pool_connections=50, max_attempts=10):
     """Initialize the S3 client
+    The client is created once per process and shared by all threads, see data_buckets_IO.s3_transport
+    :param S3_ENDPOINT_URL: S3 endpoint URL. If not specified, the one in s3_bucket_credentials is used
+    :param S3_ACCESS_KEY: S3 access key. If not specified, the one in s3_bucket_credentials is used
+    :param S3_SECRET_ACCESS_KEY: S3 secret access key. If not specified, the one in s3_bucket_credentials is used
+    :param max_pool_connections: Maximum number of connections kept in the pool, should be at least the number of threads using the client
+    :param max_attempts: Maximum number of attempts of a request, throttling and 5xx responses are retried with backoff
     :return: S3 client object
     """
-    # Initialize the S3 client
-    s3 = boto3.client(
-        's3',
-        endpoint_url=S3_ENDPOINT_URL,
-        aws_access_key_id=S3_ACCESS_KEY,
-        aws_secret_access_key=S3_SECRET_ACCESS_KEY
-    )
+    # use the default credentials if not given
+    if S3_ENDPOINT_URL is None or S3_ACCESS_KEY is None or S3_SECRET_ACCESS_KEY is None:
+        from data_buckets_IO import s3_bucket_credentials as credentials
+        S3_ENDPOINT_URL = S3_ENDPOINT_URL or credentials.S3_ENDPOINT_URL
+        S3_ACCESS_KEY = S3_ACCESS_KEY or credentials.S3_ACCESS_KEY
+        S3_SECRET_ACCESS_KEY = S3_SECRET_ACCESS_KEY or credentials.S3_SECRET_ACCESS_KEY
+
+    # get the shared S3 client
+    s3 = get_s3_client(S3_ENDPOINT_URL, S3_ACCESS_KEY, S3_SECRET_ACCESS_KEY, 
+                       max_pool_connections=max_pool_connections, max_attempts=max_attempts)
     return s3
 
 # %%
 # methods for reading data
-def read_file(s3, file_name, bucket):
-    """reading a file from an S3 bucket
+def read_file(s3, file_name, bucket, cache=None):
+    """reading a file from an S3 bucket into memory
     :param s3: Initialized S3 client object
-    :param file_name: File to upload
-    :param bucket: Bucket to upload to
-    :return: object if file was uploaded, else False
+    :param file_name: File to read
+    :param bucket: Bucket to read from
+    :param cache: ObjectCache to read the file from, the file is only downloaded if not cached or changed
+    :return: raw bytes of the object if file was read, else None
     """
+    if cache is not None:
+        cached_file = cache.get(s3, bucket, file_name)
+        if cached_file is None:
+            return None
+        with open(cached_file, "rb") as f:
+            return f.read()
+
     try:
-        #with open(file_name, "rb") as f:
         obj = s3.get_object(Bucket=bucket, Key=file_name)
-        #print(obj)
-        myObject = obj['Body'].read().decode('utf-8')
+        myObject = obj['Body'].read()
     except ClientError as e:
         logging.error(e)
         return None
     return myObject
 
-def download_file(s3, file_name, bucket, local_path):
+def read_dataset(s3, file_name, bucket, drop_variables=None, cache=None):
+    """reading a NetCDF file from an S3 bucket as xarray dataset without writing it to disk
+    :param s3: Initialized S3 client object
+    :param file_name: File to read
+    :param bucket: Bucket to read from
+    :param drop_variables: Variables that should not be read in
+    :param cache: ObjectCache to read the file from, the file is only downloaded if not cached or changed
+    :return: xr.Dataset opened from the in-memory buffer (or the cached file) if file was read, else None
+    """
+    if cache is not None:
+        # open the cached file directly instead of reading it into memory
+        cached_file = cache.get(s3, bucket, file_name)
+        if cached_file is None:
+            return None
+        return xr.open_dataset(cached_file, engine="h5netcdf", drop_variables=drop_variables)
+
+    myObject = read_file(s3, file_name, bucket)
+    if myObject is None:
+        return None
+
+    # io.BytesIO shares the memory of the bytes object as long as it is not written to, 
+    # so the object body is not copied again before h5netcdf reads from it
+    return xr.open_dataset(io.BytesIO(myObject), engine="h5netcdf", drop_variables=drop_variables)
+
+def download_file(s3, file_name, bucket, local_path, cache=None):
     """Download a file from an S3 bucket
 
     :param s3: Initialized S3 client object
     :param file_name: File to download
     :param bucket: Bucket to download from
     :param local_path: Local path to save the downloaded file
+    :param cache: ObjectCache to copy the file from, the file is only downloaded if not cached or changed
     :return: True if file was downloaded, else False
     """
+    if cache is not None:
+        cached_file = cache.get(s3, bucket, file_name)
+        if cached_file is None:
+            return False
+        shutil.copyfile(cached_file, local_path)
+        return True
 
     try:
         with open(local_path, "wb") as f:
@@ -66,34 +116,75 @@ def list_objects(s3, S3_BUCKET_NAME):
     for item in response['Contents']:
         print(item['Key'])
     
-def list_objects_within_study_period(s3, S3_BUCKET_NAME, years, months, days):
-    """List all object names within the study period"""
-    
-    all_files = []
-
-    for year in years:
-        for month in months:
-            for day in days:
-                
-                # get prefix for the folder structure in the bucket
-                prefix = get_bucket_prefix(S3_BUCKET_NAME, year, month, day)
-                    
-                # read all objects for the given day
-                response = s3.list_objects_v2(
-                    Bucket=S3_BUCKET_NAME,
-                    Prefix=prefix
-                )
-                if "Contents" not in response:
-                    continue
-
-                # loop over all objects for the given day
-                for obj in response["Contents"]:
-                    key = obj["Key"]
-                    if not key.endswith(".nc"):
-                        continue
-                    
-                    all_files.append(key)
-    
+def list_objects_with_prefix(s3, S3_BUCKET_NAME, prefix, suffix=".nc"):
+    """List all objects below a prefix, following the continuation tokens
+    :param s3: Initialized S3 client object
+    :param S3_BUCKET_NAME: Name of the S3 bucket
+    :param prefix: Prefix of the objects to list
+    :param suffix: Only objects with keys ending in suffix are returned. If None, all objects are returned
+    :return: List of dicts with Key, Size, ETag and LastModified of each object
+    """
+    objects = []
+    kwargs = {"Bucket": S3_BUCKET_NAME, "Prefix": prefix}
+
+    # one response contains at most 1000 objects, continue until the listing is complete
+    while True:
+        response = s3.list_objects_v2(**kwargs)
+
+        for obj in response.get("Contents", []):
+            if suffix is not None and not obj["Key"].endswith(suffix):
+                continue
+            objects.append({
+                "Key": obj["Key"],
+                "Size": obj["Size"],
+                "ETag": obj["ETag"].strip('"'),
+                "LastModified": obj["LastModified"],
+            })
+
+        if not response.get("IsTruncated"):
+            break
+        kwargs["ContinuationToken"] = response["NextContinuationToken"]
+
+    return objects
+
+def list_objects_within_study_period(s3, S3_BUCKET_NAME, years, months, days, with_metadata=False, max_workers=16, use_inventory=False,
+                                     inventory_max_age=None):
+    """List all object names within the study period
+    :param s3: Initialized S3 client object
+    :param S3_BUCKET_NAME: Name of the S3 bucket
+    :param years: Years of the study period
+    :param months: Months of the study period
+    :param days: Days of the study period
+    :param with_metadata: If True, return dicts with Key, Size, ETag and LastModified instead of keys only
+    :param max_workers: Number of daily prefixes that are listed concurrently
+    :param use_inventory: If True, take the objects from the local inventory, only prefixes not synced yet are listed
+    :param inventory_max_age: datetime.timedelta after which the prefixes in the inventory are listed again. 
+                              If None, synced prefixes are never listed again, so objects uploaded later are missing
+    :return: List of object keys (or object dicts) sorted by day
+    """
+    if use_inventory:
+        # imported here, as the inventory itself uses the methods of this module
+        from data_buckets_IO.bucket_inventory import refresh_inventory, query_study_period
+        inventory = refresh_inventory(s3, S3_BUCKET_NAME, years, months, days, max_age=inventory_max_age, max_workers=max_workers)
+        objects = query_study_period(inventory, years, months, days, with_metadata=True)
+        if with_metadata:
+            return [{"Key": row.key, "Size": row.size, "ETag": row.etag, "LastModified": row.last_modified}
+                    for row in objects.itertuples()]
+        return objects.key.tolist()
+
+    # get prefix for the folder structure in the bucket for each day
+    prefixes = [get_bucket_prefix(S3_BUCKET_NAME, year, month, day)
+                for year in years for month in months for day in days]
+
+    # list the daily prefixes concurrently, boto3 clients are thread-safe
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        daily_objects = executor.map(lambda prefix: list_objects_with_prefix(s3, S3_BUCKET_NAME, prefix), prefixes)
+
+        # executor.map keeps the order of the prefixes
+        all_files = []
+        for objects in daily_objects:
+            all_files.extend(objects if with_metadata else [obj["Key"] for obj in objects])
+
     return all_files
 
 # %%
@@ -1,11 +1,11 @@
 # script to upload MSG timeseries data to the data bucket
 # %%
 import os
-import boto3
-from botocore.exceptions import ClientError
+import datetime
 from s3_bucket_credentials import S3_ACCESS_KEY, S3_SECRET_ACCESS_KEY, S3_ENDPOINT_URL
-from bucket_information import get_bucket_prefix, get_all_bucket_names
-from data_buckets_read_and_write import Initialize_s3_client, read_file, upload_file
+from bucket_information import get_all_bucket_names
+from data_buckets_read_and_write import Initialize_s3_client, download_file, dump_transfer_metrics
+from bucket_inventory import refresh_inventory, query_study_period, count_files
 
 BUCKETS = get_all_bucket_names()
 s3 = Initialize_s3_client(S3_ENDPOINT_URL, S3_ACCESS_KEY, S3_SECRET_ACCESS_KEY)
@@ -20,65 +20,50 @@ months = range(4, 10)
 days = range(1, 32)
 download = False
 verbose = False
+# days synced longer ago than this are listed again, so objects uploaded since then are found
+inventory_max_age = datetime.timedelta(days=1)
+
+# refresh the local inventory of the bucket, only prefixes that were not synced yet or not within inventory_max_age are listed
+inventory = refresh_inventory(s3, S3_BUCKET_NAME, years, months, days, max_age=inventory_max_age)
+inventory = query_study_period(inventory, years, months, days, with_metadata=True)
+
+# count files per year, month and day from the inventory
+counts_day = count_files(inventory, by=["year", "month", "day"])
+counts_month = count_files(inventory, by=["year", "month"])
+counts_year = count_files(inventory, by=["year"])
 
 n_total = 0
 
 for year in years:
-    n_year = 0
+    n_year = counts_year.get(year, 0)
 
     for month in months:
-        n_month = 0
-
-        for day in days:
-            
-            # get prefix for the folder structure in the bucket
-            prefix = get_bucket_prefix(S3_BUCKET_NAME, year, month, day)
-                
-            try:
-                # read all objects for the given day
-                response = s3.list_objects_v2(
-                    Bucket=S3_BUCKET_NAME,
-                    Prefix=prefix
-                )
-                if "Contents" not in response:
+        n_month = counts_month.get((year, month), 0)
+
+        if verbose:
+            for day in days:
+                print(f">>> {year}{month:02d}{day:02d}: {counts_day.get((year, month, day), 0)} files")
+
+        if download and outpath is not None:
+            month_objects = query_study_period(inventory, [year], [month], days)
+            for key in month_objects:
+                # get filename of the object
+                filename = os.path.basename(key)
+
+                # define local path to save the file
+                local_file = os.path.join(outpath, filename)
+
+                # check if file already exists
+                if os.path.exists(local_file):
+                    if verbose:
+                        print(f"Already downloaded: {filename}")
                     continue
 
-                n_day = 0
-                # loop over all objects for the given day
-                for obj in response["Contents"]:
-                    key = obj["Key"]
-                    if not key.endswith(".nc"):
-                        continue
-                    n_day += 1
-                    n_month += 1
-
-                    if download and outpath is not None:
-                        # get filename of the object
-                        filename = os.path.basename(key)
-
-                        # define local path to save the file
-                        local_file = os.path.join(outpath, filename)
-
-                        # check if file already exists
-                        if os.path.exists(local_file):
-                            if verbose:
-                                print(f"Already downloaded: {filename}")
-                            continue
-
-                        # download file to local path
-                        if verbose:
-                            print(f"Downloading: {key}")
-                        with open(local_file, "wb") as f:
-                            s3.download_fileobj(S3_BUCKET_NAME, key, f)
-            
-            # catching errors
-            except ClientError as e:
-                print(f"Failed to list/download files for {year}-{month:02d}-{day:02d}: {e}")
-            
-            if verbose:
-                print(f">>> {year}{month:02d}{day:02d}: {n_day} files")
-
-        n_year += n_month
+                # download file to local path
+                if verbose:
+                    print(f"Downloading: {key}")
+                download_file(s3, key, S3_BUCKET_NAME, local_file)
+
         print(f"> {year}{month:02d}: {n_month} files")
     
     n_total += n_year
@@ -86,4 +71,7 @@ for year in years:
 
 print("\nn_total =", n_total)
 
+# print number of requests, bytes and latencies of the S3 calls
+dump_transfer_metrics()
+
 # %%
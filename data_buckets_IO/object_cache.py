@@ -0,0 +1,181 @@
+# local on-disk cache of objects downloaded from S3 buckets
+
+# %%
+import os
+import glob
+import hashlib
+import logging
+import tempfile
+import threading
+from botocore.exceptions import ClientError
+
+GB = 1024 * 1024 * 1024
+
+# %%
+class ObjectCache:
+    """On-disk cache of bucket objects, keyed by bucket, key and ETag
+
+    Entries are written to a temporary file and renamed into place, so several
+    processes or threads can share the same cache directory. If the cache grows
+    beyond max_bytes, the least recently used entries are deleted.
+    """
+
+    def __init__(self, cache_dir, max_bytes=50*GB):
+        """
+        :param cache_dir: Directory where the cached objects are stored
+        :param max_bytes: Maximum size of the cache in bytes
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # size of the cache known to this process, the directory is only scanned again if it exceeds max_bytes
+        self._size = None
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry_base(self, bucket, key):
+        """Path of the cache entry of an object without ETag and extension"""
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.cache_dir, bucket, digest[:2], digest)
+
+    def _entry_path(self, bucket, key, etag):
+        """Path of the cache entry of an object with given ETag, keeping the file extension of the key"""
+        extension = os.path.splitext(key)[1]
+        etag = etag.strip('"')
+        return f"{self._entry_base(bucket, key)}_{etag}{extension}"
+
+    def _cached_entries(self, bucket, key):
+        return glob.glob(f"{self._entry_base(bucket, key)}_*")
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, s3, bucket, key, etag=None):
+        """Get the local path of an object, downloading it only if it is not cached or has changed
+
+        If the ETag is known (e.g. from listing the bucket), a cached entry with the same ETag
+        is returned without any request. Otherwise the object is requested with If-None-Match,
+        so an unchanged object is not downloaded again.
+
+        :param s3: Initialized S3 client object
+        :param bucket: Bucket of the object
+        :param key: Key of the object
+        :param etag: Current ETag of the object, if known
+        :return: Path to the cached file, None if the object could not be read
+        """
+        if etag is not None:
+            path = self._entry_path(bucket, key, etag)
+            if os.path.exists(path):
+                self._touch(path)
+                self._count(hit=True)
+                return path
+
+        cached = self._cached_entries(bucket, key)
+        request = {"Bucket": bucket, "Key": key}
+        if cached:
+            # the ETag of the cached entry is stored in its filename
+            cached_etag = os.path.splitext(os.path.basename(cached[0]))[0].split("_", 1)[1]
+            request["IfNoneMatch"] = f'"{cached_etag}"'
+
+        try:
+            obj = s3.get_object(**request)
+        except ClientError as e:
+            if cached and e.response.get("Error", {}).get("Code") in ("304", "NotModified"):
+                # object did not change since it was cached
+                self._touch(cached[0])
+                self._count(hit=True)
+                return cached[0]
+            logging.error(e)
+            return None
+
+        self._count(hit=False)
+        path = self._write(bucket, key, obj["ETag"], obj["Body"])
+
+        # remove outdated versions of this object
+        for old_path in cached:
+            if old_path != path:
+                self._remove(old_path)
+
+        self.evict()
+        return path
+
+    def _write(self, bucket, key, etag, body):
+        """Write the object body atomically to the cache"""
+        path = self._entry_path(bucket, key, etag)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # write to a temporary file in the same directory and rename it into place,
+        # so other workers never see a partially written entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in iter(lambda: body.read(8 * 1024 * 1024), b""):
+                    f.write(chunk)
+            os.replace(tmp_path, path)
+        except BaseException:
+            self._remove(tmp_path)
+            raise
+
+        with self._lock:
+            if self._size is not None:
+                self._size += os.path.getsize(path)
+        return path
+
+    def _touch(self, path):
+        # the modification time is used as time of last use for the LRU eviction
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # already removed by another worker
+            pass
+
+    def size(self):
+        """Get the total size of all cached entries in bytes"""
+        return sum(size for _, size, _ in self._entries())
+
+    def _entries(self):
+        entries = []
+        for path in glob.glob(os.path.join(self.cache_dir, "*", "*", "*")):
+            if path.endswith(".tmp"):
+                continue
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def evict(self):
+        """Delete the least recently used entries until the cache is smaller than max_bytes"""
+        with self._lock:
+            if self._size is not None and self._size <= self.max_bytes:
+                return
+
+            entries = self._entries()
+            total = sum(size for _, size, _ in entries)
+
+            # oldest entries first
+            for path, size, _ in sorted(entries, key=lambda entry: entry[2]):
+                if total <= self.max_bytes:
+                    break
+                self._remove(path)
+                total -= size
+
+            self._size = total
+
+    def stats(self):
+        """Get number of cache hits and misses"""
+        return {"hits": self.hits, "misses": self.misses}
+
+# %%
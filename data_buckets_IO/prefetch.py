@@ -0,0 +1,130 @@
+# iterator over datasets in S3 buckets that downloads and decodes the next objects while the current one is processed
+
+# %%
+import io
+import collections
+import contextlib
+import xarray as xr
+from data_buckets_IO.ranged_reader import S3RangeFile
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# item yielded by the iterator, either dataset or error is None
+BucketItem = collections.namedtuple("BucketItem", ["key", "dataset", "error"])
+
+# %%
+def _stage(timer, name):
+    """Time a block as stage of the timer, if one is given"""
+    return timer.stage(name) if timer is not None else contextlib.nullcontext()
+
+def _open_one(s3, bucket, key, etag=None, variables=None, transform=None, cache=None, load=True, ranged=False, range_stats=None,
+              timer=None):
+    """Download and open a single object as dataset, raising any error"""
+    with _stage(timer, "fetch"):
+        source = _get_source(s3, bucket, key, etag, cache, ranged, range_stats)
+
+    with _stage(timer, "decode"):
+        ds = None
+        try:
+            ds = xr.open_dataset(source, engine="h5netcdf")
+            selection = ds[variables] if variables is not None else ds
+            if transform is not None:
+                selection = transform(selection)
+
+            if load:
+                # decode the data in the worker thread, the file (or in-memory buffer) is not needed afterwards
+                with ds:
+                    selection = selection.load()
+        except BaseException:
+            # the dataset is not returned, so release the file and the connection of the ranged reads
+            if ds is not None:
+                ds.close()
+            if ranged:
+                source.close()
+            raise
+        if load and ranged:
+            source.close()
+    return selection
+
+def _get_source(s3, bucket, key, etag, cache, ranged, range_stats):
+    """Get the object as file-like object or cached file, the ranged reads only download when the data is decoded"""
+    if ranged:
+        # only the parts of the file needed for the selected variables are downloaded
+        source = S3RangeFile(s3, bucket, key, stats=range_stats)
+    elif cache is not None:
+        source = cache.get(s3, bucket, key, etag=etag)
+        if source is None:
+            raise FileNotFoundError(f"{key} could not be read from bucket {bucket}")
+    else:
+        source = io.BytesIO(s3.get_object(Bucket=bucket, Key=key)["Body"].read())
+    return source
+
+def _try_open_one(s3, bucket, key, etag, options):
+    try:
+        return BucketItem(key, _open_one(s3, bucket, key, etag, **options), None)
+    except Exception as e:
+        return BucketItem(key, None, e)
+
+# %%
+def iter_bucket_datasets(s3, bucket, keys, variables=None, prefetch=8, workers=4, ordered=True,
+                         etags=None, cache=None, load=True, ranged=False, range_stats=None, transform=None, timer=None):
+    """Iterate over the objects of a bucket as xarray datasets, downloading and decoding the next objects in the background
+
+    At most prefetch objects are in flight or waiting to be consumed at any time, so the memory
+    is bounded by prefetch times the size of one (decoded) dataset. Objects that can not be read
+    or opened do not stop the iteration: they are yielded with the error instead of the dataset.
+
+    :param s3: Initialized S3 client object
+    :param bucket: Bucket to read from
+    :param keys: Keys of the objects to read
+    :param variables: List of variables to keep. If None, all variables are kept
+    :param prefetch: Maximum number of objects that are downloaded and decoded ahead
+    :param workers: Number of threads downloading and decoding the objects
+    :param ordered: If True, yield the objects in the order of keys, else as soon as they are ready
+    :param etags: dict mapping keys to their ETags (e.g. from listing the bucket), only used with cache
+    :param cache: ObjectCache to read the objects from, objects are only downloaded if not cached or changed
+    :param load: If True, load the data into memory in the worker threads, else the datasets are opened lazily
+    :param ranged: If True, read the objects with ranged GET requests (S3RangeFile) instead of downloading them completely, 
+                   which saves most of the transfer if only some variables are needed. The cache is not used then
+    :param range_stats: RangeReadStats collecting the bytes fetched by the ranged reads
+    :param transform: Function applied to each opened dataset in the worker threads, e.g. to read only a window of it
+    :param timer: StageTimer (see helpers/stage_timer.py) timing the stages "fetch" and "decode" of each object.
+                  With ranged reads the data is downloaded while it is decoded
+    :return: Iterator of BucketItem(key, dataset, error)
+    """
+    keys = iter(keys)
+    in_flight = collections.deque()
+    options = {"variables": variables, "transform": transform, "cache": cache, "load": load, 
+               "ranged": ranged, "range_stats": range_stats, "timer": timer}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+
+        def submit_next():
+            key = next(keys, None)
+            if key is None:
+                return False
+            etag = etags.get(key) if etags is not None else None
+            in_flight.append(executor.submit(_try_open_one, s3, bucket, key, etag, options))
+            return True
+
+        # fill the queue of objects in flight
+        while len(in_flight) < max(prefetch, 1) and submit_next():
+            pass
+
+        try:
+            while in_flight:
+                if ordered:
+                    future = in_flight.popleft()
+                else:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    future = done.pop()
+                    in_flight.remove(future)
+
+                # start the next download before handing out this dataset
+                submit_next()
+                yield future.result()
+        finally:
+            # if the consumer stops early, do not start the objects that are still queued
+            for future in in_flight:
+                future.cancel()
+
+# %%
@@ -0,0 +1,199 @@
+# read-only file-like access to objects in S3 buckets with ranged GET requests, so only the needed parts of a file are downloaded
+
+# %%
+import io
+import threading
+import contextlib
+import collections
+from botocore.exceptions import ClientError
+
+KB = 1024
+MB = 1024 * KB
+
+# %%
+class RangeReadStats:
+    """Thread-safe totals of the bytes fetched by ranged reads compared to the size of the objects"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.objects = 0
+        self.requests = 0
+        self.bytes_fetched = 0
+        self.object_bytes = 0
+
+    def add(self, requests, bytes_fetched, object_bytes):
+        with self._lock:
+            self.objects += 1
+            self.requests += requests
+            self.bytes_fetched += bytes_fetched
+            self.object_bytes += object_bytes
+
+    def summary(self):
+        """Get the totals as dict, fraction is the share of the object sizes that was downloaded"""
+        with self._lock:
+            return {
+                "objects": self.objects,
+                "requests": self.requests,
+                "bytes_fetched": self.bytes_fetched,
+                "object_bytes": self.object_bytes,
+                "fraction": self.bytes_fetched / self.object_bytes if self.object_bytes > 0 else 0.0,
+            }
+
+    def __str__(self):
+        s = self.summary()
+        return f"fetched {s['bytes_fetched']/MB:.1f} MB of {s['object_bytes']/MB:.1f} MB ({100*s['fraction']:.1f}%) " + \
+               f"from {s['objects']} objects with {s['requests']} requests"
+
+# %%
+class S3RangeFile(io.RawIOBase):
+    """Read-only, seekable file-like object over an S3 object, reading it with ranged GET requests
+
+    The object is read in blocks of block_size bytes which are kept in an LRU cache, so the many
+    small reads of the HDF5 metadata are served from few requests. Missing blocks of one read are
+    fetched together, also across gaps of up to max_gap_blocks cached blocks, as one request is
+    cheaper than several small ones. h5py (and xarray with engine="h5netcdf") can open this object
+    directly and then only downloads the chunks of the variables that are accessed.
+    """
+
+    def __init__(self, s3, bucket, key, block_size=256*KB, max_cached_blocks=256, max_gap_blocks=2, stats=None):
+        """
+        :param s3: Initialized S3 client object
+        :param bucket: Bucket of the object
+        :param key: Key of the object
+        :param block_size: Size of the blocks that are read and cached in bytes
+        :param max_cached_blocks: Maximum number of blocks kept in memory
+        :param max_gap_blocks: Missing blocks separated by at most this many cached blocks are fetched with one request
+        :param stats: RangeReadStats the fetched bytes of this object are added to when it is closed
+        """
+        super().__init__()
+        # size and ETag of the object, the ETag makes sure all ranges are read from the same version
+        head = s3.head_object(Bucket=bucket, Key=key)
+        self.size = head["ContentLength"]
+        self.etag = head["ETag"]
+
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.block_size = block_size
+        self.max_cached_blocks = max_cached_blocks
+        self.max_gap_blocks = max_gap_blocks
+        self.stats = stats
+
+        self.requests = 0
+        self.bytes_fetched = 0
+        self._blocks = collections.OrderedDict()
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._position = offset
+        elif whence == io.SEEK_CUR:
+            self._position += offset
+        elif whence == io.SEEK_END:
+            self._position = self.size + offset
+        else:
+            raise ValueError(f"invalid whence ({whence})")
+        if self._position < 0:
+            raise ValueError("negative seek position")
+        return self._position
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        start = self._position
+        end = self.size if size is None or size < 0 else min(start + size, self.size)
+        if start >= end:
+            return b""
+
+        first_block, last_block = start // self.block_size, (end - 1) // self.block_size
+        self._fetch_blocks(first_block, last_block)
+
+        data = b"".join(self._get_block(b) for b in range(first_block, last_block + 1))
+        offset = first_block * self.block_size
+        self._position = end
+        return data[start - offset:end - offset]
+
+    def _get_block(self, index):
+        # mark the block as recently used
+        self._blocks.move_to_end(index)
+        return self._blocks[index]
+
+    def _fetch_blocks(self, first_block, last_block):
+        """Fetch the missing blocks between first_block and last_block, coalescing them into few requests"""
+        missing = []
+        for b in range(first_block, last_block + 1):
+            if b in self._blocks:
+                # keep the cached blocks of this read from being dropped below
+                self._blocks.move_to_end(b)
+            else:
+                missing.append(b)
+        if not missing:
+            return
+
+        # group the missing blocks into runs, bridging small gaps of cached blocks
+        runs = [[missing[0], missing[0]]]
+        for b in missing[1:]:
+            if b - runs[-1][1] - 1 <= self.max_gap_blocks:
+                runs[-1][1] = b
+            else:
+                runs.append([b, b])
+
+        for run_start, run_end in runs:
+            self._fetch_range(run_start, run_end)
+
+        # drop the least recently used blocks, but keep the blocks of the current read
+        n_needed = last_block - first_block + 1
+        while len(self._blocks) > max(self.max_cached_blocks, n_needed):
+            self._blocks.popitem(last=False)
+
+    def _fetch_range(self, first_block, last_block):
+        start = first_block * self.block_size
+        end = min((last_block + 1) * self.block_size, self.size) - 1
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=self.key, Range=f"bytes={start}-{end}", IfMatch=self.etag)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("412", "PreconditionFailed"):
+                raise IOError(f"{self.key} changed in bucket {self.bucket} while it was read") from e
+            raise
+        # close the body also if reading it fails, so its connection is released to the pool
+        with contextlib.closing(response["Body"]) as body:
+            data = body.read()
+        self.requests += 1
+        self.bytes_fetched += len(data)
+
+        for b in range(first_block, last_block + 1):
+            block_start = (b - first_block) * self.block_size
+            self._blocks[b] = data[block_start:block_start + self.block_size]
+            self._blocks.move_to_end(b)
+
+    def report(self):
+        """Get the number of requests and the bytes fetched compared to the object size"""
+        return {
+            "key": self.key,
+            "requests": self.requests,
+            "bytes_fetched": self.bytes_fetched,
+            "object_bytes": self.size,
+            "fraction": self.bytes_fetched / self.size if self.size > 0 else 0.0,
+        }
+
+    def close(self):
+        if not self.closed and getattr(self, "stats", None) is not None:
+            self.stats.add(self.requests, self.bytes_fetched, self.size)
+        self._blocks.clear()
+        super().close()
+
+# %%
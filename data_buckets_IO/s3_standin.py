@@ -0,0 +1,392 @@
+# local stand-in for the S3 object store, serving buckets from memory over http on localhost with injectable latency and errors
+
+# %%
+import re
+import time
+import random
+import hashlib
+import threading
+import urllib.parse
+from email.utils import formatdate
+from xml.sax.saxutils import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from data_buckets_IO.s3_transport import get_s3_client
+
+# %%
+class _StoredObject:
+    def __init__(self, body, etag=None):
+        self.body = body
+        self.etag = etag or hashlib.md5(body).hexdigest()
+        self.last_modified = time.time()
+
+    def iso_last_modified(self):
+        return time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(self.last_modified))
+
+    def http_last_modified(self):
+        return formatdate(self.last_modified, usegmt=True)
+
+class S3StandIn:
+    """In-memory S3 stand-in served on localhost, for tests and benchmarks without the production object store
+
+    Supports the requests used in data_buckets_IO: ListObjectsV2, GetObject (with Range, If-Match
+    and If-None-Match), HeadObject, PutObject, DeleteObject and multipart uploads. Every request
+    is delayed by latency (plus a random jitter) and fails with error_status at error_rate, so the
+    retries and the concurrency settings of the client can be studied offline.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, error_status=503, bandwidth=None, seed=None):
+        """
+        :param latency: Delay of every request in seconds
+        :param jitter: Maximum additional random delay of every request in seconds
+        :param error_rate: Fraction of requests that fail with error_status
+        :param error_status: HTTP status of the injected errors (503 SlowDown or 500 InternalError)
+        :param bandwidth: Bandwidth per connection in bytes per second for request and response bodies. If None, unlimited
+        :param seed: Seed of the random latencies and errors
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.bandwidth = bandwidth
+        self.random = random.Random(seed)
+
+        self.buckets = {}
+        self.uploads = {}
+        self.lock = threading.Lock()
+        self.request_counts = {}
+        self.injected_errors = 0
+
+        self.server = None
+        self.thread = None
+        self.endpoint_url = None
+
+    # %%
+    # methods to start and stop the server
+    def start(self, port=0):
+        """Start serving on localhost, port 0 picks a free port
+        :return: endpoint url of the stand-in
+        """
+        handler = type("_Handler", (_S3RequestHandler,), {"standin": self})
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.endpoint_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        return self.endpoint_url
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def client(self, max_pool_connections=50, max_attempts=10, retry_mode="adaptive"):
+        """Get an S3 client for the stand-in, configured like the clients of the production store"""
+        return get_s3_client(self.endpoint_url, "standin", "standin", max_pool_connections=max_pool_connections,
+                             max_attempts=max_attempts, retry_mode=retry_mode)
+
+    # %%
+    # methods to fill and inspect the buckets directly
+    def create_bucket(self, bucket):
+        with self.lock:
+            self.buckets.setdefault(bucket, {})
+
+    def put(self, bucket, key, body):
+        with self.lock:
+            self.buckets.setdefault(bucket, {})[key] = _StoredObject(body)
+
+    def get(self, bucket, key):
+        with self.lock:
+            obj = self.buckets.get(bucket, {}).get(key)
+        return None if obj is None else obj.body
+
+    def keys(self, bucket, prefix=""):
+        with self.lock:
+            return sorted(key for key in self.buckets.get(bucket, {}) if key.startswith(prefix))
+
+    def reset_counts(self):
+        with self.lock:
+            self.request_counts = {}
+            self.injected_errors = 0
+
+    def _count(self, operation):
+        with self.lock:
+            self.request_counts[operation] = self.request_counts.get(operation, 0) + 1
+
+    def _inject(self):
+        """Delay the request and decide if it fails"""
+        delay = self.latency
+        with self.lock:
+            if self.jitter > 0:
+                delay += self.random.uniform(0, self.jitter)
+            fail = self.error_rate > 0 and self.random.random() < self.error_rate
+            if fail:
+                self.injected_errors += 1
+        if delay > 0:
+            time.sleep(delay)
+        return fail
+
+    def _transfer(self, n_bytes):
+        """Delay a body transfer according to the bandwidth"""
+        if self.bandwidth is not None and n_bytes > 0:
+            time.sleep(n_bytes / self.bandwidth)
+
+# %%
+_ERROR_CODES = {
+    304: "NotModified",
+    404: "NoSuchKey",
+    412: "PreconditionFailed",
+    416: "InvalidRange",
+    500: "InternalError",
+    503: "SlowDown",
+}
+
+class _S3RequestHandler(BaseHTTPRequestHandler):
+    """Handle the S3 REST requests with path-style addressing (/bucket/key)"""
+
+    protocol_version = "HTTP/1.1"
+    standin = None
+
+    def log_message(self, format, *args):
+        # do not print every request
+        pass
+
+    # %%
+    # helpers to parse requests and send responses
+    def _parse(self):
+        url = urllib.parse.urlsplit(self.path)
+        parts = url.path.lstrip("/").split("/", 1)
+        bucket = urllib.parse.unquote(parts[0])
+        key = urllib.parse.unquote(parts[1]) if len(parts) > 1 else ""
+        query = dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+        return bucket, key, query
+
+    def _read_body(self):
+        if "chunked" in self.headers.get("Transfer-Encoding", ""):
+            raw = b""
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    # skip the trailers
+                    while self.rfile.readline().strip():
+                        pass
+                    break
+                raw += self.rfile.read(size)
+                self.rfile.readline()
+        else:
+            raw = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        # streaming uploads wrap the payload in aws-chunked encoding
+        if "aws-chunked" in self.headers.get("Content-Encoding", "") or \
+           self.headers.get("x-amz-content-sha256", "").startswith("STREAMING-"):
+            raw = _decode_aws_chunked(raw)
+
+        self.standin._transfer(len(raw))
+        return raw
+
+    def _send(self, status, body=b"", headers=None, send_body=True):
+        self.send_response(status)
+        headers = headers or {}
+        headers.setdefault("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if send_body and body:
+            self.standin._transfer(len(body))
+            self.wfile.write(body)
+
+    def _send_error(self, status, code=None, send_body=True):
+        code = code or _ERROR_CODES.get(status, "InternalError")
+        body = b"" if status == 304 else \
+            f'<?xml version="1.0" encoding="UTF-8"?><Error><Code>{code}</Code><Message>{code}</Message></Error>'.encode()
+        self._send(status, body, {"Content-Type": "application/xml"}, send_body=send_body)
+
+    def _handle(self, method):
+        standin = self.standin
+        bucket, key, query = self._parse()
+        body = self._read_body() if method in ("PUT", "POST") else b""
+
+        operation = _operation_name(method, key, query)
+        standin._count(operation)
+        if standin._inject():
+            self._send_error(standin.error_status, send_body=method != "HEAD")
+            return
+
+        with standin.lock:
+            exists = bucket in standin.buckets
+        if not exists:
+            self._send_error(404, "NoSuchBucket", send_body=method != "HEAD")
+            return
+
+        getattr(self, f"_{operation}")(bucket, key, query, body)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_HEAD(self):
+        self._handle("HEAD")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+    # %%
+    # operations
+    def _head_bucket(self, bucket, key, query, body):
+        self._send(200)
+
+    def _list_objects_v2(self, bucket, key, query, body):
+        prefix = query.get("prefix", "")
+        max_keys = int(query.get("max-keys", 1000))
+        start_after = query.get("continuation-token", query.get("start-after", ""))
+
+        with self.standin.lock:
+            objects = self.standin.buckets[bucket]
+            keys = sorted(k for k in objects if k.startswith(prefix) and k > start_after)
+            page = [(k, objects[k]) for k in keys[:max_keys]]
+        truncated = len(keys) > max_keys
+
+        contents = "".join(
+            f"<Contents><Key>{escape(k)}</Key><LastModified>{obj.iso_last_modified()}</LastModified>"
+            f"<ETag>&quot;{obj.etag}&quot;</ETag><Size>{len(obj.body)}</Size><StorageClass>STANDARD</StorageClass></Contents>"
+            for k, obj in page)
+        # the last key of the page serves as continuation token
+        token = f"<NextContinuationToken>{escape(page[-1][0])}</NextContinuationToken>" if truncated else ""
+        xml = f'<?xml version="1.0" encoding="UTF-8"?><ListBucketResult><Name>{escape(bucket)}</Name>' + \
+              f"<Prefix>{escape(prefix)}</Prefix><KeyCount>{len(page)}</KeyCount><MaxKeys>{max_keys}</MaxKeys>" + \
+              f"<IsTruncated>{str(truncated).lower()}</IsTruncated>{contents}{token}</ListBucketResult>"
+        self._send(200, xml.encode(), {"Content-Type": "application/xml"})
+
+    def _get_object(self, bucket, key, query, body, send_body=True):
+        with self.standin.lock:
+            obj = self.standin.buckets[bucket].get(key)
+        if obj is None:
+            self._send_error(404, send_body=send_body)
+            return
+
+        headers = {"ETag": f'"{obj.etag}"', "Last-Modified": obj.http_last_modified(), "Accept-Ranges": "bytes"}
+        if_match = self.headers.get("If-Match")
+        if if_match is not None and if_match.strip('"') != obj.etag:
+            self._send_error(412, send_body=send_body)
+            return
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None and if_none_match.strip('"') == obj.etag:
+            self._send(304, headers={"ETag": f'"{obj.etag}"'})
+            return
+
+        status, data = 200, obj.body
+        byte_range = re.match(r"bytes=(\d*)-(\d*)", self.headers.get("Range", ""))
+        if byte_range:
+            size = len(obj.body)
+            start, end = byte_range.groups()
+            if start == "":
+                start, end = max(size - int(end), 0), size - 1
+            else:
+                start, end = int(start), min(int(end) if end else size - 1, size - 1)
+            if start >= size:
+                self._send_error(416, send_body=send_body)
+                return
+            status, data = 206, obj.body[start:end + 1]
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+
+        headers["Content-Type"] = "application/octet-stream"
+        headers["Content-Length"] = str(len(data))
+        self._send(status, data, headers, send_body=send_body)
+
+    def _head_object(self, bucket, key, query, body):
+        self._get_object(bucket, key, query, body, send_body=False)
+
+    def _put_object(self, bucket, key, query, body):
+        obj = _StoredObject(body)
+        with self.standin.lock:
+            self.standin.buckets[bucket][key] = obj
+        self._send(200, headers={"ETag": f'"{obj.etag}"'})
+
+    def _delete_object(self, bucket, key, query, body):
+        with self.standin.lock:
+            self.standin.buckets[bucket].pop(key, None)
+        self._send(204)
+
+    def _create_multipart_upload(self, bucket, key, query, body):
+        upload_id = hashlib.md5(f"{bucket}/{key}/{time.time()}/{threading.get_ident()}".encode()).hexdigest()
+        with self.standin.lock:
+            self.standin.uploads[upload_id] = {}
+        xml = f'<?xml version="1.0" encoding="UTF-8"?><InitiateMultipartUploadResult><Bucket>{escape(bucket)}</Bucket>' + \
+              f"<Key>{escape(key)}</Key><UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>"
+        self._send(200, xml.encode(), {"Content-Type": "application/xml"})
+
+    def _upload_part(self, bucket, key, query, body):
+        with self.standin.lock:
+            parts = self.standin.uploads.get(query["uploadId"])
+            if parts is not None:
+                parts[int(query["partNumber"])] = body
+        if parts is None:
+            self._send_error(404, "NoSuchUpload")
+            return
+        self._send(200, headers={"ETag": f'"{hashlib.md5(body).hexdigest()}"'})
+
+    def _complete_multipart_upload(self, bucket, key, query, body):
+        part_numbers = [int(n) for n in re.findall(rb"<PartNumber>(\d+)</PartNumber>", body)]
+        with self.standin.lock:
+            parts = self.standin.uploads.pop(query["uploadId"], None)
+        if parts is None:
+            self._send_error(404, "NoSuchUpload")
+            return
+
+        # the ETag of multipart uploads is the md5 of the part md5s with the number of parts
+        data = b"".join(parts[n] for n in part_numbers)
+        digests = b"".join(hashlib.md5(parts[n]).digest() for n in part_numbers)
+        obj = _StoredObject(data, etag=f"{hashlib.md5(digests).hexdigest()}-{len(part_numbers)}")
+        with self.standin.lock:
+            self.standin.buckets[bucket][key] = obj
+
+        xml = f'<?xml version="1.0" encoding="UTF-8"?><CompleteMultipartUploadResult><Bucket>{escape(bucket)}</Bucket>' + \
+              f"<Key>{escape(key)}</Key><ETag>&quot;{obj.etag}&quot;</ETag></CompleteMultipartUploadResult>"
+        self._send(200, xml.encode(), {"Content-Type": "application/xml"})
+
+    def _abort_multipart_upload(self, bucket, key, query, body):
+        with self.standin.lock:
+            self.standin.uploads.pop(query.get("uploadId"), None)
+        self._send(204)
+
+# %%
+def _operation_name(method, key, query):
+    """Get the name of the handler method of a request"""
+    if method == "GET":
+        return "get_object" if key else "list_objects_v2"
+    if method == "HEAD":
+        return "head_object" if key else "head_bucket"
+    if method == "PUT":
+        return "upload_part" if "uploadId" in query else "put_object"
+    if method == "POST":
+        return "create_multipart_upload" if "uploads" in query else "complete_multipart_upload"
+    if method == "DELETE":
+        return "abort_multipart_upload" if "uploadId" in query else "delete_object"
+    return None
+
+def _decode_aws_chunked(raw):
+    """Decode a payload in aws-chunked encoding: hex size[;chunk-signature=...] CRLF data CRLF ... 0 CRLF trailers"""
+    data = b""
+    position = 0
+    while True:
+        line_end = raw.index(b"\r\n", position)
+        size = int(raw[position:line_end].split(b";")[0], 16)
+        position = line_end + 2
+        if size == 0:
+            return data
+        data += raw[position:position + size]
+        position += size + 2
+
+# %%
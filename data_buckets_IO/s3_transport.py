@@ -0,0 +1,179 @@
+# shared S3 transport: one client per process with a tunable connection pool, adaptive retries and transfer metrics
+
+# %%
+import os
+import json
+import time
+import bisect
+import threading
+import boto3
+from botocore.config import Config
+
+# upper edges of the latency histogram bins in milliseconds
+LATENCY_BINS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float("inf")]
+
+# %%
+class TransferMetrics:
+    """Thread-safe counters of requests, bytes, latencies and retries of all S3 calls"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.retries = 0
+            self.errors = 0
+            self.bytes_sent = 0
+            self.bytes_received = 0
+            self.operations = {}
+
+    def _operation(self, name):
+        if name not in self.operations:
+            self.operations[name] = {"calls": 0, "seconds": 0.0, "latency_ms_histogram": [0] * len(LATENCY_BINS_MS)}
+        return self.operations[name]
+
+    def add_request(self, bytes_sent):
+        with self._lock:
+            self.requests += 1
+            self.bytes_sent += bytes_sent
+
+    def add_call(self, operation, seconds, bytes_received, retries, error=False):
+        with self._lock:
+            stats = self._operation(operation)
+            stats["calls"] += 1
+            stats["seconds"] += seconds
+            stats["latency_ms_histogram"][bisect.bisect_left(LATENCY_BINS_MS, seconds * 1000)] += 1
+            self.bytes_received += bytes_received
+            self.retries += retries
+            self.errors += int(error)
+
+    def merge(self, summary):
+        """Add the counters of a summary, e.g. of the metrics of a worker process"""
+        with self._lock:
+            for name in ["requests", "retries", "errors", "bytes_sent", "bytes_received"]:
+                setattr(self, name, getattr(self, name) + summary[name])
+            for name, stats in summary["operations"].items():
+                operation = self._operation(name)
+                operation["calls"] += stats["calls"]
+                operation["seconds"] += stats["seconds"]
+                operation["latency_ms_histogram"] = [a + b for a, b in zip(operation["latency_ms_histogram"], stats["latency_ms_histogram"])]
+
+    def summary(self):
+        """Get all counters as dict"""
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "retries": self.retries,
+                "errors": self.errors,
+                "bytes_sent": self.bytes_sent,
+                "bytes_received": self.bytes_received,
+                "latency_bins_ms": [str(b) for b in LATENCY_BINS_MS],
+                "operations": json.loads(json.dumps(self.operations)),
+            }
+
+# metrics of all clients created by this module
+metrics = TransferMetrics()
+
+# %%
+# event handlers collecting the metrics
+def _content_length(headers):
+    try:
+        return int(headers.get("Content-Length", 0) or 0)
+    except (TypeError, ValueError):
+        return 0
+
+def _on_before_call(context, **kwargs):
+    context["transport_start_time"] = time.perf_counter()
+
+def _on_before_send(request, **kwargs):
+    # called for every http request, including retried attempts
+    metrics.add_request(_content_length(request.headers))
+
+def _on_after_call(http_response, parsed, model, context, **kwargs):
+    seconds = time.perf_counter() - context.get("transport_start_time", time.perf_counter())
+    retries = parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+    metrics.add_call(model.name, seconds, _content_length(http_response.headers), retries, 
+                     error=http_response.status_code >= 400)
+
+def _on_after_call_error(exception, context, event_name, **kwargs):
+    seconds = time.perf_counter() - context.get("transport_start_time", time.perf_counter())
+    # the event name is "after-call-error.s3.<operation>"
+    metrics.add_call(event_name.split(".")[-1], seconds, 0, 0, error=True)
+
+# %%
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_s3_client(endpoint_url, access_key, secret_key, max_pool_connections=50, max_attempts=10, retry_mode="adaptive"):
+    """Get the S3 client of this process for the given endpoint and settings
+
+    The client is created once per process and settings and shared by all threads: boto3
+    clients are thread-safe and all threads draw their connections from the client's pool,
+    which holds max_pool_connections connections. Throttling and 5xx responses are retried
+    with exponential backoff, in adaptive mode the request rate is also reduced while throttled.
+
+    :param endpoint_url: S3 endpoint URL
+    :param access_key: S3 access key
+    :param secret_key: S3 secret access key
+    :param max_pool_connections: Number of connections kept in the pool, should be at least the number of threads
+    :param max_attempts: Maximum number of attempts of a request including retries
+    :param retry_mode: Retry mode of botocore ("adaptive", "standard" or "legacy")
+    :return: S3 client object
+    """
+    # the pid is part of the key, so forked worker processes create their own client
+    key = (os.getpid(), endpoint_url, access_key, max_pool_connections, max_attempts, retry_mode)
+
+    with _clients_lock:
+        if key not in _clients:
+            config = Config(
+                max_pool_connections=max_pool_connections,
+                retries={"total_max_attempts": max_attempts, "mode": retry_mode},
+            )
+            # a separate session per client, as the default boto3 session is not thread-safe
+            session = boto3.session.Session()
+            s3 = session.client(
+                's3',
+                endpoint_url=endpoint_url,
+                aws_access_key_id=access_key,
+                aws_secret_access_key=secret_key,
+                config=config
+            )
+
+            # register the handlers collecting the transfer metrics
+            events = s3.meta.events
+            events.register("before-call.s3", _on_before_call)
+            events.register("before-send.s3", _on_before_send)
+            events.register("after-call.s3", _on_after_call)
+            events.register("after-call-error.s3", _on_after_call_error)
+
+            _clients[key] = s3
+
+        return _clients[key]
+
+# %%
+# methods to access the transfer metrics
+def get_transfer_metrics():
+    """Get the transfer metrics of all S3 calls of this process"""
+    return metrics.summary()
+
+def reset_transfer_metrics():
+    """Reset all transfer metrics to zero"""
+    metrics.reset()
+
+def merge_transfer_metrics(summary):
+    """Add the transfer metrics of another process, given as summary of get_transfer_metrics"""
+    metrics.merge(summary)
+
+def dump_transfer_metrics(path=None):
+    """Print the transfer metrics as json, or write them to a json file if path is given"""
+    summary = get_transfer_metrics()
+    if path is None:
+        print(json.dumps(summary, indent=2), flush=True)
+    else:
+        with open(path, "w") as f:
+            json.dump(summary, f, indent=2)
+    return summary
+
+# %%
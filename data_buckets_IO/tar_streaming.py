@@ -0,0 +1,117 @@
+# methods to upload the members of a tar archive to S3 buckets while reading the archive as a stream
+
+# %%
+import time
+import hashlib
+import logging
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import BotoCoreError, ClientError
+from data_buckets_IO.bulk_upload import load_manifest, _ManifestWriter, MB
+
+GB = 1024 * MB
+
+# %%
+class ByteBudget:
+    """Limit the number of bytes that are buffered at the same time by several threads"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, n_bytes):
+        with self.condition:
+            # a member larger than the budget is only buffered if nothing else is buffered
+            while self.used > 0 and self.used + n_bytes > self.max_bytes:
+                self.condition.wait()
+            self.used += n_bytes
+
+    def release(self, n_bytes):
+        with self.condition:
+            self.used -= n_bytes
+            self.condition.notify_all()
+
+# %%
+def upload_tar_stream(s3, tar_fileobj, bucket, get_object_name, budget=None, max_workers=16,
+                      manifest_path=None, verbose=False):
+    """Upload the members of a tar archive to an S3 bucket without extracting them to disk
+
+    The archive is read sequentially (tarfile stream mode), so it can come directly from a
+    network stream, e.g. the stdout of 'cat' over ssh. The members are buffered in memory
+    until they are uploaded, the size of this buffer is limited by the byte budget.
+
+    :param s3: Initialized S3 client object
+    :param tar_fileobj: File-like object the tar archive is read from
+    :param bucket: Bucket to upload to
+    :param get_object_name: Function returning the S3 object name for a member name, or None to skip the member
+    :param budget: ByteBudget limiting the buffered bytes, can be shared between several archives. Default: 1 GB
+    :param max_workers: Number of members that are uploaded concurrently
+    :param manifest_path: Path to the local manifest of uploaded objects, objects listed there are skipped
+    :param verbose: If True, print each uploaded object name
+    :return: dict with number of uploaded, skipped and failed members, uploaded bytes and runtime in seconds
+    """
+    start_time = time.time()
+    if budget is None:
+        budget = ByteBudget(1 * GB)
+
+    manifest = load_manifest(manifest_path, bucket)
+    manifest_writer = _ManifestWriter(manifest_path, bucket)
+    counts = {"uploaded": 0, "skipped": 0, "failed": 0, "bytes": 0}
+    counts_lock = threading.Lock()
+    futures = {}
+
+    def upload_member(object_name, body):
+        try:
+            s3.put_object(Bucket=bucket, Key=object_name, Body=body)
+        except (ClientError, BotoCoreError) as e:
+            # connection, timeout and exhausted retries raise BotoCoreError, not ClientError
+            logging.error(f"Failed to upload {object_name}: {e}")
+            with counts_lock:
+                counts["failed"] += 1
+            return
+        finally:
+            budget.release(len(body))
+
+        manifest_writer.add(object_name, len(body), hashlib.md5(body).hexdigest())
+        with counts_lock:
+            counts["uploaded"] += 1
+            counts["bytes"] += len(body)
+        if verbose:
+            print("uploaded: ", object_name, flush=True)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor, \
+             tarfile.open(fileobj=tar_fileobj, mode="r|*") as tar:
+
+            # members are read in the order they are stored in the archive
+            for member in tar:
+                if not member.isfile():
+                    continue
+                object_name = get_object_name(member.name)
+                if object_name is None:
+                    continue
+
+                # skip members uploaded in a previous run, the stream moves on to the next member
+                if object_name in manifest and manifest[object_name]["size"] == member.size:
+                    counts["skipped"] += 1
+                    continue
+
+                # wait until the uploads free enough of the buffer, then read the member from the stream
+                budget.acquire(member.size)
+                body = tar.extractfile(member).read()
+                futures[executor.submit(upload_member, object_name, body)] = object_name
+    finally:
+        manifest_writer.close()
+
+    # all other errors of the uploads end up in the futures, count these members as failed as well
+    for future, object_name in futures.items():
+        if future.exception() is not None:
+            logging.error(f"Failed to upload {object_name}: {future.exception()!r}")
+            counts["failed"] += 1
+
+    counts["seconds"] = time.time() - start_time
+    return counts
+
+# %%
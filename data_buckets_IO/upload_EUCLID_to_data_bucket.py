@@ -2,14 +2,15 @@
 
 # %%
 import time
-from glob import glob
 import os
-import shutil
-import tarfile
+import re
+import logging
+from concurrent.futures import ThreadPoolExecutor
 from paramiko import SSHClient
 from scp import SCPClient
 from s3_bucket_credentials import S3_ACCESS_KEY, S3_SECRET_ACCESS_KEY, S3_ENDPOINT_URL
-from data_buckets_read_and_write import Initialize_s3_client, upload_file
+from data_buckets_read_and_write import Initialize_s3_client, dump_transfer_metrics
+from tar_streaming import upload_tar_stream, ByteBudget, GB
 
 def ssh_scp_files(ssh_host, ssh_user, ssh_password, ssh_port, source_volume, destination_volume):
     logging.info("In ssh_scp_files()method, to copy the files to the server")
@@ -24,32 +25,46 @@ def ssh_scp_files(ssh_host, ssh_user, ssh_password, ssh_port, source_volume, des
 #Directory with the data to upload
 years = range(2017, 2025)
 months = range(4, 10)
-days = range(1, 32) #[9, 10, 11]
 path = "/data/EUCLID/all_years_tar_files"
 BUCKET_NAME = "expats-euclid"
-delete_extracted = True
 delete_tar_after_upload = True
 
+# settings of the streaming upload
+max_workers = 32
+max_buffer_bytes = 2 * GB  # maximum size of the members buffered in memory, shared by all years
+n_years_in_transfer = 2  # the transfer of the next year overlaps with the upload of the current year
+manifest_path = f"{path}/upload_manifest.jsonl"
+
 # initialize the S3 client to upload the data to bucket
-s3 = Initialize_s3_client(S3_ENDPOINT_URL, S3_ACCESS_KEY, S3_SECRET_ACCESS_KEY)
+s3 = Initialize_s3_client(S3_ENDPOINT_URL, S3_ACCESS_KEY, S3_SECRET_ACCESS_KEY, 
+                          max_pool_connections=n_years_in_transfer*max_workers)
+budget = ByteBudget(max_buffer_bytes)
 
 # %%
-# Upload the data to the bucket
-start_time = time.time()
-total = 0
-for year in years:
-    print()
-    print("Year: ", year, flush=True)
-
+def get_object_name(member_name, year):
+    """Get the object name of the daily files YYYY/MM/*.nc in the tar archive, None for all other members"""
+    match = re.search(r"(\d{4})/(\d{2})/([^/]+\.nc)$", member_name)
+    if match is None or int(match.group(1)) != year or int(match.group(2)) not in months:
+        return None
+    return f"{year}/{match.group(2)}/{match.group(3)}"
+
+def upload_year(year):
+    """Stream the tar archive of one year and upload its daily files"""
     remote_tar_file = f'/net/merisi/pbigalke/data/EUCLID/all_years_tar_files/{year}.tar'
     year_tar_file = f"{path}/{year}.tar"
 
     if os.path.exists(year_tar_file):
-        print(year_tar_file, "already exists.")
+        print(year_tar_file, "already exists.", flush=True)
+        with open(year_tar_file, "rb") as f:
+            summary = upload_tar_stream(s3, f, BUCKET_NAME, lambda name: get_object_name(name, year), 
+                                        budget=budget, max_workers=max_workers, manifest_path=manifest_path)
+
+        if delete_tar_after_upload and summary["failed"] == 0:
+            print("deleting", year_tar_file, flush=True)
+            os.remove(year_tar_file)
 
     else:
-        print("copying file from institute server:", remote_tar_file, flush=True)
-        # copy with scp the respective .tar file from
+        print("streaming file from institute server:", remote_tar_file, flush=True)
         ssh = SSHClient()
         ssh.load_system_host_keys()
         ssh.connect(hostname='ostro.meteo.uni-koeln.de',
@@ -57,58 +72,38 @@ for year in years:
                     password='nlePwVg,4amPinu',
                     look_for_keys=False)
 
-        # SCPCLient takes a paramiko transport as its only argument
-        scp = SCPClient(ssh.get_transport())
-        scp.get(remote_tar_file, year_tar_file)
-        scp.close()
-
-     # define year path
-    year_path = year_tar_file.replace(".tar", "")
+        # read the archive from the stdout of cat instead of copying it to disk first
+        _, stdout, stderr = ssh.exec_command(f"cat {remote_tar_file}")
+        try:
+            summary = upload_tar_stream(s3, stdout, BUCKET_NAME, lambda name: get_object_name(name, year), 
+                                        budget=budget, max_workers=max_workers, manifest_path=manifest_path)
+            # a stream cut off between two members ends like a complete archive, so check that cat succeeded
+            exit_status = stdout.channel.recv_exit_status()
+            if exit_status != 0:
+                raise IOError(f"Streaming {remote_tar_file} failed with exit status {exit_status}: {stderr.read().decode().strip()}")
+        finally:
+            ssh.close()
+
+    print("Year: ", year, " files uploaded: ", summary["uploaded"], " skipped: ", summary["skipped"], 
+          " failed: ", summary["failed"], f" ({summary['bytes']/GB:.2f} GB in {summary['seconds']/60:.2f} minutes)", flush=True)
+    return summary
 
-    # unpack year folder if not already exists
-    if not os.path.exists(year_path):
-        print("unpacking", year_tar_file, flush=True)
-        # Extract all subfolders to the specified directory
-        with tarfile.open(year_tar_file, "r") as tar:
-            tar.extractall(path=year_path)
-    else:
-        print("already unpacked", year_tar_file, flush=True)
-
-    year_total = 0
-    # loop over months
-    for month in months:
-        
-        # get all daily files
-        day_files = sorted(glob(f"{year_path}/{year}/{month:02d}/*.nc"))
-    
-        # loop over files and upload to bucket
-        if len(day_files) > 0:
-                
-            for file in day_files:
-                #Uploading a file to the bucket (make sure you have write access)
-                object_name = f"{year}/{month:02d}/{os.path.basename(file)}"
-                # Open file in binary mode and upload
-                upload_file(s3, file, BUCKET_NAME, object_name=object_name)
-
-        print("- month: ", month, " files found: ", len(day_files), flush=True)	
-        year_total += len(day_files)
-
-    print("Year: ", year, " files found: ", year_total, flush=True)	
-    total += year_total
-
-    # delete extracted year folder
-    if delete_extracted:
-        print(f"deleting", year_path, flush=True)
-        shutil.rmtree(year_path)
-
-    if delete_tar_after_upload:
-        print("deleting", year_tar_file, flush=True)
-        os.remove(year_tar_file)
+# %%
+# Upload the data to the bucket
+start_time = time.time()
 
+# several years are in transfer at the same time, all of them share the buffer budget
+with ThreadPoolExecutor(max_workers=n_years_in_transfer) as executor:
+    summaries = list(executor.map(upload_year, years))
 
+total = sum(summary["uploaded"] for summary in summaries)
 print("Total files uploaded: ", total, flush=True)
 t = time.time() - start_time
-print("Time taken to extract and upload files: ", f"{t/3600:.2f} hours or {t/60:.2f} minutes.", flush=True)# %%
+print("Time taken to stream and upload files: ", f"{t/3600:.2f} hours or {t/60:.2f} minutes.", flush=True)
+
+# print number of requests, bytes, retries and latencies of the S3 calls
+dump_transfer_metrics()
+# %%
 
 
 # %%
@@ -0,0 +1,111 @@
+# benchmark of the encoding profiles of the crop files: bytes per sample, write and read time and error of the stored values
+
+# %%
+import os
+import sys
+import json
+import time
+import tempfile
+import numpy as np
+import pandas as pd
+import xarray as xr
+from scipy.ndimage import gaussian_filter
+sys.path.append('..')
+from helpers.crop_encoding import ENCODING_PROFILES, save_crop
+
+# %%
+def get_synthetic_crops(n_samples=50, n_frames=8, cropsize=100, seed=0):
+    """Get crops with spatially smooth brightness temperatures and cloud mask, similar to the MSG timeseries crops
+    :param n_samples: Number of crops
+    :param n_frames: Number of timestamps of each crop
+    :param cropsize: Size of the crops
+    :param seed: Seed of the random fields
+    :return: List of xarray datasets
+    """
+    rng = np.random.default_rng(seed)
+    crops = []
+    for i in range(n_samples):
+        times = pd.Timestamp("2015-04-01") + pd.to_timedelta(15 * (np.arange(n_frames) + i * n_frames), "min")
+        field = gaussian_filter(rng.normal(size=(n_frames, cropsize, cropsize)), sigma=(1, 4, 4))
+        field = field / field.std()
+        ir_108 = (255 + 15 * field).astype(np.float32)
+        wv_062 = (235 + 8 * field + rng.normal(scale=0.5, size=field.shape)).astype(np.float32)
+        cma = (field < 0.3).astype(np.float32)
+        crop = xr.Dataset({"IR_108": (("time", "lat", "lon"), ir_108), "WV_062": (("time", "lat", "lon"), wv_062),
+                           "cma": (("time", "lat", "lon"), cma)},
+                          coords={"time": times.values, "lat": 45 + 0.04 * np.arange(cropsize), "lon": 8 + 0.04 * np.arange(cropsize)})
+        crop["IR_108_cm"] = crop.IR_108.where(crop.cma == 1, 300)
+        crops.append(crop)
+    return crops
+
+def read_crops(crop_files):
+    """Read crop files into memory, e.g. to benchmark the profiles with real crops"""
+    crops = []
+    for crop_file in crop_files:
+        with xr.open_dataset(crop_file) as crop:
+            crops.append(crop.load())
+    return crops
+
+# %%
+def benchmark_profile(crops, profile, tmp_dir, vmin=200, vmax=300):
+    """Write and read all crops with one encoding profile
+    :return: dict with bytes per sample, write and read time per sample in ms and the maximum absolute error of the values
+    """
+    files = [f"{tmp_dir}/{profile}_{i}.nc" for i in range(len(crops))]
+
+    start_time = time.perf_counter()
+    for crop, crop_file in zip(crops, files):
+        save_crop(crop, crop_file, profile=profile, vmin=vmin, vmax=vmax)
+    write_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    read = read_crops(files)
+    read_time = time.perf_counter() - start_time
+
+    max_error = max(float(np.nanmax(np.abs(r[var].values - crop[var].values))) for crop, r in zip(crops, read) for var in crop.data_vars)
+    n_bytes = sum(os.path.getsize(crop_file) for crop_file in files)
+    return {
+        "profile": profile,
+        "samples": len(crops),
+        "bytes_per_sample": n_bytes / len(crops),
+        "write_ms_per_sample": write_time / len(crops) * 1000,
+        "read_ms_per_sample": read_time / len(crops) * 1000,
+        "max_abs_error": max_error,
+    }
+
+def run_benchmarks(crop_files=None, n_samples=50, profiles=ENCODING_PROFILES, vmin=200, vmax=300, output_file=None):
+    """Run the benchmark for all profiles, with the given crop files or synthetic crops
+    :param crop_files: Crop files to benchmark with. If None, synthetic crops are used
+    :param n_samples: Number of synthetic crops
+    :param profiles: Encoding profiles to compare
+    :param vmin: Lower brightness temperature of the compact profile
+    :param vmax: Upper brightness temperature of the compact profile
+    :param output_file: json file to save the results to
+    :return: List of dicts with the results
+    """
+    crops = read_crops(crop_files) if crop_files is not None else get_synthetic_crops(n_samples)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for profile in profiles:
+            results.append(benchmark_profile(crops, profile, tmp_dir, vmin=vmin, vmax=vmax))
+
+    print_results(results)
+    if output_file is not None:
+        with open(output_file, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+def print_results(results):
+    print(f"{'profile':<10}{'samples':>9}{'kB/sample':>11}{'ratio':>8}{'write ms':>10}{'read ms':>9}{'max error':>11}")
+    reference = results[0]["bytes_per_sample"]
+    for r in results:
+        print(f"{r['profile']:<10}{r['samples']:>9}{r['bytes_per_sample']/1024:>11.1f}{reference/r['bytes_per_sample']:>8.2f}" + \
+              f"{r['write_ms_per_sample']:>10.2f}{r['read_ms_per_sample']:>9.2f}{r['max_abs_error']:>11.4f}", flush=True)
+
+# %%
+if __name__ == "__main__":
+    # crops of the timeseries dataset to compare the profiles with, synthetic crops if None
+    crop_files = None
+    run_benchmarks(crop_files=crop_files, n_samples=50, output_file="benchmark_crop_encoding.json")
+
+# %%
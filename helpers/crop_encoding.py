@@ -0,0 +1,78 @@
+import numpy as np
+
+# named encodings of the crop files written with to_netcdf
+#   default: encoding of xarray (or inherited from the source files)
+#   fast:    no compression, one chunk per variable
+#   archive: zlib with shuffle, lossless
+#   compact: brightness temperatures as int16 with scale and offset, cloud mask as int8, zlib with shuffle
+ENCODING_PROFILES = ["default", "fast", "archive", "compact"]
+
+# timestamps of MSG are full minutes, int32 minutes cover the years until 6053
+TIME_ENCODING = {"units": "minutes since 1970-01-01 00:00:00", "dtype": "int32"}
+
+def is_brightness_temperature(var):
+    """Check if a variable of the MSG crops is a brightness temperature in K (thermal channels and masked IR_108)"""
+    return var.startswith(("IR_", "WV_")) and not var.startswith("IR_016")
+
+def get_int16_scaling(vmin, vmax):
+    """Get scale_factor and add_offset of the int16 brightness temperatures, centered between vmin and vmax
+    The resolution is (vmax - vmin) / 30000, so values about half the range below vmin and above vmax are kept as well.
+    """
+    # float32 scaling, so the values are decoded as float32
+    return np.float32((vmax - vmin) / 30000.), np.float32((vmax + vmin) / 2.)
+
+def get_int16_range(vmin, vmax):
+    """Get the range of brightness temperatures that can be stored as int16, see get_int16_scaling"""
+    scale_factor, add_offset = get_int16_scaling(vmin, vmax)
+    return float(add_offset - np.iinfo(np.int16).max * scale_factor), float(add_offset + np.iinfo(np.int16).max * scale_factor)
+
+def get_encoding(ds, profile="default", vmin=200, vmax=300, complevel=4):
+    """Get the encoding of a crop dataset for to_netcdf
+
+    Args:
+        ds (xr.Dataset): crop dataset
+        profile (str, optional): one of ENCODING_PROFILES. Defaults to "default".
+        vmin (float, optional): lower brightness temperature of the int16 range of the compact profile. Defaults to 200.
+        vmax (float, optional): upper brightness temperature of the int16 range of the compact profile. Defaults to 300.
+        complevel (int, optional): zlib compression level of the archive and compact profiles. Defaults to 4.
+
+    Returns:
+        dict: encoding per variable
+    """
+    if profile not in ENCODING_PROFILES:
+        raise ValueError(f"Unknown encoding profile {profile}, use one of {ENCODING_PROFILES}")
+    if profile == "default":
+        return {}
+
+    encoding = {}
+    for var in ds.data_vars:
+        if profile == "fast":
+            encoding[var] = {"zlib": False, "chunksizes": ds[var].shape} if ds[var].ndim > 0 else {}
+            continue
+
+        encoding[var] = {"zlib": True, "complevel": complevel, "shuffle": True}
+        if profile == "compact" and is_brightness_temperature(var):
+            scale_factor, add_offset = get_int16_scaling(vmin, vmax)
+            encoding[var].update({"dtype": "int16", "scale_factor": scale_factor, "add_offset": add_offset,
+                                  "_FillValue": np.iinfo(np.int16).min})
+        elif profile == "compact" and var == "cma":
+            encoding[var].update({"dtype": "int8", "_FillValue": -1})
+
+    if "time" in ds.coords:
+        encoding["time"] = dict(TIME_ENCODING)
+    return encoding
+
+def save_crop(ds, filepath, profile="default", vmin=200, vmax=300):
+    """Save a crop dataset as netcdf with the given encoding profile, see get_encoding"""
+    if profile != "default":
+        # the encoding inherited from the source files (e.g. chunks of the whole domain) is replaced
+        ds = ds.copy()
+        for var in ds.variables:
+            ds[var].encoding = {}
+    if profile == "compact":
+        # values outside of the int16 range would overflow
+        low, high = get_int16_range(vmin, vmax)
+        for var in ds.data_vars:
+            if is_brightness_temperature(var):
+                ds[var] = ds[var].clip(low, high)
+    ds.to_netcdf(filepath, mode='w', encoding=get_encoding(ds, profile, vmin=vmin, vmax=vmax))
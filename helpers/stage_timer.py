@@ -0,0 +1,83 @@
+# timers and counters of the stages of a processing pipeline, with a summary as json
+
+# %%
+import json
+import time
+import threading
+import contextlib
+
+# %%
+class StageTimer:
+    """Thread-safe accumulated time and number of calls per stage, and counters
+
+    The stages can also run in background threads (e.g. downloading the next files), their time
+    then overlaps with the other stages. Summaries of timers of other processes are added with merge.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.stages = {}
+            self.counters = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time the enclosed block as stage name"""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start_time)
+
+    def add_time(self, name, seconds, calls=1):
+        with self._lock:
+            stage = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0})
+            stage["calls"] += calls
+            stage["seconds"] += seconds
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    def merge(self, summary):
+        """Add the stages and counters of a summary, e.g. of a timer of another process"""
+        for name, stage in summary["stages"].items():
+            self.add_time(name, stage["seconds"], stage["calls"])
+        for name, n in summary["counters"].items():
+            self.count(name, n)
+
+    def summary(self):
+        """Get the stages and counters as dict"""
+        with self._lock:
+            return {"stages": {name: dict(stage) for name, stage in self.stages.items()}, "counters": dict(self.counters)}
+
+    def pop(self):
+        """Get the summary and reset the timer"""
+        with self._lock:
+            summary = {"stages": self.stages, "counters": self.counters}
+            self.stages, self.counters = {}, {}
+        return summary
+
+    def __str__(self):
+        return format_summary(self.summary())
+
+# %%
+def format_summary(summary):
+    """Format a summary of a StageTimer as a single line"""
+    stages = ", ".join(f"{name} {stage['seconds']:.2f}s" for name, stage in summary["stages"].items())
+    counters = ", ".join(f"{name} {n}" for name, n in summary["counters"].items())
+    return f"{stages} | {counters}"
+
+def dump_summary(summary, path=None):
+    """Print a summary as json, or write it to a json file if path is given"""
+    if path is None:
+        print(json.dumps(summary, indent=2), flush=True)
+    else:
+        with open(path, "w") as f:
+            json.dump(summary, f, indent=2)
+    return summary
+
+# %%
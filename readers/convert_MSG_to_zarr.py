@@ -0,0 +1,139 @@
+"""
+convert the daily MSG NetCDF files into chunked Zarr stores, tiled in time and space for reading small windows
+
+usage:
+    python convert_MSG_to_zarr.py INPUT_DIR OUTPUT_DIR [--workers 8] [--chunk-time 4] [--chunk-space 128]
+
+Every daily file INPUT_DIR/<subpath>.nc is converted into the store OUTPUT_DIR/<subpath>.zarr.
+Stores are written to a temporary directory and renamed when complete, so an interrupted
+conversion can be restarted and only converts the days that are missing.
+"""
+# %%
+import os
+import sys
+import glob
+import time
+import shutil
+import argparse
+import numpy as np
+import xarray as xr
+from concurrent.futures import ProcessPoolExecutor, as_completed
+sys.path.append('..')
+# the variable flagging timestamps without any data, so missing timestamps are found without reading the channels
+from readers.read_MSG import MISSING_VARIABLE
+
+# %%
+def get_zarr_store(nc_file, input_dir, output_dir):
+    """Get the path of the Zarr store of a daily NetCDF file, mirroring the folder structure of the input"""
+    relative_path = os.path.relpath(nc_file, input_dir)
+    return os.path.join(output_dir, os.path.splitext(relative_path)[0] + ".zarr")
+
+def convert_day(nc_file, zarr_store, chunk_time=4, chunk_space=128, channels=None, dtype="float32",
+                reference_channel="IR_108", overwrite=False):
+    """Convert one daily NetCDF file into a chunked Zarr store
+
+    Args:
+        nc_file (pathlike): daily NetCDF file
+        zarr_store (pathlike): path of the Zarr store
+        chunk_time (int, optional): number of timestamps per chunk. Defaults to 4.
+        chunk_space (int, optional): number of pixels per chunk in lat and lon. Defaults to 128.
+        channels (list(str), optional): data variables to convert. Defaults to None (all).
+        dtype (str, optional): dtype of the floating point variables, None keeps the dtype of the file. Defaults to "float32".
+        reference_channel (str, optional): channel used to flag missing timestamps. Defaults to "IR_108".
+        overwrite (bool, optional): convert the day again if the store exists. Defaults to False.
+
+    Returns:
+        str: "converted" or "skipped"
+    """
+    if os.path.exists(zarr_store) and not overwrite:
+        return "skipped"
+
+    # write to a temporary store that is renamed when complete
+    tmp_store = f"{zarr_store}.tmp"
+    shutil.rmtree(tmp_store, ignore_errors=True)
+    os.makedirs(os.path.dirname(os.path.abspath(zarr_store)), exist_ok=True)
+
+    with xr.open_dataset(nc_file) as dataset:
+        if channels is not None:
+            dataset = dataset[[var for var in dataset.data_vars if var in channels]]
+        dataset = dataset.load()
+
+    # cast the channels and flag the timestamps without data
+    for var in dataset.data_vars:
+        if dtype is not None and np.issubdtype(dataset[var].dtype, np.floating):
+            dataset[var] = dataset[var].astype(dtype)
+    if reference_channel in dataset.data_vars:
+        dataset[MISSING_VARIABLE] = dataset[reference_channel].isnull().all(dim=["lat", "lon"])
+
+    # chunks tiled in time and space, the encoding of the NetCDF file does not apply to Zarr
+    chunk_sizes = {"time": chunk_time, "lat": chunk_space, "lon": chunk_space}
+    encoding = {}
+    for var in dataset.variables:
+        dataset[var].encoding = {}
+        if var in dataset.data_vars:
+            encoding[var] = {"chunks": tuple(min(chunk_sizes.get(dim, size), size)
+                                             for dim, size in zip(dataset[var].dims, dataset[var].shape))}
+
+    dataset.to_zarr(tmp_store, mode="w", encoding=encoding, consolidated=True)
+
+    if os.path.exists(zarr_store):
+        shutil.rmtree(zarr_store)
+    os.replace(tmp_store, zarr_store)
+    return "converted"
+
+# %%
+def convert_archive(input_dir, output_dir, pattern="*/*/*.nc", workers=8, **kwargs):
+    """Convert all daily NetCDF files of an archive in parallel, skipping the days that are already converted
+
+    Args:
+        input_dir (pathlike): directory of the daily NetCDF files
+        output_dir (pathlike): directory of the Zarr stores
+        pattern (str, optional): glob pattern of the daily files below input_dir. Defaults to "*/*/*.nc" (year/month/file).
+        workers (int, optional): number of days converted in parallel processes. Defaults to 8.
+        **kwargs: arguments passed to convert_day
+
+    Returns:
+        dict: number of converted, skipped and failed days
+    """
+    nc_files = sorted(glob.glob(os.path.join(input_dir, pattern)))
+    counts = {"converted": 0, "skipped": 0, "failed": 0}
+    start_time = time.time()
+    print(f"converting {len(nc_files)} daily files from {input_dir} to {output_dir}", flush=True)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(convert_day, nc_file, get_zarr_store(nc_file, input_dir, output_dir), **kwargs): nc_file
+                   for nc_file in nc_files}
+
+        for future in as_completed(futures):
+            try:
+                counts[future.result()] += 1
+            except Exception as e:
+                print(f"Failed to convert {futures[future]}: {e}", flush=True)
+                counts["failed"] += 1
+                continue
+            if (counts["converted"] + counts["skipped"]) % 50 == 0:
+                print(f"{counts} after {(time.time()-start_time)/60:.1f} minutes", flush=True)
+
+    print(f"{counts} in {(time.time()-start_time)/60:.1f} minutes", flush=True)
+    return counts
+
+# %%
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert daily MSG NetCDF files into chunked Zarr stores")
+    parser.add_argument("input_dir", help="directory of the daily NetCDF files")
+    parser.add_argument("output_dir", help="directory of the Zarr stores")
+    parser.add_argument("--pattern", default="*/*/*.nc", help="glob pattern of the daily files below input_dir")
+    parser.add_argument("--workers", type=int, default=8, help="number of days converted in parallel")
+    parser.add_argument("--chunk-time", type=int, default=4, help="number of timestamps per chunk")
+    parser.add_argument("--chunk-space", type=int, default=128, help="number of pixels per chunk in lat and lon")
+    parser.add_argument("--channels", nargs="+", default=None, help="data variables to convert (default: all)")
+    parser.add_argument("--dtype", default="float32", help="dtype of the floating point variables")
+    parser.add_argument("--overwrite", action="store_true", help="convert days again that are already converted")
+    args = parser.parse_args()
+
+    counts = convert_archive(args.input_dir, args.output_dir, pattern=args.pattern, workers=args.workers,
+                             chunk_time=args.chunk_time, chunk_space=args.chunk_space, channels=args.channels,
+                             dtype=args.dtype, overwrite=args.overwrite)
+    sys.exit(1 if counts["failed"] > 0 else 0)
+
+# %%
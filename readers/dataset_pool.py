@@ -0,0 +1,86 @@
+"""
+pool of open datasets, so files that are read many times are opened only once
+
+"""
+# %%
+import threading
+import collections
+import xarray as xr
+
+# %%
+class DatasetPool:
+    """Keep the most recently used datasets open and close the ones that are evicted
+
+    Datasets are keyed by file path and open arguments. A dataset returned by the pool
+    stays valid until it is evicted, i.e. until max_open other files were opened since
+    it was last used, or until the pool is closed.
+    """
+
+    def __init__(self, max_open=4):
+        """
+        Args:
+            max_open (int, optional): maximum number of datasets that are kept open. Defaults to 4.
+        """
+        self.max_open = max_open
+        self.hits = 0
+        self.misses = 0
+        self._datasets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def open(self, path, **kwargs):
+        """Get the open dataset of a file, opening it only if it is not in the pool
+
+        Args:
+            path (pathlike): path to the file
+            **kwargs: arguments passed to xr.open_dataset, e.g. drop_variables or engine
+
+        Returns:
+            xr.Dataset: open dataset
+        """
+        key = (str(path), _freeze(kwargs))
+        with self._lock:
+            if key in self._datasets:
+                self.hits += 1
+                self._datasets.move_to_end(key)
+                return self._datasets[key]
+            self.misses += 1
+
+        # open outside of the lock, so other threads can use the pool meanwhile
+        dataset = xr.open_dataset(path, **kwargs)
+
+        with self._lock:
+            if key in self._datasets:
+                # opened by another thread in the meantime
+                dataset.close()
+                return self._datasets[key]
+            self._datasets[key] = dataset
+
+            # close the least recently used datasets
+            while len(self._datasets) > self.max_open:
+                _, evicted = self._datasets.popitem(last=False)
+                evicted.close()
+        return dataset
+
+    def close(self):
+        """Close all datasets of the pool"""
+        with self._lock:
+            for dataset in self._datasets.values():
+                dataset.close()
+            self._datasets.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def stats(self):
+        """Get number of hits and misses and the number of open datasets"""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "open": len(self._datasets)}
+
+def _freeze(kwargs):
+    """Make the open arguments hashable"""
+    return tuple(sorted((name, tuple(value) if isinstance(value, list) else value) for name, value in kwargs.items()))
+
+# %%
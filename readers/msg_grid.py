@@ -0,0 +1,155 @@
+"""
+regular lon/lat grid of the MSG files with index lookup of points and crops
+
+"""
+# %%
+import os
+import threading
+import numpy as np
+import xarray as xr
+
+# the coordinates are cached in the cache directory of the user, outside of the repository
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "msg_grid")
+GRID_CACHE_FILE = os.path.join(CACHE_DIR, "msg_grid_coords.npz")
+
+# %%
+class MSGGrid:
+    """Longitudes and latitudes of the MSG grid with vectorized lookup of grid indices
+
+    On a regular grid the index of a point is computed arithmetically from the origin and
+    spacing of the grid, otherwise the coordinates are searched. In both cases the closest
+    grid point is returned, on ties the lower index.
+    """
+
+    def __init__(self, lon, lat):
+        """
+        Args:
+            lon (np.array(float)): ascending longitude values of the grid
+            lat (np.array(float)): ascending latitude values of the grid
+        """
+        self.lon = np.asarray(lon)
+        self.lat = np.asarray(lat)
+        self.shape = (len(self.lat), len(self.lon))
+        self._lon_axis = _Axis(self.lon)
+        self._lat_axis = _Axis(self.lat)
+
+    @classmethod
+    def from_file(cls, msg_file):
+        """Read the grid from the coordinates of a MSG file"""
+        # the data variables are opened lazily and not read
+        with xr.open_dataset(msg_file) as dataset:
+            return cls(dataset.lon.values, dataset.lat.values)
+
+    @classmethod
+    def from_dataset(cls, dataset):
+        """Get the grid of an opened dataset on the MSG grid (e.g. regridded MWCC-H data)"""
+        return cls(dataset.lon.values, dataset.lat.values)
+
+    def save(self, cache_file=GRID_CACHE_FILE):
+        """Save the coordinates to a npz file"""
+        # write to a temporary file first, so other processes never read a partial file
+        os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_file, lon=self.lon, lat=self.lat)
+        os.replace(tmp_file, cache_file)
+
+    @classmethod
+    def load(cls, cache_file=GRID_CACHE_FILE):
+        """Load the coordinates from a npz file"""
+        with np.load(cache_file) as coords:
+            return cls(coords["lon"], coords["lat"])
+
+    # %%
+    def points_to_indices(self, lon, lat):
+        """Get the indices of the grid points closest to the given points
+
+        Args:
+            lon (float or array-like): longitudes of the points
+            lat (float or array-like): latitudes of the points
+
+        Returns:
+            np.array(int), np.array(int): lon and lat indices of the points (scalars for scalar input)
+        """
+        return self._lon_axis.indices(lon), self._lat_axis.indices(lat)
+
+    def crop_indices(self, center_lon, center_lat, cropsize):
+        """Get the index ranges of crops around the given centers, shifted away from the edges to fit into the grid
+
+        Args:
+            center_lon (float or array-like): longitudes of the crop centers
+            center_lat (float or array-like): latitudes of the crop centers
+            cropsize (int): number of pixels of the crops in lon and lat
+
+        Returns:
+            np.array(int), np.array(int): start indices of the crops along lon and lat, the crops end at start + cropsize
+        """
+        idx_lon_c, idx_lat_c = self.points_to_indices(center_lon, center_lat)
+        lon_start = _crop_start(idx_lon_c, len(self.lon), cropsize)
+        lat_start = _crop_start(idx_lat_c, len(self.lat), cropsize)
+        return lon_start, lat_start
+
+    def crop_isel(self, center_lon, center_lat, cropsize):
+        """Get the isel indexers of a single crop around the given center"""
+        lon_start, lat_start = self.crop_indices(center_lon, center_lat, cropsize)
+        return {"lon": slice(int(lon_start), int(lon_start) + int(cropsize)),
+                "lat": slice(int(lat_start), int(lat_start) + int(cropsize))}
+
+class _Axis:
+    """Lookup of indices along one coordinate axis"""
+
+    def __init__(self, values):
+        self.values = values
+        self.n = len(values)
+        self.start = values[0]
+        self.step = (values[-1] - values[0]) / (self.n - 1) if self.n > 1 else 1.0
+        # the grid is regular if all steps are equal up to the precision of the stored coordinates
+        self.regular = self.n > 1 and np.allclose(np.diff(values), self.step, rtol=0, atol=abs(self.step) * 1e-3)
+
+    def indices(self, points):
+        points = np.asarray(points, dtype=np.float64)
+        if self.regular:
+            # closest index, ties to the lower index
+            idx = np.ceil((points - self.start) / self.step - 0.5).astype(int)
+            return np.clip(idx, 0, self.n - 1)
+
+        # irregular axis: closest of the two neighbours found by searchsorted
+        idx = np.clip(np.searchsorted(self.values, points), 1, self.n - 1)
+        lower_closer = (points - self.values[idx - 1]) <= (self.values[idx] - points)
+        return np.where(lower_closer, idx - 1, idx)
+
+def _crop_start(idx_center, n, cropsize):
+    """Start index of crops around the centers, shifted away from the edges to fit the whole crop"""
+    padding = cropsize / 2.
+    idx_center = np.clip(idx_center, int(padding), int(n - 1 - padding))
+    return idx_center - int(padding)
+
+# %%
+_grid = None
+_grid_lock = threading.Lock()
+
+def get_msg_grid(msg_file=None, cache_file=GRID_CACHE_FILE):
+    """Get the MSG grid of this process, loaded once from the coordinate cache
+
+    If the cache file does not exist yet, the coordinates are read from msg_file and cached.
+
+    Args:
+        msg_file (pathlike, optional): MSG file to read the grid from if not cached. Defaults to None (example file in MSG_PATH).
+        cache_file (pathlike, optional): npz file caching the coordinates. Defaults to GRID_CACHE_FILE.
+
+    Returns:
+        MSGGrid: grid of the MSG files
+    """
+    global _grid
+    with _grid_lock:
+        if _grid is None:
+            if os.path.exists(cache_file):
+                _grid = MSGGrid.load(cache_file)
+            else:
+                if msg_file is None:
+                    from readers.read_MSG import MSG_PATH
+                    msg_file = f"{MSG_PATH}/2023/09/20230930-EXPATS-RG.nc"
+                _grid = MSGGrid.from_file(msg_file)
+                _grid.save(cache_file)
+        return _grid
+
+# %%
@@ -1,30 +1,137 @@
 # %%
 import xarray as xr
+import numpy as np
 import os
 import sys
 sys.path.append('..')
 import helpers.datetime_helper as hlp
+from readers.msg_grid import get_msg_grid
 
 MSG_PATH = "/data/sat/msg/netcdf/parallax"
+# daily files of MSG_PATH converted to chunked Zarr stores, see readers/convert_MSG_to_zarr.py
+MSG_ZARR_PATH = "/data/sat/msg/zarr/parallax"
+
+# variable of the Zarr stores flagging timestamps without data
+MISSING_VARIABLE = "missing_timestamp"
 
 CHANNELS = ["IR_016", "IR_039", "IR_087", "IR_097", "IR_108", "IR_120", "IR_134",
             "VIS006", "VIS008", "WV_062", "WV_073"]
 
 # %%
-def read(msg_file, channels=None):
+def read(msg_file, channels=None, pool=None):
     """Read MSG file and return xarray dataset
 
     Args:
         msg_file (pathlike): path to MSG file
         channels (list(str), optional): list of channel names that should be read in. Defaults to None.
+        pool (DatasetPool, optional): pool of open datasets, the file is only opened if it is not in the pool. Defaults to None.
 
     Returns:
         xr.dataset: xarray dataset containing MSG data
     """
     drop = [ch for ch in CHANNELS if ch not in channels] if channels is not None else None
-    with xr.open_dataset(msg_file, drop_variables=drop) as dataset:
+    if pool is not None:
+        return pool.open(msg_file, drop_variables=drop, **_open_kwargs(msg_file))
+    with xr.open_dataset(msg_file, drop_variables=drop, **_open_kwargs(msg_file)) as dataset:
         return dataset
 
+def open_lazy(msg_file, channels=None):
+    """Open MSG file or Zarr store lazily, the data is only read when accessed and the caller closes the dataset
+
+    Args:
+        msg_file (pathlike): path to MSG file or Zarr store
+        channels (list(str), optional): list of channel names that should be read in. Defaults to None.
+
+    Returns:
+        xr.dataset: lazily opened xarray dataset
+    """
+    drop = [ch for ch in CHANNELS if ch not in channels] if channels is not None else None
+    return xr.open_dataset(msg_file, drop_variables=drop, **_open_kwargs(msg_file))
+
+def _open_kwargs(msg_file):
+    """Get the backend arguments to open a NetCDF file or a Zarr store"""
+    if str(msg_file).rstrip("/").endswith(".zarr"):
+        # without dask, the lazily opened store reads only the chunks that overlap the selection
+        return {"engine": "zarr", "chunks": None, "consolidated": True}
+    return {}
+
+def read_window(msg_source, times=None, lon_range=None, lat_range=None, lon_idx=None, lat_idx=None, 
+                channels=None, dtype=np.float32, pool=None, backend="netcdf"):
+    """Read only a window of MSG data: selected timestamps, a lon/lat box and channels
+
+    The window is selected with integer indices on the lazily opened file, so only this part
+    is read and decoded from the NetCDF/HDF5 file, never the full domain of the day.
+    From the chunked Zarr stores, only the chunks overlapping the window are read.
+
+    Args:
+        msg_source (pathlike, np.datetime64 or xr.Dataset): MSG file or Zarr store, a timestamp of the day to read or an opened dataset
+        times (array-like or slice, optional): timestamps to read, or slice(start, end) of timestamps. Defaults to None (all).
+        lon_range (tuple(float), optional): (min, max) longitude of the window, inclusive. Defaults to None.
+        lat_range (tuple(float), optional): (min, max) latitude of the window, inclusive. Defaults to None.
+        lon_idx (tuple(int) or slice, optional): (start, stop) index range of the window along lon, used instead of lon_range. Defaults to None.
+        lat_idx (tuple(int) or slice, optional): (start, stop) index range of the window along lat, used instead of lat_range. Defaults to None.
+        channels (list(str), optional): channels to read, other data variables (e.g. the cloud mask) are kept. Defaults to None (all).
+        dtype (np.dtype, optional): dtype of the floating point variables, None keeps the dtype of the file. Defaults to np.float32.
+        pool (DatasetPool, optional): pool of open datasets, the file is only opened if it is not in the pool. Defaults to None.
+        backend (str, optional): "netcdf" or "zarr", archive the file of a timestamp is taken from. Defaults to "netcdf".
+
+    Returns:
+        xr.dataset: xarray dataset containing the loaded window of MSG data
+    """
+    if isinstance(msg_source, xr.Dataset):
+        dataset, close = msg_source, False
+    else:
+        if isinstance(msg_source, (np.datetime64, np.ndarray)):
+            msg_source = get_MSG_file_from_timestamp(msg_source, backend=backend)
+        drop = [ch for ch in CHANNELS if ch not in channels] if channels is not None else None
+        if pool is not None:
+            dataset, close = pool.open(msg_source, drop_variables=drop, **_open_kwargs(msg_source)), False
+        else:
+            dataset, close = xr.open_dataset(msg_source, drop_variables=drop, **_open_kwargs(msg_source)), True
+
+    try:
+        # integer indices of the window, computed from the coordinates only
+        indexers = {}
+        if times is not None:
+            time_values = dataset.time.values
+            if isinstance(times, slice):
+                selected = (time_values >= np.datetime64(times.start)) & (time_values <= np.datetime64(times.stop))
+            else:
+                selected = np.isin(time_values, np.asarray(times, dtype=time_values.dtype))
+            indexers["time"] = np.flatnonzero(selected)
+        indexers.update(_window_indexer(dataset, "lon", lon_range, lon_idx))
+        indexers.update(_window_indexer(dataset, "lat", lat_range, lat_idx))
+
+        # the indexing is applied lazily, only the window is read when loading
+        window = dataset.isel(indexers)
+        if channels is not None:
+            window = window.drop_vars([ch for ch in CHANNELS if ch in window.data_vars and ch not in channels])
+        # the flag of missing timestamps of the Zarr stores is not part of the MSG data
+        window = window.drop_vars(MISSING_VARIABLE, errors="ignore")
+        window = window.load()
+    finally:
+        if close:
+            dataset.close()
+
+    if dtype is not None:
+        for var in window.data_vars:
+            if np.issubdtype(window[var].dtype, np.floating):
+                window[var] = window[var].astype(dtype)
+    return window
+
+def _window_indexer(dataset, dim, value_range, idx_range):
+    """Get the slice of indices along lon or lat for a value range or an index range"""
+    if isinstance(idx_range, slice):
+        return {dim: idx_range}
+    if idx_range is not None:
+        return {dim: slice(int(idx_range[0]), int(idx_range[1]))}
+    if value_range is None:
+        return {}
+    inside = np.flatnonzero((dataset[dim].values >= value_range[0]) & (dataset[dim].values <= value_range[1]))
+    if len(inside) == 0:
+        return {dim: slice(0, 0)}
+    return {dim: slice(inside[0], inside[-1] + 1)}
+
 def get_y_m_d_from_filepath(msg_file):
     """Extract year, month and day from MSG file path
 
@@ -40,21 +147,20 @@ def get_y_m_d_from_filepath(msg_file):
 
 def get_lon_lat():
     """Get longitude and latitude values of regular gridded MSG files given in MSG_PATH
+    The coordinates are read once and cached on disk, see readers.msg_grid
 
     Returns:
         np.array(float), np.array(float): longitude and latitude values
     """
-    MSG_example_file = f"{MSG_PATH}/2023/09/20230930-EXPATS-RG.nc"
-    with xr.open_dataset(MSG_example_file, drop_variables=CHANNELS) as dataset:
-        lon = dataset.lon.values
-        lat = dataset.lat.values
-    return lon, lat
+    grid = get_msg_grid()
+    return grid.lon, grid.lat
 
-def get_MSG_file_from_timestamp(msg_dt):
+def get_MSG_file_from_timestamp(msg_dt, backend="netcdf"):
     """Get MSG file from timestamp
 
     Args:
         msg_dt (np.datetime64): MSG timestamp
+        backend (str, optional): "netcdf" for the daily NetCDF file, "zarr" for its Zarr store. Defaults to "netcdf".
 
     Returns:
         pathlike: corresponding MSG file
@@ -63,6 +169,8 @@ def get_MSG_file_from_timestamp(msg_dt):
     dt_str = hlp.get_datestring_from_npdatetime(msg_dt)
 
     # get corresponding MSG file containing this timestamp
+    if backend == "zarr":
+        return f"{MSG_ZARR_PATH}/{dt_str[:4]}/{dt_str[4:6]}/{dt_str}-EXPATS-RG.zarr"
     msg_file = f"{MSG_PATH}/{dt_str[:4]}/{dt_str[4:6]}/{dt_str}-EXPATS-RG.nc" #20220615-EXPATS-RG.nc
     
     return msg_file
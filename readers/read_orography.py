@@ -11,6 +11,7 @@ from config.data_file_dirs import orography_file
 
 def read_orography():
     
-    data = xr.open_dataset(orography_file)
-    return data
+    # the orography is small, load it and close the file
+    with xr.open_dataset(orography_file) as data:
+        return data.load()
 
@@ -5,6 +5,8 @@ import numpy as np
 import re
 import os
 import sys
+import functools
+import pandas as pd
 sys.path.append("..")
 import matching_data.collect_matching_files as clct
 import helpers.datetime_helper as hlp
@@ -36,63 +38,138 @@ hail_class_dict = {
     4: "super_hail", 
 }
 
+# hail classes as uint8 codes: the number of the hail class, or MISSING_HAIL_CLASS for missing POH (e.g. outside of the overpass)
+MISSING_HAIL_CLASS = 255
+# name of the missing hail class, as given by convert_POH_to_hail_class
+MISSING_HAIL_CLASS_NAME = "nan"
+
+# boundaries of the hail classes in POH, hail class i for boundaries[i] <= POH < boundaries[i+1]
+POH_BOUNDARIES = np.array([0, 0.2, 0.36, 0.45, 0.6, 1.01])
+
+# lookup tables of the conversions, all vectorized with np.take
+# code of each position of POH in POH_BOUNDARIES (np.searchsorted), POH below 0, above 1.01 or NaN is missing
+_POH_POSITION_TO_CODE = np.array([MISSING_HAIL_CLASS] + list(hail_class_dict) + [MISSING_HAIL_CLASS], dtype=np.uint8)
+# number and name of each code
+_CODE_TO_NUMBER = np.full(256, np.nan)
+_CODE_TO_NUMBER[list(hail_class_dict)] = list(hail_class_dict)
+_CODE_TO_NAME = np.full(256, MISSING_HAIL_CLASS_NAME, dtype=np.array(list(hail_class_dict.values())).dtype)
+_CODE_TO_NAME[list(hail_class_dict)] = list(hail_class_dict.values())
+# codes that have a name
+_NAMED_CODES = np.array(list(hail_class_dict) + [MISSING_HAIL_CLASS])
+# names sorted alphabetically and their numbers, to find the numbers of names with np.searchsorted
+_SORTED_NAMES = np.array(sorted(hail_class_dict.values()))
+_SORTED_NAME_TO_NUMBER = np.array([{v: k for k, v in hail_class_dict.items()}[name] for name in _SORTED_NAMES])
+
 def get_hail_classes(type="number"):
     if type == "number":
         return list(hail_class_dict.keys())
     elif type == "name":
         return list(hail_class_dict.values())
-    
-def convert_POH_to_hail_class(poh, type="number"):
-    # define hail classes, the entry np.NaN is assigned to poh=NaN
-    if type == "name":
-        hail_classes = ["no_hail", 
-                        "hail_potential", 
-                        "hail_initiation_graupel", 
-                        "large_hail", 
-                        "super_hail", 
-                        np.NaN]
-    else:
-        hail_classes = [0, 1, 2, 3, 4, np.NaN]
-    
-    # if only one values is given
-    if isinstance(poh, float):
-        poh = np.array(poh)
-
-    # define boundaries of hail classes
-    boundaries = [0, 0.2, 0.36, 0.45, 0.6, 1.01]
-
-    # search for hail class corresponding to given poh
-    idx = np.searchsorted(boundaries, poh.ravel(), side='right') - 1
-    hail_classes = np.take(hail_classes, idx)
 
-    # reshape into original shape
-    hail_classes = hail_classes.reshape(poh.shape)
-
-    return hail_classes
+def get_hail_class_codes(poh, out=None):
+    """Get the hail class of POH values as uint8 codes, MISSING_HAIL_CLASS for NaN and values outside of POH_BOUNDARIES
+    :param poh: POH value or array
+    :param out: uint8 array with the shape of poh to write the codes to
+    :return: uint8 codes with the shape of poh
+    """
+    positions = np.searchsorted(POH_BOUNDARIES, poh, side='right')
+    return np.take(_POH_POSITION_TO_CODE, positions, out=out)
+
+def convert_POH_to_hail_class(poh, type="number", out=None):
+    """Convert POH values to hail class numbers (float, NaN for missing POH) or names ("nan" for missing POH)
+    :param poh: POH value or array
+    :param type: "number" or "name"
+    :param out: array with the shape of poh to write the hail classes to, float for numbers and str for names
+    :return: hail classes with the shape of poh
+    """
+    codes = get_hail_class_codes(poh)
+    return np.take(_CODE_TO_NAME if type == "name" else _CODE_TO_NUMBER, codes, out=out)
+
+def convert_hail_class(hail_class_values, to="name", out=None):
+    """Convert hail class numbers (or uint8 codes) to names, or names to numbers
+    NaN and MISSING_HAIL_CLASS are converted to MISSING_HAIL_CLASS_NAME, other unknown classes raise a ValueError.
+    :param hail_class_values: hail class value or array
+    :param to: "name" or "number"
+    :param out: array with the shape of hail_class_values to write the converted classes to
+    :return: converted hail classes with the shape of hail_class_values
+    """
+    hail_class_values = np.asarray(hail_class_values)
 
-def convert_hail_class(hail_class_values, to="name"):
     # which direction to convert
     if to == "number":
-        # Create a reverse dictionary for name to number conversion
-        reverse_hail_class_dict = {v: k for k, v in hail_class_dict.items()}
+        # position of each name in the sorted names
+        positions = np.minimum(np.searchsorted(_SORTED_NAMES, hail_class_values), len(_SORTED_NAMES) - 1)
+        unknown = _SORTED_NAMES[positions] != hail_class_values
+        if unknown.any():
+            raise ValueError(f"Unknown hail class names {np.unique(hail_class_values[unknown])}")
+        return np.take(_SORTED_NAME_TO_NUMBER, positions, out=out)
 
-        # Define a vectorized function for conversion
-        vectorized_conversion = np.vectorize(lambda x: reverse_hail_class_dict[x])
-        hail_class_values = vectorized_conversion(hail_class_values)
-    
     elif to == "name":
-        # Define a vectorized function for conversion
-        vectorized_conversion = np.vectorize(lambda x: hail_class_dict[x])
-        hail_class_values = vectorized_conversion(hail_class_values)
-    
+        if hail_class_values.dtype.kind == 'f':
+            hail_class_values = np.where(np.isnan(hail_class_values), MISSING_HAIL_CLASS, hail_class_values)
+        unknown = ~np.isin(hail_class_values, _NAMED_CODES)
+        if unknown.any():
+            raise ValueError(f"Unknown hail classes {np.unique(hail_class_values[unknown])}")
+        return np.take(_CODE_TO_NAME, hail_class_values.astype(np.intp), out=out)
+
     return hail_class_values
 
+def hail_class_stats(hail_class_values, min_pixels=[1]):
+    """Get the pixels per hail class, the area covered by the overpass and the maximum hail class of MWCC-H fields
+    The fields are converted once to uint8 codes, and all numbers are derived from the counts of the codes for all min_pixels at once.
+    :param hail_class_values: hail class numbers (NaN outside of the overpass) or uint8 codes (see get_hail_class_codes)
+                              of a single field (lat, lon) or a stack of fields (..., lat, lon)
+    :param min_pixels: minimum numbers of pixels of the maximum hail class
+    :return: dict with, for each field:
+             counts: number of pixels of each hail class, shape (..., number of hail classes)
+             covered_fraction: fraction of the pixels covered by the overpass (not NaN)
+             area_percentage: covered_fraction in percent rounded to integers, see area_percentage_covered_by_overpass
+             max_hail_class: maximum hail class with at least min_pixels pixels (-1 if there is none), shape (..., len(min_pixels))
+    """
+    hail_class_values = np.asarray(hail_class_values)
+    field_shape = hail_class_values.shape[:-2]
+    n_pixels = hail_class_values.shape[-2] * hail_class_values.shape[-1]
+
+    # the whole stack as uint8 codes, NaN becomes the missing code, then the codes of each field are counted
+    codes = _get_stack_codes(hail_class_values).reshape(-1, n_pixels)
+    n_classes = len(hail_class_dict)
+    counts = np.zeros((len(codes), n_classes), dtype=np.int64)
+    n_missing = np.zeros(len(codes), dtype=np.int64)
+    for k, field_codes in enumerate(codes):
+        # comparisons of the uint8 codes are several times faster than np.bincount
+        for hail in range(n_classes):
+            counts[k, hail] = np.count_nonzero(field_codes == hail)
+        n_missing[k] = np.count_nonzero(field_codes == MISSING_HAIL_CLASS)
+
+    # maximum hail class reaching each minimum number of pixels
+    reached = counts[:, None, ::-1] >= np.asarray(min_pixels)[None, :, None]
+    max_class = np.where(reached.any(axis=-1), n_classes - 1 - np.argmax(reached, axis=-1), -1)
+
+    # same arithmetic and rounding (half to even) as area_percentage_covered_by_overpass
+    covered_fraction = (n_pixels - n_missing) / n_pixels
+    return {
+        "counts": counts.reshape(field_shape + (n_classes,)),
+        "covered_fraction": covered_fraction.reshape(field_shape),
+        "area_percentage": np.round(covered_fraction * 100).astype(int).reshape(field_shape),
+        "max_hail_class": max_class.reshape(field_shape + (len(min_pixels),)),
+    }
+
+def _get_stack_codes(hail_class_values):
+    """Get hail class numbers as uint8 codes with MISSING_HAIL_CLASS for NaN, uint8 codes are returned as they are"""
+    if hail_class_values.dtype == np.uint8:
+        return hail_class_values
+    codes = np.empty(hail_class_values.shape, dtype=np.uint8)
+    # fmin ignores NaN, so NaN becomes the missing code while the hail class numbers are kept
+    with np.errstate(invalid="ignore"):
+        np.fmin(hail_class_values, MISSING_HAIL_CLASS, out=codes, casting="unsafe")
+    return codes
+
 # get the maximum hail class in the hail class array
 def max_hail_class(hail_class_values, min_pixel=1):
-    for hail in get_hail_classes(type="number")[::-1]:
-        if np.count_nonzero(hail_class_values == hail) >= min_pixel:
-            return hail
-    return None
+    # all values count as one field
+    hail_class_values = np.asarray(hail_class_values).reshape(1, -1)
+    max_class = int(hail_class_stats(hail_class_values, min_pixels=[min_pixel])["max_hail_class"][0])
+    return max_class if max_class >= 0 else None
 
 # calculate area percentage covered by overpass from probability of hail values
 def area_percentage_covered_by_overpass(poh_or_hail_class):
@@ -107,6 +184,15 @@ def area_percentage_covered_by_overpass(poh_or_hail_class):
 
 # %%
 # functions to extract information from file path
+# patterns of the date and the scanning start and end times in the file paths, see generate_mwcch_filepath
+DATE_PATTERN = re.compile(r'(\d{8})')
+START_PATTERN = re.compile(r'_S(\d{4})_')
+END_PATTERN = re.compile(r'_E(\d{4})_')
+
+SATELLITES = ['meto01', 'meto02', 'meto03', 'noaa15', 'noaa16', 'noaa17', 'noaa18', 'noaa19', 
+              'n20', 'n21', 'npp', 'f16', 'f17', 'gpm']
+DETECTORS = ['ATMS', 'MHS', 'SSMIS', 'GMI']
+
 def get_y_m_d_from_mwcch_filepath(file_path):
     # get date string
     date = get_datestring_from_mwcch_filepath(file_path)
@@ -140,13 +226,9 @@ def get_scan_datetime_from_mwcch_filepath(file_path, which="both"):
         return start_datetime, end_datetime
 
 def get_start_and_end_timestrings_from_mwcch_filepath(file_path):
-    # Define the regular expression patterns for start and end times
-    start_pattern = r'_S(\d{4})_'
-    end_pattern = r'_E(\d{4})_'
-
-    # Search for the patterns in the filename
-    start_match = re.search(start_pattern, file_path)
-    end_match = re.search(end_pattern, file_path)
+    # Search for the patterns of start and end times in the filename
+    start_match = START_PATTERN.search(file_path)
+    end_match = END_PATTERN.search(file_path)
 
     # Extract the times if the patterns are found
     if start_match and end_match:
@@ -157,11 +239,8 @@ def get_start_and_end_timestrings_from_mwcch_filepath(file_path):
         raise ValueError("Start or end time pattern not found in filename")
     
 def get_datestring_from_mwcch_filepath(file_path):
-    # Define the regular expression pattern for date
-    date_pattern = r'(\d{8})'
-
-    # Search for the patterns in the filename
-    date_match = re.search(date_pattern, file_path)
+    # Search for the date pattern in the filename
+    date_match = DATE_PATTERN.search(file_path)
 
     # Extract the times if the patterns are found
     if date_match:
@@ -170,23 +249,99 @@ def get_datestring_from_mwcch_filepath(file_path):
         raise ValueError("Date pattern not found in filename")
 
 def get_satellite(file_path=None):
-    satellites = ['meto01', 'meto02', 'meto03', 'noaa15', 'noaa16', 'noaa17', 'noaa18', 'noaa19', 
-                  'n20', 'n21', 'npp', 'f16', 'f17', 'gpm']
     if file_path is None:
-        return satellites
+        return list(SATELLITES)
     
-    for sat in satellites:
+    for sat in SATELLITES:
         if sat in file_path.lower():
             return sat
     return None
 
 def get_detector_from_mwcch_filepath(file_path):
-    detectors = ['ATMS', 'MHS', 'SSMIS', 'GMI']
-    for det in detectors:
+    for det in DETECTORS:
         if det.lower() in file_path.lower():
             return det
     return None
 
+def parse_mwcch_paths(paths):
+    """Parse date, scanning start and end time, detector and satellite of many MWCC-H file paths at once
+    Each pattern is searched in all paths in a single pass, giving the same values as the functions for single paths above.
+    The tables of the last file lists are cached, each call returns a copy that can be modified.
+    :param paths: list of MWCC-H file paths
+    :return: DataFrame with the columns path, date (string YYYYMMDD), start and end (datetime64), detector and satellite
+             (None if not found), one row per path in the order of paths
+    """
+    return _parse_mwcch_paths(tuple(paths)).copy()
+
+@functools.lru_cache(maxsize=16)
+def _parse_mwcch_paths(paths):
+    # all paths as one string with one path per line, each pattern is searched once in the whole string
+    joined = "\n".join(paths)
+    line_starts = np.cumsum([0] + [len(file_path) + 1 for file_path in paths])[:len(paths)]
+    date, start, end = [_first_match_per_line(pattern, joined, line_starts) for pattern in [DATE_PATTERN, START_PATTERN, END_PATTERN]]
+    if any(None in values for values in [date, start, end]):
+        # raise the error of the first path that does not match
+        for file_path in paths:
+            get_scan_datetime_from_mwcch_filepath(file_path)
+
+    # the first detector and satellite of the lists that is part of each path, as for single paths
+    joined_lower = joined.lower()
+    detector = _first_contained(joined_lower, line_starts, DETECTORS)
+    satellite = _first_contained(joined_lower, line_starts, SATELLITES)
+
+    # few different dates, so only the unique dates are converted, the times HHMM are added as minutes
+    start, end = [_get_hhmm(times) for times in [start, end]]
+    unique_dates, date_index = np.unique(date.astype(str), return_inverse=True)
+    try:
+        days = np.array([f"{d[:4]}-{d[4:6]}-{d[6:]}" for d in unique_dates], dtype="datetime64[D]")[date_index]
+        is_valid = (start // 100 <= 23) & (start % 100 <= 59) & (end // 100 <= 23) & (end % 100 <= 59)
+    except ValueError:
+        is_valid = np.zeros(len(paths), dtype=bool)
+    if not is_valid.all():
+        # raise the error of the first path with an invalid date or time
+        for file_path in paths:
+            get_scan_datetime_from_mwcch_filepath(file_path)
+
+    return pd.DataFrame({
+        "path": pd.Series(paths, dtype=object),
+        "date": pd.Series(date, dtype=object),
+        "start": days + _get_minutes(start),
+        "end": days + _get_minutes(end),
+        "detector": pd.Series(detector, dtype=object),
+        "satellite": pd.Series(satellite, dtype=object),
+    })
+
+def _get_lines(positions, line_starts):
+    """Get the line of each position in the joined paths"""
+    return np.searchsorted(line_starts, np.asarray(positions, dtype=int), side='right') - 1
+
+def _get_hhmm(timestrings):
+    """Convert time strings HHMM to integers"""
+    return timestrings.astype(str).astype(int) if len(timestrings) > 0 else np.zeros(0, dtype=int)
+
+def _get_minutes(hhmm):
+    """Convert times HHMM given as integers to timedelta64 in minutes"""
+    return ((hhmm // 100) * 60 + hhmm % 100).astype("timedelta64[m]")
+
+def _first_match_per_line(pattern, joined, line_starts):
+    """Get the first group of the first match of the pattern in each line, None if there is none
+    The patterns do not match across lines, so the first match within each line is the same as searching the line itself.
+    """
+    matches = list(pattern.finditer(joined))
+    lines, first = np.unique(_get_lines([match.start() for match in matches], line_starts), return_index=True)
+    values = np.full(len(line_starts), None, dtype=object)
+    values[lines] = [matches[k].group(1) for k in first]
+    return values
+
+def _first_contained(joined_lower, line_starts, names):
+    """Get the first of the names that is part of each line of joined_lower, None if there is none"""
+    contained = np.zeros((len(line_starts), len(names)), dtype=bool)
+    for k, name in enumerate(names):
+        contained[_get_lines([match.start() for match in re.finditer(re.escape(name.lower()), joined_lower)], line_starts), k] = True
+    first = np.array(names, dtype=object)[np.argmax(contained, axis=1)] if len(names) > 0 else np.full(len(line_starts), None)
+    first[~contained.any(axis=1)] = None
+    return first
+
 def generate_mwcch_filepath(path, start_dt, end_dt, detector, satellite, suffix=""):
     # get date string from start datetime
     date_string = hlp.get_datestring_from_npdatetime(start_dt)
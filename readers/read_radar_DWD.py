@@ -4,16 +4,20 @@ reading routines for radar data from DWD
 """
 import xarray as xr
 
-def read_radar_DWD(path_radolan_DE, day):
+def read_radar_DWD(path_radolan_DE, day, pool=None):
     """
     function to read the radar files of a given day
     Args:
         path_radolan_DE (_type_): _description_
+        pool (DatasetPool, optional): pool of open datasets that keeps and closes the file handles. Defaults to None.
     """
     yy = day[0:4]
     mm = day[4:6]
     filename = path_radolan_DE+yy+'/'+mm+'/YW_2017.002_'+day+'.nc'
-    data = xr.open_dataset(filename)    
-    
-    return(data)
+    if pool is not None:
+        return pool.open(filename)
+
+    # close the file handle, the data is read lazily from the file when accessed
+    with xr.open_dataset(filename) as data:
+        return(data)
 
@@ -1,378 +1,931 @@
 # %%
-import io
 import xarray as xr
-import random
 import time
+import datetime
+import calendar
 import numpy as np
+import pandas as pd
 from scipy.ndimage import binary_closing
 import os
+import sys
+import logging
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+from botocore.exceptions import ClientError
 from s3_bucket_credentials import S3_BUCKET_NAME, S3_ACCESS_KEY, S3_SECRET_ACCESS_KEY, S3_ENDPOINT_URL
-from data_buckets_read_and_write import read_file, Initialize_s3_client
+from data_buckets_read_and_write import iter_bucket_datasets, Initialize_s3_client, reset_transfer_metrics, get_transfer_metrics, \
+    merge_transfer_metrics
+from crop_shards import CropShardWriter, build_crop_index
+sys.path.append('..')
+import readers.read_MSG as msg_read
+from helpers.crop_encoding import save_crop
+from helpers.stage_timer import StageTimer, format_summary, dump_summary
 
 # %%
-# Initialize the S3 client (bucket)
-print('Initializing S3 client for accessing Data Bucket...')
-s3 = Initialize_s3_client(S3_ENDPOINT_URL, S3_ACCESS_KEY, S3_SECRET_ACCESS_KEY)
+# S3 client (bucket) of this process
+def get_s3():
+    """Get the S3 client of this process, each worker process creates its own client and connection pool"""
+    return Initialize_s3_client(S3_ENDPOINT_URL, S3_ACCESS_KEY, S3_SECRET_ACCESS_KEY)
 
 # which channel to use
 CHANNEL = 'IR_108'
 VMIN, VMAX = 200, 300
 
+# crops are read in boxes aligned to the chunks of the Zarr stores in lat and lon (see readers/convert_MSG_to_zarr.py)
+BOX_ALIGNMENT = 128
+
+# columns of the crop plan
+PLAN_COLUMNS = ["date", "window_start", "time", "quadrant", "idx_lon", "idx_lat", "across_midnight"]
+
+# time of the stages and counters of this process, the results of the days carry the summary of their day
+timer = StageTimer()
+
 # %%
 # methods to select crops and save them
-def search_timewindow_without_nan(ds_day, start_time, n_frames):
-    """Search for a timeseries window without NaN values in the dataset
-    :param ds_day: Dataset for the current day
-    :param start_time: Start time of the timeseries window
+def get_missing_timestamps(ds):
+    """Get for each timestamp if all data is NaN, i.e. MSG timestamp is missing
+    The Zarr stores flag the missing timestamps, so the channels do not need to be read
+    """
+    if msg_read.MISSING_VARIABLE in ds:
+        return ds[msg_read.MISSING_VARIABLE]
+    return ds[CHANNEL].isnull().all(dim=['lat', 'lon'])
+
+def plan_timewindows(is_missing, start_time, n_frames):
+    """Plan all timeseries windows without missing timestamps of a day
+    Starting at start_time, windows of n_frames follow each other without gap. A window with missing
+    timestamps is moved to the timestamp after its last missing one, as long as the day has timestamps left.
+    :param is_missing: Boolean array, True for each missing timestamp of the day
+    :param start_time: Start time of the first timeseries window
     :param n_frames: Number of frames in the timeseries window
-        
-    :return: ds_timeseries: Dataset for the timeseries window
-             start_time_next: Start time of the next timeseries window
+
+    :return: window_starts: Array of the start times of the complete windows, each window ends at start + n_frames
+             trailing_start: Start time of the incomplete last window of the day without missing timestamps, None if there is none
     """
-    # get current end time
-    end_time = start_time + n_frames
-
-    # flag to indicate if still searching for timeseries window without NaNs
-    searching_timeseries_window = True
-    # loop until a timeseries window without NaNs is found
-    while searching_timeseries_window:
-        
-        # slice small timeseries from dataset
-        ds_timeseries = ds_day.isel(time=slice(start_time, end_time))
-        if verbose:
-            print("\n", ds_timeseries.time.values[0], ds_timeseries.time.values[-1], flush=verbose)
-        
-        # check at each timestamp if all data is NaN, i.e. MSG timestamp is missing
-        is_all_nan = ds_timeseries[CHANNEL].isnull().all(dim=['lat', 'lon'])
-        if verbose:
-            print("missing timestamps: ", is_all_nan.values, flush=verbose)
+    is_missing = np.asarray(is_missing, dtype=bool)
+    n_times = len(is_missing)
+
+    # number of missing timestamps before each time, a window [start, end) is complete if it has none
+    n_missing_before = np.concatenate(([0], np.cumsum(is_missing)))
+    # index of the last missing timestamp before each time (-1: none)
+    last_missing_before = np.maximum.accumulate(np.concatenate(([-1], np.where(is_missing, np.arange(n_times), -1))))
+
+    window_starts = []
+    trailing_start = None
+    while start_time < n_times:
+        end_time = min(start_time + n_frames, n_times)
+        if n_missing_before[end_time] > n_missing_before[start_time]:
+            # move on to after the last missing timestamp of this window
+            start_time = last_missing_before[end_time] + 1
+        elif end_time - start_time < n_frames:
+            # incomplete last window of the day
+            trailing_start = start_time
+            break
+        else:
+            window_starts.append(start_time)
+            start_time = end_time
 
-        # move on to after missing timestamp
-        if is_all_nan.any():
-            # moving to next available timestamp
-            if verbose:
-                print(f"Skipping chunk {ds_timeseries.time.values[0]} due to a missing timestamp.", flush=verbose)
-            ind_nan_last = np.where(is_all_nan.values)[0][-1]
-
-            # shift start and end time to next available timestamp
-            start_time += ind_nan_last + 1
-            end_time = start_time + n_frames
-
-            # check if start time is still within the dataset
-            if start_time >= len(ds_day.time.values):
-                # if not, end this loop
-                searching_timeseries_window = False
-                start_time_next = None
-                ds_timeseries = None
-                break
-
-            # if start and end within daytime - continue to the next iteration of the loop   
-            continue
-        
-        # end the loop if all timestamps are available
-        searching_timeseries_window = False
+    return np.array(window_starts, dtype=int), trailing_start
 
-        # set the start and end time for the next timeseries
-        start_time_next = end_time
+def get_valid_crop_origins(ds_timeseries, cropsize):
+    """Get all crop origins whose crop has no NaN values at any timestamp of the timeseries window
+    The NaN values of each crop are counted with a summed-area table of the NaN mask collapsed over time.
+    :param ds_timeseries: xarray dataset of the timeseries window
+    :param cropsize: Size of the crop
+    :return: valid: Boolean array (lat, lon) of the crop origins, True if the crop starting there has no NaN values
+    """
+    nan_mask = ds_timeseries[CHANNEL].isnull().any(dim='time').transpose('lat', 'lon').values
 
-    return ds_timeseries, start_time_next
+    # summed-area table, sat[y, x] is the number of NaN pixels in nan_mask[:y, :x]
+    sat = np.zeros((nan_mask.shape[0] + 1, nan_mask.shape[1] + 1), dtype=np.int64)
+    sat[1:, 1:] = nan_mask.cumsum(axis=0).cumsum(axis=1)
 
-def crop_from_quadrant(ds_timeseries, i, j, cropsize, maxoverlap, max_cropping_attempts):
-    """Crop a random subcrop from the dataset within one of the quadrants denoted by i and j
-    :param ds_timeseries: xarray dataset of the timeseries window
+    # number of NaN pixels of the crops at all origins
+    n_nan = sat[cropsize:, cropsize:] - sat[:-cropsize, cropsize:] - sat[cropsize:, :-cropsize] + sat[:-cropsize, :-cropsize]
+    return n_nan == 0
+
+def crop_from_quadrant(valid, len_lon, len_lat, i, j, cropsize, maxoverlap, rng):
+    """Select a random crop origin without NaN values within one of the quadrants denoted by i and j
+    :param valid: Boolean array (lat, lon) of the crop origins without NaN values, see get_valid_crop_origins
+    :param len_lon: Length of the lon dimension of the domain
+    :param len_lat: Length of the lat dimension of the domain
     :param i: Index of the quadrant row (0 or 1)
     :param j: Index of the quadrant column (0 or 1)
     :param cropsize: Size of the crop
     :param maxoverlap: Maximum allowed overlap of the crops among each other, this is affecting the range of the random selection
-    :param max_cropping_attempts: Maximum number of attempts to find a crop without NaN values
-    :return: crop_timeseries: Cropped dataset
-             n_attempts: Number of attempts to crop the dataset
+    :param rng: np.random.Generator to select the origin
+    :return: idx_lon, idx_lat: Origin of the crop, None if the quadrant has no crop without NaN values
     """
-    # get length of lat and lon dimensions
-    len_lon, len_lat = ds_timeseries.sizes['lon'], ds_timeseries.sizes['lat']
-    
-    # counter for cropping attempts
-    n_attempts = 0
-    # flag to indicate if a crop was generated
-    crop_generated = False
-    crop_timeseries = None
-
-    # loop until either a crop is generated or maximum number of attempts is reached
-    # (in case of many NaNs in the data at some point - after max_cropping_attempts - the creation of crops is aborted)
-    while n_attempts < max_cropping_attempts and not crop_generated:
-
-        # get range of lon and lat in which the crops are randomly selected
-        # depending on i and j indicating position of quadrant within domain
-        min_idx_lon = 0 if i==0 else int(len_lon/2 - maxoverlap/2*cropsize)
-        max_idx_lon = int(len_lon/2 - cropsize + maxoverlap/2*cropsize) if i==0 else int(len_lon - cropsize)
-        min_idx_lat = 0 if j==0 else int(len_lat/2 - maxoverlap/2*cropsize)
-        max_idx_lat = int(len_lat/2 - cropsize + maxoverlap/2*cropsize) if j==0 else int(len_lat - cropsize)
-
-        # randomly select origin of crop in given lon and lat ranges (exclusive of higher threshold)
-        idx_lon = np.random.randint(min_idx_lon, max_idx_lon)
-        idx_lat = np.random.randint(min_idx_lat, max_idx_lat)
-
-        # crop timeseries by selected lat and lon
-        crop_timeseries = ds_timeseries.isel(lon=slice(idx_lon, idx_lon+cropsize), lat=slice(idx_lat, idx_lat+cropsize))
-
-        # check if timeseries contains any NaN values
-        nan_exist = crop_timeseries[CHANNEL].isnull().any()
-        if nan_exist:
-            n_attempts += 1
-            continue
-        else:
-            n_attempts += 1
-            crop_generated = True
-
-    return crop_timeseries, n_attempts
+    # get range of lon and lat in which the crops are randomly selected
+    # depending on i and j indicating position of quadrant within domain
+    min_idx_lon = 0 if i==0 else int(len_lon/2 - maxoverlap/2*cropsize)
+    max_idx_lon = int(len_lon/2 - cropsize + maxoverlap/2*cropsize) if i==0 else int(len_lon - cropsize)
+    min_idx_lat = 0 if j==0 else int(len_lat/2 - maxoverlap/2*cropsize)
+    max_idx_lat = int(len_lat/2 - cropsize + maxoverlap/2*cropsize) if j==0 else int(len_lat - cropsize)
+
+    # randomly select one of the valid origins in given lon and lat ranges (exclusive of higher threshold)
+    valid_lat, valid_lon = np.nonzero(valid[min_idx_lat:max_idx_lat, min_idx_lon:max_idx_lon])
+    if len(valid_lat) == 0:
+        return None
+    k = rng.integers(len(valid_lat))
+    return min_idx_lon + int(valid_lon[k]), min_idx_lat + int(valid_lat[k])
 
 def apply_closing_on_cloud_mask(cloud_mask):
     """Apply binary closing on the cloud mask to fill small holes
-    :param cloud_mask: xarray dataset of the cloud mask
-    :return: cloud_mask: xarray dataset of the cloud mask with holes filled
+    The closing is applied with a 3x3 structuring element on each timestamp (and crop), all at once.
+    :param cloud_mask: xarray DataArray of the cloud mask, e.g. (time, lat, lon) or (crop, time, lat, lon)
+    :return: cloud_mask: copy of the cloud mask with holes filled
     """
-    # loop over timestamps and apply the closing algorithm of the 'holes' in the cloud mask
-    for t in range(len(cloud_mask.time.values)):
-        # get the cloud mask for the current timestamp
-        cloud_mask_ts = cloud_mask.isel(time=t)
+    cloud_mask = cloud_mask.transpose(..., 'lat', 'lon')
 
-        # apply binary closing with a 3x3 structuring element
-        structure = np.ones((3, 3), dtype=np.uint8)
+    # 3x3 structuring element in lat and lon, the other dimensions are not connected
+    structure = np.ones((1,) * (cloud_mask.ndim - 2) + (3, 3), dtype=np.uint8)
 
-        # apply the binary closing to the cloud mask
-        # cloud_mask_closed[t] = binary_closing(cloud_mask_ts, structure=structure)
-        cloud_mask[t] = binary_closing(cloud_mask_ts, structure=structure)
+    # apply the binary closing to the cloud mask
+    cloud_mask_closed = binary_closing(cloud_mask.values, structure=structure)
 
-    return cloud_mask
+    return cloud_mask.copy(data=cloud_mask_closed.astype(cloud_mask.dtype))
 
-def add_parameters_with_applied_closed_cm(crop_timeseries, vmax=VMAX):
+def add_parameters_with_applied_closed_cm(crop_timeseries, vmax=VMAX, is_closed=False):
     """Apply the closed cloud mask to the IR_108 channel and save it in the dataset as new variable
     :param crop_timeseries: xarray dataset of the cropped timeseries
     :param vmax: Maximum value for the IR_108 channel
+    :param is_closed: If True, the cloud mask of the dataset is already closed
     :return: crop_timeseries: xarray dataset of the cropped timeseries including applied closed cloud mask
     """
     # get cloud mask from timeseries data and apply binary closing
-    cloud_mask = apply_closing_on_cloud_mask(crop_timeseries['cma'])
+    if not is_closed:
+        crop_timeseries['cma'] = apply_closing_on_cloud_mask(crop_timeseries['cma'])
 
     # apply the cloud mask to the 10.8 channel of the timeseries data
     # set the values outside the cloud mask to vmax
-    IR_108_cm = crop_timeseries.IR_108.where(cloud_mask == 1, vmax)
+    IR_108_cm = crop_timeseries.IR_108.where(crop_timeseries['cma'] == 1, vmax)
 
     # save the masked data in the original dataset as additional variable
     crop_timeseries["IR_108_cm"] = IR_108_cm
                                       
     return crop_timeseries
 
-def crop_and_save_from_all_quadrants(ds_timeseries, cropsize, max_spatial_overlap, out_path, out_basename, max_cropping_attempts=10, verbose=False):
-    """Crop out random samples from all quadrants and save them as netcdf
+def select_crop_origins(ds_timeseries, cropsize, max_spatial_overlap, rng=None, verbose=False):
+    """Select a random crop origin without NaN values in each of the 4 quadrants of the whole domain
+    Only the NaN values of CHANNEL are read.
     :param ds_timeseries: xarray dataset of the timeseries window
     :param cropsize: Size of the crops
     :param max_spatial_overlap: Maximum allowed overlap of the crops among each other as fraction of the cropsize
+    :param rng: np.random.Generator to select the crops. If None, a randomly seeded generator is used
+    :param verbose: If True, print the quadrants without crop
+    :return: origins: dict of quadrant -> (idx_lon, idx_lat) of the crop, quadrants without crop without NaN values are left out
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+
+    # get length of lat and lon dimensions
+    len_lon, len_lat = ds_timeseries.sizes['lon'], ds_timeseries.sizes['lat']
+    with timer.stage("crop_sampling"):
+        valid = get_valid_crop_origins(ds_timeseries, cropsize)
+
+        origins = {}
+        for i in range(2):
+            for j in range(2):
+                origins[2*i+j] = crop_from_quadrant(valid, len_lon, len_lat, i, j, cropsize, max_spatial_overlap, rng)
+
+    timer.count("crop_attempts", len(origins))
+    for quadrant in list(origins):
+        if origins[quadrant] is None:
+            timer.count("crops_rejected")
+            if verbose:
+                print(f"No crop without NaN values in quadrant {quadrant}.", flush=verbose)
+            del origins[quadrant]
+    return origins
+
+def save_crops(ds_timeseries, origins, cropsize, out_path, out_basename, edge_mode="domain", writer=None, encoding="default",
+               verbose=False):
+    """Cut out the crops at the given origins and save them as netcdf
+    Only the box around the crops is read, aligned to the chunks of the Zarr stores.
+    :param ds_timeseries: xarray dataset of the timeseries window
+    :param origins: dict of quadrant -> (idx_lon, idx_lat) of the crops, see select_crop_origins
+    :param cropsize: Size of the crops
     :param out_path: Path to save the crops
     :param out_basename: Basename for the output files
-    :param max_cropping_attempts: Maximum number of attempts to find a crop without NaN values
+    :param edge_mode: How the cloud mask is closed at the crop borders.
+                      "domain": closed once on the whole domain, the crop borders are closed with the pixels around the crop
+                      "crop": closed on each crop, the area outside the crop counts as cloud free (as before closing the domain)
+    :param writer: CropShardWriter to append the crops to. If None, each crop is saved as netcdf file in out_path
+    :param encoding: Encoding profile of the netcdf files: "default", "fast", "archive" or "compact" (see helpers/crop_encoding.py)
     :param verbose: If True, print the filename of each crop
     :return: None
     """
-    # loop over 4 quadrants of the whole domain
-    for i in range(2):
-        for j in range(2):
-            # crop out random sample with given size from quadrant
-            crop_timeseries, n_attempts = crop_from_quadrant(ds_timeseries, i, j, cropsize, max_spatial_overlap, max_cropping_attempts)
+    if edge_mode not in ("domain", "crop"):
+        raise ValueError(f"edge_mode must be 'domain' or 'crop', not {edge_mode}")
+    if len(origins) == 0:
+        return
+
+    quadrants = list(origins)
+    idx_lon = np.array([origins[q][0] for q in quadrants])[:, None] + np.arange(cropsize)
+    idx_lat = np.array([origins[q][1] for q in quadrants])[:, None] + np.arange(cropsize)
+
+    # read the box around all crops at once, with a margin of 2 pixels the closing of the cloud mask
+    # within the crops is the same as on the whole domain
+    box = {'lon': get_box_slice(idx_lon, ds_timeseries.sizes['lon']),
+           'lat': get_box_slice(idx_lat, ds_timeseries.sizes['lat'])}
+    with timer.stage("read_box"):
+        ds_box = ds_timeseries.isel(box).load()
+    idx_lon, idx_lat = idx_lon - box['lon'].start, idx_lat - box['lat'].start
+
+    # close the cloud mask once for the whole window, shared by all crops
+    if edge_mode == "domain":
+        with timer.stage("cloud_mask_closing"):
+            ds_box = ds_box.assign(cma=apply_closing_on_cloud_mask(ds_box['cma']))
+
+    # gather the crops of all quadrants at once
+    crops = ds_box.isel(lon=xr.DataArray(idx_lon, dims=('crop', 'lon')),
+                        lat=xr.DataArray(idx_lat, dims=('crop', 'lat')))
+
+    # close the cloud mask of all crops at once
+    if edge_mode == "crop":
+        with timer.stage("cloud_mask_closing"):
+            crops['cma'] = apply_closing_on_cloud_mask(crops['cma'])
+
+    for k, quadrant in enumerate(quadrants):
+        crop_timeseries = crops.isel(crop=k).set_xindex('lat').set_xindex('lon')
+
+        # apply cm, the flag of missing timestamps is not saved with the crop
+        crop_timeseries_cm = add_parameters_with_applied_closed_cm(crop_timeseries.drop_vars(msg_read.MISSING_VARIABLE, errors="ignore"),
+                                                                   is_closed=True)
+
+        timer.count("crops")
+        if writer is not None:
+            # append crop to the shard of its day
+            with timer.stage("write"):
+                writer.write(crop_timeseries_cm, quadrant, *origins[quadrant])
+            timer.count("bytes_written", crop_timeseries_cm.nbytes)
+            continue
 
-            if crop_timeseries is None:
-                continue
-            
-            # apply cm
-            crop_timeseries_cm = add_parameters_with_applied_closed_cm(crop_timeseries)
-
-            # get the date and time of the first timestamp in the timeseries
-            date_str, time_str = str(crop_timeseries_cm.time.values[0]).split('T')
-            year, month, day = date_str.split('-')
-
-            # output_folder for this day
-            output_folder = f"{out_path}/{year}/{month}/{day}"
-            os.makedirs(output_folder, exist_ok=True)
-            
-            # generate file name
-            filepath_to_save = f"{output_folder}/{out_basename}_{year}-{month}-{day}_{time_str[:2]}{time_str[3:5]}_crop{2*i+j}.nc"
-
-            # save crop to a netcdf file
-            crop_timeseries_cm.to_netcdf(filepath_to_save, mode='w')
-            
-            if verbose:
-                print(f"saved after {n_attempts} attempts to: ", filepath_to_save, flush=verbose)
-
-def process_trailing_timeseries_of_previous_day(from_previous_day, ds_day, n_frames, 
-                                                cropsize, max_spatial_overlap, out_path, out_basename, 
-                                                max_cropping_attempts=10, verbose=False):
-    """Process the trailing timeseries of the previous day
-    :param from_previous_day: Dataset of the trailing timeseries of the previous day
-    :param ds_day: Dataset of the current day
+        # get the date and time of the first timestamp in the timeseries
+        date_str, time_str = str(crop_timeseries_cm.time.values[0]).split('T')
+        year, month, day = date_str.split('-')
+
+        # output_folder for this day
+        output_folder = f"{out_path}/{year}/{month}/{day}"
+        os.makedirs(output_folder, exist_ok=True)
+
+        # generate file name
+        filepath_to_save = f"{output_folder}/{out_basename}_{year}-{month}-{day}_{time_str[:2]}{time_str[3:5]}_crop{quadrant}.nc"
+
+        # save crop to a netcdf file, the compact profile stores the brightness temperatures as int16 around VMIN to VMAX
+        with timer.stage("write"):
+            save_crop(crop_timeseries_cm, filepath_to_save, profile=encoding, vmin=VMIN, vmax=VMAX)
+        timer.count("bytes_written", os.path.getsize(filepath_to_save))
+
+        if verbose:
+            print(f"saved to: ", filepath_to_save, flush=verbose)
+
+def get_box_slice(idx, size, margin=2, alignment=BOX_ALIGNMENT):
+    """Get the slice of the box around the given indices with a margin, extended to multiples of alignment"""
+    start = max(int(idx.min()) - margin, 0) // alignment * alignment
+    stop = min(-(-(int(idx.max()) + 1 + margin) // alignment) * alignment, size)
+    return slice(start, stop)
+
+def crop_and_save_from_all_quadrants(ds_timeseries, cropsize, max_spatial_overlap, out_path, out_basename, edge_mode="domain",
+                                     rng=None, writer=None, encoding="default", verbose=False):
+    """Crop out random samples without NaN values from all quadrants and save them as netcdf
+    (see select_crop_origins and save_crops for the parameters)
+    :return: None
+    """
+    origins = select_crop_origins(ds_timeseries, cropsize, max_spatial_overlap, rng=rng, verbose=verbose)
+    save_crops(ds_timeseries, origins, cropsize, out_path, out_basename, edge_mode=edge_mode, writer=writer, encoding=encoding, verbose=verbose)
+
+def plan_timeseries_across_midnight(previous_day, current_day, n_frames, cropsize, max_spatial_overlap, seed=None, verbose=False):
+    """Plan the timeseries window across midnight, from the incomplete last window of the previous day and the first frames of the current day
+    The window is only used if it has no missing timestamps, the first window of the current day starts late enough not to overlap it much (see get_start_times).
+    :param previous_day: Result of process_day (or plan_day_with_edges) for the previous day
+    :param current_day: Result of process_day (or plan_day_with_edges) for the current day
     :param n_frames: Number of frames in the timeseries window
     :param cropsize: Size of the crops
-    :param maxoverlap: Maximum allowed overlap of the crops among each other as fraction of the cropsize
-    :param out_path: Path to save the crops
-    :param out_basename: Basename for the output files
-    :param max_cropping_attempts: Maximum number of attempts to find a crop without NaN values
-    :param verbose: If True, print the filename of each crop
+    :param max_spatial_overlap: Maximum allowed overlap of the crops among each other as fraction of the cropsize
+    :param seed: Seed of the random generators of the days, see get_day_rng
+    :param verbose: If True, print why a window is not used
 
-    :return: from_previous_day: Dataset of the trailing timeseries of the previous day set back to None
-             next_start_time: Start time of the next timeseries window
+    :return: ds_timeseries: Dataset of the window across midnight, None if the window is not used
+             origins: Origins of the crops of the window, see select_crop_origins
     """
-    # add the trailing timeseries of the previous day to the current day data and slice timeseries
-    ds_timeseries = xr.concat([from_previous_day, ds_day], dim='time').isel(time=slice(0, n_frames))
+    from_previous_day, head = previous_day["trailing"], current_day["head"]
+    if from_previous_day is None:
+        return None, {}
+
+    # the trailing timeseries has no missing timestamps, the first timestamps of the current day need to be complete as well
+    n_current_day = n_frames - len(from_previous_day.time.values)
+    if head is None or len(head.time.values) < n_current_day:
+        if verbose:
+            print(f"The trailing timeseries of {previous_day['date']} has missing data in the next day.", flush=verbose)
+        return None, {}
+
+    # add the trailing timeseries of the previous day to the current day data
+    ds_timeseries = xr.concat([from_previous_day, head.isel(time=slice(0, n_current_day))], dim='time')
     if verbose:
         print("\n", ds_timeseries.time.values[0], ds_timeseries.time.values[-1], flush=verbose)
 
-    # check at each timestamp if all data is NaN, i.e. MSG timestamp is missing
-    is_all_nan = ds_timeseries[CHANNEL].isnull().all(dim=['lat', 'lon'])
+    origins = select_crop_origins(ds_timeseries, cropsize, max_spatial_overlap,
+                                  rng=get_day_rng(seed, current_day["date"], stream=1), verbose=verbose)
+    timer.count("windows_across_midnight")
+    return ds_timeseries, origins
+
+def process_timeseries_across_midnight(previous_day, current_day, n_frames, cropsize, max_spatial_overlap, out_path, out_basename,
+                                       edge_mode="domain", seed=None, writer=None, encoding="default", verbose=False):
+    """Crop and save the timeseries window across midnight, see plan_timeseries_across_midnight
+    :return: True if the window across midnight was cropped and saved
+    """
+    ds_timeseries, origins = plan_timeseries_across_midnight(previous_day, current_day, n_frames, cropsize, max_spatial_overlap,
+                                                             seed=seed, verbose=verbose)
+    if ds_timeseries is None:
+        return False
+
+    # crop out random samples from all quadrants given size and save them as netcdf
+    save_crops(ds_timeseries, origins, cropsize, out_path, out_basename, edge_mode=edge_mode, writer=writer, encoding=encoding, verbose=verbose)
+    return True
+
+# %%
+def get_day_files(path_dir, basename, year, months, days, zarr_path=None):
+    """Get the files (or Zarr stores) of all days of a year, days that do not exist in the bucket are skipped later
+    :return: dict of file -> datetime.date of the day
+    """
+    return {get_day_file(path_dir, basename, datetime.date(year, month, day), zarr_path): datetime.date(year, month, day)
+            for month in months for day in days if day <= calendar.monthrange(year, month)[1]}
+
+def get_day_file(path_dir, basename, date, zarr_path=None):
+    """Get the file of a day in the bucket, or its Zarr store in zarr_path"""
+    if zarr_path is not None:
+        return f"{zarr_path}/{date.year:04d}/{date.month:02d}/{basename}_{date}.zarr"
+    return f"{path_dir}/{date.year:04d}/{date.month:02d}/{basename}_{date}.nc"
+
+def is_next_day(previous_day, current_day):
+    """Check if the current day directly follows the previous day, the results of both are given as dicts with the date"""
+    return previous_day is not None and \
+        datetime.date.fromisoformat(current_day["date"]) - datetime.date.fromisoformat(previous_day["date"]) == datetime.timedelta(days=1)
+
+def open_zarr_days(stores, channels=None):
+    """Open the daily Zarr stores lazily, yielding (store, dataset, error) like iter_bucket_datasets"""
+    for store in stores:
+        if not os.path.exists(store):
+            yield store, None, FileNotFoundError(f"{store} does not exist")
+            continue
+        with timer.stage("decode"):
+            ds = msg_read.open_lazy(store, channels=channels)
+        yield store, ds, None
+
+def read_days(files, channels=None, dtype=np.float32, zarr_path=None, variables=None, prefetch=2):
+    """Read the days from the bucket or open their Zarr stores, yielding (file, dataset, error) like iter_bucket_datasets
+    The next days (prefetch) are downloaded and decoded in the background while the current day is processed.
+    :param variables: Variables read from the bucket, with ranged requests. If None, all variables are read.
+                      The Zarr stores are opened lazily, only the variables that are used are read from them
+    """
+    if zarr_path is not None:
+        return open_zarr_days(files, channels=channels)
+    return iter_bucket_datasets(get_s3(), S3_BUCKET_NAME, files, variables=variables, ranged=variables is not None,
+                                prefetch=prefetch, workers=prefetch, timer=timer,
+                                transform=lambda ds: msg_read.read_window(ds, channels=channels, dtype=dtype))
+
+def get_day_rng(seed, date, stream=0):
+    """Get the random generator of a day, derived from the seed and the date, so the crops do not depend on the order in which the days are processed
+    :param seed: Seed of the whole dataset. If None, the generator is seeded randomly
+    :param date: Date of the day as string YYYY-MM-DD
+    :param stream: Index of the independent random stream of this day (0: windows within the day, 1: window across midnight ending on this day,
+                   2: start of the first window of the day)
+    :return: np.random.Generator
+    """
+    if seed is None:
+        return np.random.default_rng()
+    return np.random.default_rng([seed, int(date.replace('-', '')), stream])
+
+def get_day_missing(ds_day, date):
+    """Get the missing timestamps of a day, only CHANNEL is read"""
+    with timer.stage("window_search"):
+        return {"date": date, "is_missing": get_missing_timestamps(ds_day).values}
+
+def get_start_times(days_missing, n_frames=8, max_daily_offset=None, max_spatial_overlap=0.25, seed=None):
+    """Draw the start of the first window of each day, in order of the days
+    If the trailing frames of the previous day and the first frames of the day give a complete window across midnight,
+    the first window of the day starts late enough to only overlap it by a few frames, as otherwise the window is not used.
+    :param days_missing: Results of get_day_missing of the days, in order
+    :return: dict with the start of the first window of each day by date
+    """
+    start_times = {}
+    previous_day = None
+    for day in days_missing:
+        rng = get_day_rng(seed, day["date"], stream=2)
+        is_missing = day["is_missing"]
+
+        n_current_day = None
+        if is_next_day(previous_day, day) and previous_day["trailing_start"] is not None:
+            n_trailing = len(previous_day["is_missing"]) - previous_day["trailing_start"]
+            n_current_day = n_frames - n_trailing
+            if len(is_missing) < n_current_day or is_missing[:n_current_day].any():
+                n_current_day = None
+
+        if n_current_day is not None:
+            # make sure that there is only small overlap with the window across midnight
+            earliest_start = max(int(n_frames - max_spatial_overlap*n_frames - n_trailing), 0)
+            start_time = int(rng.integers(earliest_start, n_frames))
+        elif max_daily_offset is not None:
+            # generate random offset for first timeseries of the day to increase variability
+            start_time = int(rng.integers(0, round(max_daily_offset*n_frames)+2))
+        else:
+            start_time = int(rng.integers(0, n_frames))
+
+        start_times[day["date"]] = start_time
+        _, trailing_start = plan_timewindows(is_missing, start_time, n_frames)
+        previous_day = {**day, "trailing_start": trailing_start}
+    return start_times
+
+def plan_day(ds_day, date, start_time, n_frames=8, cropsize=100, max_spatial_overlap=0.25, seed=None, verbose=False):
+    """Plan the timeseries windows of a day and the crops of each window, only the missing timestamps and the NaN values of CHANNEL are read
+    The start of the first window is settled beforehand with get_start_times, so the days can be planned independently of each other.
+    The window across midnight is planned afterwards with plan_timeseries_across_midnight.
+    :param ds_day: Dataset of the day
+    :param date: Date of the day as string YYYY-MM-DD
+    :param start_time: Start of the first window of the day, see get_start_times
+    :param seed: Seed of the random generators of the days, see get_day_rng
+    (see construct_timeseries_dataset for the other parameters)
+
+    :return: dict with the date, the start time of the first window, the windows as list of (window start, origins of the crops)
+             and the times of their first timestamps, the start of the incomplete last window (trailing_start, None if there is none) and the number of first frames
+             without missing timestamps needed for the window across midnight (n_head)
+    """
+    rng = get_day_rng(seed, date)
+
+    # missing timestamps of the day, checked once for the whole day
+    with timer.stage("window_search"):
+        is_missing = get_missing_timestamps(ds_day).values
     if verbose:
-        print("missing timestamps:", is_all_nan.values, flush=verbose)
-
-    # process this timeseries if it is complete before moving on with the normal processing of the next day
-    if not is_all_nan.any():
-
-        # crop out random samples from all quadrants given size and save them as netcdf
-        crop_and_save_from_all_quadrants(ds_timeseries, cropsize, max_spatial_overlap, out_path, out_basename, 
-                                         max_cropping_attempts=max_cropping_attempts, verbose=verbose)
-        
-        # generate random offset for next timeseries of the day to increase variability
-        # make sure that there is only small overlap with trailing timeseries of previous day
-        earliest_start = max(int(n_frames - max_spatial_overlap*n_frames - len(from_previous_day.time.values)), 0)
-        next_start_time = random.randint(earliest_start, int(n_frames-1))
-        if verbose:
-            print(f"random start time of next timeseries between {earliest_start} and {int(n_frames-1)}", next_start_time, flush=verbose)
+        print("start time", start_time, flush=verbose)
 
-    else:
-        # generate random offset for first timeseries of the day to increase variability
-        next_start_time = random.randint(0, int(n_frames-1))
+    # plan all timeseries windows without NaN values until the end of the day
+    with timer.stage("window_search"):
+        window_starts, trailing_start = plan_timewindows(is_missing, start_time, n_frames)
+    timer.count("windows", len(window_starts))
+    timer.count("missing_timestamps", is_missing.sum())
+    if verbose:
+        print("missing timestamps:", np.where(is_missing)[0], "window starts:", window_starts, flush=verbose)
+
+    # select the crops of each window
+    windows = [(int(window_start), select_crop_origins(ds_day.isel(time=slice(window_start, window_start + n_frames)),
+                                                       cropsize, max_spatial_overlap, rng=rng, verbose=verbose))
+               for window_start in window_starts]
+
+    # the window across midnight needs at most n_frames-1 first frames of the next day
+    n_head = min(n_frames - 1, int(np.argmax(is_missing)) if is_missing.any() else len(is_missing))
+
+    return {"date": date, "start_time": start_time, "windows": windows, "window_times": ds_day.time.values[window_starts],
+            "trailing_start": trailing_start, "n_head": n_head}
+
+def add_day_edges(day, ds_day):
+    """Add the first frames (head) and the incomplete last window (trailing) of a day to its result, for the window across midnight"""
+    # load into memory, as the file of this day is closed afterwards
+    day["head"] = ds_day.isel(time=slice(0, day["n_head"])).load() if day["n_head"] > 0 else None
+    day["trailing"] = ds_day.isel(time=slice(day["trailing_start"], None)).load() if day["trailing_start"] is not None else None
+    return day
+
+def plan_day_with_edges(ds_day, date, **kwargs):
+    """Plan a day, keeping the data of its edges to plan the windows across midnight, see plan_day"""
+    return add_day_edges(plan_day(ds_day, date, **kwargs), ds_day)
+
+def execute_day(ds_day, date, windows, trailing_start=None, n_head=0, n_frames=8, cropsize=100, out_path=None, out_basename=None,
+                edge_mode="domain", output_format="netcdf", max_samples_per_shard=1000, encoding="default", verbose=False):
+    """Crop and save the planned windows within a day
+    :param ds_day: Dataset of the day
+    :param date: Date of the day as string YYYY-MM-DD
+    :param windows: List of (window start, origins of the crops) of the day, see plan_day
+    :param trailing_start: Start of the window across midnight starting on this day, None if there is none
+    :param n_head: Number of first frames of this day for a window across midnight ending on this day
+    (see construct_timeseries_dataset for the other parameters)
+
+    :return: dict with the date and the data of the edges of the day (head and trailing) for the windows across midnight
+    """
+    # the shards of this day are written again from the start
+    writer = CropShardWriter(out_path, out_basename, max_samples_per_shard, overwrite=True) if output_format == "shards" else None
+
+    for window_start, origins in windows:
+        # crop out the planned samples and save them as netcdf
+        ds_timeseries = ds_day.isel(time=slice(window_start, window_start + n_frames))
+        save_crops(ds_timeseries, origins, cropsize, out_path, out_basename, edge_mode=edge_mode, writer=writer, encoding=encoding, verbose=verbose)
+    if writer is not None:
+        writer.close()
+
+    return add_day_edges({"date": date, "trailing_start": trailing_start, "n_head": n_head}, ds_day)
+
+def process_day(ds_day, date, start_time, n_frames=8, cropsize=100, max_spatial_overlap=0.25,
+                out_path=None, out_basename=None, edge_mode="domain", seed=None,
+                output_format="netcdf", max_samples_per_shard=1000, encoding="default", verbose=False):
+    """Plan and crop all timeseries windows within one day, see plan_day and execute_day
+    :return: dict with the date, the start time of the first window, the number of windows and the edges of the day
+    """
+    day = plan_day(ds_day, date, start_time, n_frames=n_frames, cropsize=cropsize,
+                   max_spatial_overlap=max_spatial_overlap, seed=seed, verbose=verbose)
+    if verbose and day["trailing_start"] is not None:
+        print(f"The last timeseries of the day is not complete - keep for next day.", flush=verbose)
+
+    edges = execute_day(ds_day, date, day["windows"], trailing_start=day["trailing_start"], n_head=day["n_head"],
+                        n_frames=n_frames, cropsize=cropsize, out_path=out_path, out_basename=out_basename, edge_mode=edge_mode,
+                        output_format=output_format, max_samples_per_shard=max_samples_per_shard, encoding=encoding, verbose=verbose)
+    return {"date": date, "start_time": day["start_time"], "n_windows": len(day["windows"]),
+            "head": edges["head"], "trailing": edges["trailing"]}
+
+def _read_and_apply(file, date, day_function, read_kwargs, day_kwargs):
+    """Read a single day and apply day_function to it, in a worker process
+    The timer and transfer metrics of the worker only hold this day, they are returned also if the day fails (see run_days).
+    """
+    timer.reset()
+    reset_transfer_metrics()
+    with timer.stage("read_wait"):
+        file, ds_day, error = list(read_days([file], prefetch=1, **read_kwargs))[0]
+    if error is not None:
+        return file, {"timing": timer.pop(), "transfer": get_transfer_metrics()}, error
+    with ds_day:
+        result = day_function(ds_day, date, **day_kwargs)
+    result["timing"] = timer.pop()
+    result["transfer"] = get_transfer_metrics()
+    return file, result, None
+
+def report_read_error(file, error, verbose=False):
+    """Report a day that could not be read, return True if reading failed and False if the file does not exist
+    Missing files are only printed if verbose, all other errors (e.g. corrupt files, timeouts, credentials) are logged.
+    """
+    if isinstance(error, FileNotFoundError) or \
+       (isinstance(error, ClientError) and error.response.get("Error", {}).get("Code") in ("NoSuchKey", "404")):
         if verbose:
-            print(f"The trailing timeseries of previous day has missing data - move on with next day.", flush=verbose)
-            print("random start time", next_start_time, flush=verbose)
+            print(f"Could not read {file}: {error}", flush=True)
+        return False
+    logging.error(f"Could not read {file}: {error!r}")
+    return True
+
+def print_failed_days(n_failed):
+    if n_failed > 0:
+        print(f"{n_failed} days could not be read and were skipped, see the errors above", flush=True)
+
+def run_days(files, dates, day_function, day_kwargs, read_kwargs, workers=1, prefetch=2):
+    """Apply day_function(ds_day, date, **day_kwargs) to each day, yielding (file, result, error) in the order of the days
+    With workers > 1 the days are read and processed in parallel processes, else the next days (prefetch) are read
+    in the background while the current day is processed.
+    :param day_kwargs: Arguments of day_function, one dict for all days or a list with one dict per day
+    :param read_kwargs: Arguments of read_days
+    The result of each day (a dict) gets the summary of the stage timer of the day as "timing". The reading of
+    the next days in the background is counted with the day during which it finished.
+    """
+    if isinstance(day_kwargs, dict):
+        day_kwargs = [day_kwargs] * len(files)
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for file, result, error in executor.map(_read_and_apply, files, dates, [day_function]*len(files),
+                                                    [read_kwargs]*len(files), day_kwargs):
+                # add the counters of the worker to this process, the timing of failed days is counted with the next day
+                merge_transfer_metrics(result.pop("transfer"))
+                if error is not None:
+                    timer.merge(result["timing"])
+                    result = None
+                yield file, result, error
+        return
+
+    with contextlib.closing(read_days(files, prefetch=prefetch, **read_kwargs)) as days:
+        for date, kwargs in zip(dates, day_kwargs):
+            # time waiting for the day, the next days are read in the background
+            with timer.stage("read_wait"):
+                file, ds_day, error = next(days)
+            if error is not None:
+                yield file, None, error
+                continue
+            with ds_day:
+                result = day_function(ds_day, date, **kwargs)
+            result["timing"] = timer.pop()
+            yield file, result, None
+
+def plan_start_times(files, dates, read_kwargs, n_frames=8, max_daily_offset=None, max_spatial_overlap=0.25, seed=None,
+                     workers=1, prefetch=2, day_timer=None, verbose=False):
+    """Read the missing timestamps of the days and draw the start of their first windows, see get_start_times
+    Only the missing timestamps are read, so the days can then be planned and cropped in parallel.
+    :param day_timer: StageTimer the time of reading the missing timestamps is added to
+    :return: start_times: dict with the start of the first window of each day by date, days that could not be read are left out
+             n_failed: Number of days that could not be read
+    """
+    days_missing = []
+    n_failed = 0
+    missing_kwargs = {"channels": [CHANNEL], "zarr_path": read_kwargs.get("zarr_path"), "variables": [CHANNEL]}
+    for file, day, error in run_days(files, dates, get_day_missing, {}, missing_kwargs, workers=workers, prefetch=prefetch):
+        if error is not None:
+            n_failed += int(report_read_error(file, error, verbose))
+            continue
+        if day_timer is not None:
+            day_timer.merge(day["timing"])
+        days_missing.append(day)
+    return get_start_times(days_missing, n_frames, max_daily_offset, max_spatial_overlap, seed), n_failed
 
-    # reset from_previous_day to None
-    from_previous_day = None
-    
-    return from_previous_day, next_start_time
+def print_progress(start_time_script, count_days):
+    print("----------------------------------------------", flush=True)
+    temp_runtime = time.time() - start_time_script
+    print(f"{count_days} days processed: {temp_runtime/max(count_days, 1):.2f} seconds or {temp_runtime/max(count_days, 1)/60:.2f} minutes per day", flush=True)
+    print(f"total runtime until now: {temp_runtime/60:.2f} minutes or {temp_runtime/60/60:.2f} hours", flush=True)
 
 # %%
-def construct_timeseries_dataset(path_dir, basename, years, months, days, 
-                                 n_frames=8, max_temporal_overlap=0, max_daily_offset=None, 
-                                 cropsize=100, max_spatial_overlap=0.25, max_cropping_attempts=10, 
-                                 out_path=None, out_basename=None, verbose=False):
-    
+def construct_timeseries_dataset(path_dir, basename, years, months, days,
+                                 n_frames=8, max_temporal_overlap=0, max_daily_offset=None,
+                                 cropsize=100, max_spatial_overlap=0.25,
+                                 out_path=None, out_basename=None, prefetch=2, channels=None, dtype=np.float32, zarr_path=None,
+                                 edge_mode="domain", seed=None, workers=1, output_format="netcdf", max_samples_per_shard=1000,
+                                 encoding="default", timing_file=None, print_timing=False, verbose=False):
+    """Crop random timeseries from the daily MSG files in the bucket and save them as netcdf
+    The next days (prefetch) are downloaded and decoded while the current day is cropped.
+    Only the given channels (None: all) are decoded, as dtype (None: dtype of the files).
+    If zarr_path is given, the days are read from the local Zarr stores of the daily files
+    (see readers/convert_MSG_to_zarr.py) instead, only the chunks overlapping the crops are read.
+    The cloud mask is closed once per timeseries window (edge_mode "domain") or per crop (edge_mode "crop").
+
+    With workers > 1 the days are processed in parallel processes. Each day draws its random numbers from
+    its own generator derived from seed and date, so the crops are the same for any number of workers.
+    Before, the missing timestamps of the days are read to draw the start of the first window of each day in order
+    of the days, so it leaves room for the window across midnight from the previous day (see get_start_times).
+    The windows across midnight are cropped in a second pass over consecutive days, in order.
+
+    With output_format "netcdf" each crop is saved as its own netcdf file. With output_format "shards" the crops
+    of each day are appended to HDF5 shards of at most max_samples_per_shard crops, and an index of all crops
+    is built at the end (see crop_shards.py). The netcdf files are written with the encoding profile
+    "default", "fast", "archive" or "compact" (see helpers/crop_encoding.py), the shards are not affected.
+
+    The crops can also be planned first with plan_timeseries_dataset and cut out later with execute_crop_plan.
+
+    The time of the stages (fetch, decode, read_wait, window_search, crop_sampling, read_box, cloud_mask_closing, write)
+    and the counters (windows, crop attempts, rejected crops, crops, bytes written) are summed over all days and
+    printed as json at the end, or written to timing_file. With print_timing, a line with the stages of each day is printed.
+    The stages of the workers run at the same time, so with workers > 1 their sum is larger than the runtime.
+    """
+    if output_format not in ("netcdf", "shards"):
+        raise ValueError(f"output_format must be 'netcdf' or 'shards', not {output_format}")
+
     # get start time of this script
     start_time_script = time.time()
     # count days to estimate later runtime per day
     count_days = 0
+    # time of the stages of all days
+    timer.reset()
+    total_timer = StageTimer()
+
+    read_kwargs = {"channels": channels, "dtype": dtype, "zarr_path": zarr_path}
+    day_kwargs = {"n_frames": n_frames, "cropsize": cropsize,
+                  "max_spatial_overlap": max_spatial_overlap, "out_path": out_path, "out_basename": out_basename,
+                  "edge_mode": edge_mode, "seed": seed, "output_format": output_format,
+                  "max_samples_per_shard": max_samples_per_shard, "encoding": encoding, "verbose": verbose}
 
     # loop over years
     for year in years:
         print(f"\n\nProcessing year {year}...", flush=True)
-        # dataset to store the last timeseries of each day
-        # if the last timeseries of the previous day was not complete, we need to add it to the first timeseries of the next day
-        from_previous_day = None
-
-        # loop over months and days
-        for month in months:
-            print(f"\nProcessing month {month}...", flush=True)
-            # loop over days
-            for day in days:
-                # get filename of this day
-                file = f"{path_dir}/{year:04d}/{month:02d}/{basename}_{year:04d}-{month:02d}-{day:02d}.nc"
-
-                # read in file from bucket if exists
-                my_obj = read_file(s3, file, S3_BUCKET_NAME)
-                if my_obj is not None:
-                    
-                    # count days to estimate later runtime per day
-                    count_days += 1
-                    print(file, flush=True)
-
-                    # open dataset
-                    with xr.open_dataset(io.BytesIO(my_obj)) as ds_day:
-
-                        if from_previous_day is not None:
-                            # if trailing incomplete timeseries from previous day exists, process this first
-                            from_previous_day, start_time = process_trailing_timeseries_of_previous_day(from_previous_day, ds_day, n_frames,
-                                                                                                        cropsize, max_spatial_overlap, out_path, out_basename, 
-                                                                                                        max_cropping_attempts=max_cropping_attempts, verbose=verbose)
-                        else:
-                            # no trailing data of previous day -> generate random offset for first timeseries of the day to increase variability
-                            if max_daily_offset is not None:
-                                start_time = random.randint(0, round(max_daily_offset*n_frames)+1)
-                            else:
-                                if max_temporal_overlap is not None:
-                                    start_time = random.randint(0, int(n_frames-1))
-                                else:
-                                    start_time = random.randint(0, int(n_frames-1))
-                            if verbose:
-                                print("random start time", start_time, flush=verbose)
-
-                        # loop over until the end of the day
-                        while start_time < len(ds_day.time.values):
-                            
-                            # find timeseries window without NaN values and next start time
-                            ds_timeseries, start_time = search_timewindow_without_nan(ds_day, start_time, n_frames)
-
-                            # check if timeseries has expected length or if it is an incomplete last timeseries of the day
-                            if ds_timeseries is None:
-                                if verbose:
-                                    print(f"No trailing timeseries of day due to missing timestamps - move on to next day.", flush=verbose)
-                                from_previous_day = None
-                                break
-
-                            elif len(ds_timeseries.time.values) < n_frames or ds_timeseries is None:
-                                if verbose:
-                                    print(f"The last timeseries of the day is not complete - keep for next day.", flush=verbose)
-                                from_previous_day = ds_timeseries
-                                break
-
-                            else:
-                                # crop out random samples from all quadrants given size and save them as netcdf
-                                crop_and_save_from_all_quadrants(ds_timeseries, cropsize, max_spatial_overlap, out_path, out_basename,
-                                                                max_cropping_attempts=max_cropping_attempts, verbose=verbose)
+
+        # files of all days of this year, days that do not exist in the bucket are skipped
+        day_files = get_day_files(path_dir, basename, year, months, days, zarr_path)
+
+        # start of the first window of each day, settled in order of the days from their missing timestamps
+        start_times, n_failed = plan_start_times(list(day_files), [str(date) for date in day_files.values()], read_kwargs,
+                                                 n_frames, max_daily_offset, max_spatial_overlap, seed,
+                                                 workers=workers, prefetch=prefetch, day_timer=total_timer, verbose=verbose)
+        total_timer.count("failed_days", n_failed)
+        day_files = {file: date for file, date in day_files.items() if str(date) in start_times}
+
+        # the crops across midnight are appended to the shards of the previous day, which are complete at that point
+        writer = CropShardWriter(out_path, out_basename, max_samples_per_shard) if output_format == "shards" else None
+        previous_day = None
+        current_month = None
+
+        # first pass: crop the windows within each day,
+        # second pass: crop the windows across midnight of consecutive days, in order as the days are done
+        for file, current_day, error in run_days(list(day_files), [str(date) for date in day_files.values()], process_day,
+                                                 [{"start_time": start_times[str(date)], **day_kwargs} for date in day_files.values()],
+                                                 read_kwargs, workers=workers, prefetch=prefetch):
+            if day_files[file].month != current_month:
+                current_month = day_files[file].month
+                print(f"\nProcessing month {current_month}...", flush=True)
+
+            if error is not None:
+                if report_read_error(file, error, verbose):
+                    total_timer.count("failed_days")
+                previous_day = None
+                continue
+
+            # count days to estimate later runtime per day
+            count_days += 1
+            print(file, flush=True)
+
+            # the window across midnight is timed with the current day
+            timer.merge(current_day["timing"])
+            if is_next_day(previous_day, current_day):
+                process_timeseries_across_midnight(previous_day, current_day, n_frames, cropsize, max_spatial_overlap, out_path, out_basename,
+                                                   edge_mode=edge_mode, seed=seed, writer=writer, encoding=encoding, verbose=verbose)
+            previous_day = current_day
+
+            day_timing = timer.pop()
+            total_timer.merge(day_timing)
+            if print_timing:
+                print(f"{current_day['date']}: {format_summary(day_timing)}", flush=True)
+
+        if writer is not None:
+            writer.close()
 
         # print progress
-        print("----------------------------------------------", flush=True)
-        temp_runtime = time.time() - start_time_script
-        print(f"{count_days} days processed: {temp_runtime/count_days:.2f} seconds or {temp_runtime/count_days/60:.2f} minutes per day", flush=True)
-        print(f"total runtime until now: {temp_runtime/60:.2f} minutes or {temp_runtime/60/60:.2f} hours", flush=True)
+        print_progress(start_time_script, count_days)
+
+    if output_format == "shards":
+        # index of all crops, so single crops are read without scanning the directories
+        with total_timer.stage("index"):
+            index = build_crop_index(out_path, out_basename)
+        print(f"{len(index)} crops in the index", flush=True)
+
+    # time of failed last days, that was not counted with a following day
+    total_timer.merge(timer.pop())
 
     # runnning time of the script in minutes
     runtime = time.time() - start_time_script
     print()
     print(f"Total runtime: {runtime/60:.2f} minutes or {runtime/60/60:.2f} hours", flush=True)
     print(f"Runtime per day: {runtime/count_days:.2f} seconds or {runtime/count_days/60:.2f} minutes", flush=True)
+    print_failed_days(total_timer.summary()["counters"].get("failed_days", 0))
+
+    # time of the stages and counters as json
+    dump_summary({"days": count_days, "workers": workers, "runtime_seconds": runtime, **total_timer.summary(),
+                  "transfer": get_transfer_metrics()}, timing_file)
+
+# %%
+# plan the crops first and cut them out later
+def plan_timeseries_dataset(path_dir, basename, years, months, days,
+                            n_frames=8, max_temporal_overlap=0, max_daily_offset=None,
+                            cropsize=100, max_spatial_overlap=0.25,
+                            prefetch=2, zarr_path=None, seed=None, workers=1, plan_file=None, verbose=False):
+    """Plan the random timeseries crops of construct_timeseries_dataset without cutting them out
+    Only the missing timestamps and the NaN values of CHANNEL are read. With the same parameters and seed
+    the plan gives the same crops as construct_timeseries_dataset.
+    (see construct_timeseries_dataset for the parameters)
+    :param plan_file: csv file to save the plan to
+    :return: DataFrame with one row per crop: date and start of the window (index of the timestamp in the day), time of
+             the first timestamp, quadrant, origin of the crop (idx_lon, idx_lat) and if the window continues into the next day
+    """
+    read_kwargs = {"channels": [CHANNEL], "zarr_path": zarr_path, "variables": [CHANNEL]}
+    day_kwargs = {"n_frames": n_frames, "cropsize": cropsize,
+                  "max_spatial_overlap": max_spatial_overlap, "seed": seed, "verbose": verbose}
+
+    rows = []
+    n_failed = 0
+    for year in years:
+        print(f"\n\nPlanning year {year}...", flush=True)
+        day_files = get_day_files(path_dir, basename, year, months, days, zarr_path)
+
+        start_times, n_failed_year = plan_start_times(list(day_files), [str(date) for date in day_files.values()], read_kwargs,
+                                                      n_frames, max_daily_offset, max_spatial_overlap, seed,
+                                                      workers=workers, prefetch=prefetch, verbose=verbose)
+        n_failed += n_failed_year
+        day_files = {file: date for file, date in day_files.items() if str(date) in start_times}
+
+        previous_day = None
+        for file, current_day, error in run_days(list(day_files), [str(date) for date in day_files.values()], plan_day_with_edges,
+                                                 [{"start_time": start_times[str(date)], **day_kwargs} for date in day_files.values()],
+                                                 read_kwargs, workers=workers, prefetch=prefetch):
+            if error is not None:
+                n_failed += int(report_read_error(file, error, verbose))
+                previous_day = None
+                continue
+
+            if is_next_day(previous_day, current_day):
+                ds_timeseries, origins = plan_timeseries_across_midnight(previous_day, current_day, n_frames, cropsize, max_spatial_overlap,
+                                                                         seed=seed, verbose=verbose)
+                if ds_timeseries is not None:
+                    rows += get_plan_rows(previous_day["date"], previous_day["trailing_start"], ds_timeseries.time.values[0],
+                                          origins, across_midnight=True)
+
+            for (window_start, origins), window_time in zip(current_day["windows"], current_day["window_times"]):
+                rows += get_plan_rows(current_day["date"], window_start, window_time, origins)
+            previous_day = current_day
+
+    plan = pd.DataFrame(rows, columns=PLAN_COLUMNS).sort_values(["time", "quadrant"], ignore_index=True)
+    summarize_crop_plan(plan, n_frames, cropsize)
+    print_failed_days(n_failed)
+    if plan_file is not None:
+        plan.to_csv(plan_file, index=False)
+    return plan
+
+def get_plan_rows(date, window_start, time, origins, across_midnight=False):
+    """Get the rows of the crop plan of one window"""
+    return [{"date": date, "window_start": int(window_start), "time": pd.Timestamp(time), "quadrant": quadrant,
+             "idx_lon": idx_lon, "idx_lat": idx_lat, "across_midnight": across_midnight}
+            for quadrant, (idx_lon, idx_lat) in origins.items()]
+
+def summarize_crop_plan(plan, n_frames, cropsize):
+    """Print the number of crops, windows and days of a crop plan and the number of pixels of the crops"""
+    n_windows = len(plan.groupby(["date", "window_start"]))
+    print(f"{len(plan)} crops in {n_windows} windows ({plan.across_midnight.sum()} crops across midnight) " + \
+          f"on {plan.date.nunique()} days, {len(plan)*n_frames*cropsize**2/1e6:.1f} million pixels per variable", flush=True)
+
+def execute_crop_plan(plan, path_dir, basename, n_frames=8, cropsize=100, out_path=None, out_basename=None,
+                      prefetch=2, channels=None, dtype=np.float32, zarr_path=None, edge_mode="domain", workers=1,
+                      output_format="netcdf", max_samples_per_shard=1000, encoding="default", verbose=False):
+    """Cut out and save the crops of a crop plan, see plan_timeseries_dataset
+    Only the days of the plan are read, and of each window only the box around its crops.
+    (see construct_timeseries_dataset for the parameters)
+    :param plan: DataFrame or csv file of the crop plan
+    """
+    if isinstance(plan, str):
+        plan = pd.read_csv(plan, parse_dates=["time"])
+    if output_format not in ("netcdf", "shards"):
+        raise ValueError(f"output_format must be 'netcdf' or 'shards', not {output_format}")
+
+    start_time_script = time.time()
+    count_days = 0
+    n_failed = 0
+    read_kwargs = {"channels": channels, "dtype": dtype, "zarr_path": zarr_path}
+    common_kwargs = {"n_frames": n_frames, "cropsize": cropsize, "out_path": out_path, "out_basename": out_basename,
+                     "edge_mode": edge_mode, "output_format": output_format, "max_samples_per_shard": max_samples_per_shard,
+                     "encoding": encoding, "verbose": verbose}
+
+    # origins of the crops of each window
+    windows = {}
+    for (date, window_start, across_midnight), crops in plan.groupby(["date", "window_start", "across_midnight"]):
+        windows.setdefault(date, []).append((int(window_start), bool(across_midnight),
+                                             {int(q): (int(x), int(y)) for q, x, y in zip(crops.quadrant, crops.idx_lon, crops.idx_lat)}))
+
+    # days with windows, and the days after windows across midnight
+    dates = sorted(set(windows) | {str(datetime.date.fromisoformat(date) + datetime.timedelta(days=1))
+                                   for date in windows for _, across_midnight, _ in windows[date] if across_midnight})
+    for year in sorted({int(date[:4]) for date in dates}):
+        print(f"\n\nProcessing year {year}...", flush=True)
+        year_dates = [date for date in dates if int(date[:4]) == year]
+        files = [get_day_file(path_dir, basename, datetime.date.fromisoformat(date), zarr_path) for date in year_dates]
+
+        day_kwargs, across = [], {}
+        for date in year_dates:
+            within_day = [(window_start, origins) for window_start, across_midnight, origins in windows.get(date, []) if not across_midnight]
+            across[date] = [(window_start, origins) for window_start, across_midnight, origins in windows.get(date, []) if across_midnight]
+            previous_date = str(datetime.date.fromisoformat(date) - datetime.timedelta(days=1))
+            day_kwargs.append({"windows": within_day,
+                               "trailing_start": across[date][0][0] if len(across[date]) > 0 else None,
+                               "n_head": n_frames - 1 if len(across.get(previous_date, [])) > 0 else 0, **common_kwargs})
+
+        writer = CropShardWriter(out_path, out_basename, max_samples_per_shard) if output_format == "shards" else None
+        previous_day = None
+        for file, current_day, error in run_days(files, year_dates, execute_day, day_kwargs, read_kwargs, workers=workers, prefetch=prefetch):
+            if error is not None:
+                n_failed += int(report_read_error(file, error, verbose))
+                previous_day = None
+                continue
+            count_days += 1
+            print(file, flush=True)
+
+            # windows across midnight from the previous day
+            if is_next_day(previous_day, current_day) and previous_day["trailing"] is not None:
+                from_previous_day = previous_day["trailing"]
+                n_current_day = n_frames - len(from_previous_day.time.values)
+                ds_timeseries = xr.concat([from_previous_day, current_day["head"].isel(time=slice(0, n_current_day))], dim='time')
+                for _, origins in across[previous_day["date"]]:
+                    save_crops(ds_timeseries, origins, cropsize, out_path, out_basename, edge_mode=edge_mode, writer=writer,
+                               encoding=encoding, verbose=verbose)
+            previous_day = current_day
+
+        if writer is not None:
+            writer.close()
+        print_progress(start_time_script, count_days)
+
+    if output_format == "shards":
+        index = build_crop_index(out_path, out_basename)
+        print(f"{len(index)} crops in the index", flush=True)
+    print_failed_days(n_failed)
 
 # %% 
-#Directory with the data to upload
-years = [2015]  # np.arange(2013, 2024, 1)
-months = [4]  # np.arange(4, 10, 1)
-days = [27, 28, 29]  # np.arange(1, 32, 1) #[9, 10, 11]
-path_dir = "/data/sat/msg/ml_train_crops/IR_108-WV_062-CMA_FULL_EXPATS_DOMAIN"
-basename = "merged_MSG_CMSAF"
-
-
-# parameters for temporal cropping
-n_frames = 8 #, 10, 12, 14, 16]
-max_temporal_overlap = 0.25  # one can either set a random overlap between subsequent timeseries or... (if negative it will result in a forced gap between timeseries)
-max_daily_offset = None  # one can set a random offset at the beginning of the day to introduce a randomness in the timeseries starting times
-
-# parameters for random spatial cropping
-cropsize = 100
-max_spatial_overlap = 0.25
-max_cropping_attempts = 10
-
-# where and how to save the crops
-out_path = None # "output/data/timeseries_crops"
-out_basename = None # "MSG_timeseries"
-
-verbose = False
-
-# run preparation of timeseries dataset
-construct_timeseries_dataset(path_dir, basename, years, months, days, 
-                             n_frames, max_temporal_overlap, max_daily_offset, 
-                             cropsize, max_spatial_overlap, max_cropping_attempts, 
-                             out_path=out_path, out_basename=out_basename, verbose=verbose)
+if __name__ == "__main__":
+    #Directory with the data to upload
+    years = [2015]  # np.arange(2013, 2024, 1)
+    months = [4]  # np.arange(4, 10, 1)
+    days = [27, 28, 29]  # np.arange(1, 32, 1) #[9, 10, 11]
+    path_dir = "/data/sat/msg/ml_train_crops/IR_108-WV_062-CMA_FULL_EXPATS_DOMAIN"
+    basename = "merged_MSG_CMSAF"
+
+
+    # parameters for temporal cropping
+    n_frames = 8 #, 10, 12, 14, 16]
+    max_temporal_overlap = 0.25  # one can either set a random overlap between subsequent timeseries or... (if negative it will result in a forced gap between timeseries)
+    max_daily_offset = None  # one can set a random offset at the beginning of the day to introduce a randomness in the timeseries starting times
+
+    # parameters for random spatial cropping
+    cropsize = 100
+    max_spatial_overlap = 0.25
+
+    # where and how to save the crops
+    out_path = None # "output/data/timeseries_crops"
+    out_basename = None # "MSG_timeseries"
+
+    # encoding profile of the crop files: default, fast, archive or compact
+    encoding = "archive"
+
+    verbose = False
+
+    # days processed in parallel processes, the crops only depend on the seed and not on the number of workers
+    seed = 0
+    workers = 4
+
+    # run preparation of timeseries dataset
+    construct_timeseries_dataset(path_dir, basename, years, months, days, 
+                                 n_frames, max_temporal_overlap, max_daily_offset, 
+                                 cropsize, max_spatial_overlap, 
+                                 out_path=out_path, out_basename=out_basename, 
+                                 seed=seed, workers=workers, encoding=encoding, verbose=verbose)
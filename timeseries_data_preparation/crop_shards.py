@@ -0,0 +1,214 @@
+# sharded output of the timeseries crops: the crops of a day are appended along a sample dimension into HDF5 shards,
+# with an index of all samples so a single sample is read without scanning the directories
+
+# %%
+import os
+import glob
+import collections
+import h5py
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# name of the index file in the output directory
+INDEX_FILE = "crop_index.parquet"
+
+# %%
+def get_shard_path(out_path, out_basename, date, shard):
+    """Get the path of a shard of the crops starting on the given day
+    :param out_path: Path to save the shards
+    :param out_basename: Basename for the output files
+    :param date: Date of the first timestamp of the crops as string YYYY-MM-DD
+    :param shard: Number of the shard of this day
+    :return: Path of the shard
+    """
+    year, month, day = date.split('-')
+    return f"{out_path}/{year}/{month}/{out_basename}_{date}_shard{shard:03d}.h5"
+
+class CropShardWriter:
+    """Append crops to the shards of their day, one HDF5 file per day holds up to max_samples_per_shard crops
+
+    Each variable of the crops is stored as (sample, time, lat, lon), together with the timestamps and
+    coordinates of each sample, the quadrant and the origin (idx_lon, idx_lat) of the crop in the domain.
+    """
+
+    def __init__(self, out_path, out_basename, max_samples_per_shard=1000, overwrite=False):
+        """
+        :param out_path: Path to save the shards
+        :param out_basename: Basename for the output files
+        :param max_samples_per_shard: Maximum number of crops per shard, a new shard of the day is started afterwards
+        :param overwrite: If True, the existing shards of a day are removed when the first crop of the day is written,
+                          else the crops are appended to them
+        """
+        self.out_path = out_path
+        self.out_basename = out_basename
+        self.max_samples_per_shard = max_samples_per_shard
+        self.overwrite = overwrite
+        self._date = None
+        self._shard = None
+        self._file = None
+
+    def write(self, crop, quadrant, idx_lon, idx_lat):
+        """Append a crop to the shard of the day of its first timestamp
+        :param crop: xarray dataset of the crop with variables (time, lat, lon)
+        :param quadrant: Quadrant of the domain the crop was taken from
+        :param idx_lon: Index of the first lon of the crop in the domain
+        :param idx_lat: Index of the first lat of the crop in the domain
+        """
+        date = str(crop.time.values[0])[:10]
+        if date != self._date:
+            self._open_day(date)
+        elif len(self._file["quadrant"]) >= self.max_samples_per_shard:
+            self._open_shard(self._shard + 1)
+
+        if "time" not in self._file:
+            self._create_datasets(crop)
+
+        # append the crop as new sample
+        row = len(self._file["quadrant"])
+        for name, dataset in self._file.items():
+            dataset.resize(row + 1, axis=0)
+        for var in self._file.attrs["variables"]:
+            self._file[var][row] = crop[var].transpose('time', 'lat', 'lon').values
+        self._file["time"][row] = crop.time.values.astype("datetime64[ns]").astype(np.int64)
+        self._file["lat"][row] = crop.lat.values
+        self._file["lon"][row] = crop.lon.values
+        self._file["quadrant"][row] = quadrant
+        self._file["idx_lon"][row] = idx_lon
+        self._file["idx_lat"][row] = idx_lat
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._date = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _open_day(self, date):
+        self.close()
+        self._date = date
+        existing = sorted(glob.glob(get_shard_path(self.out_path, self.out_basename, date, 0).replace("shard000", "shard*")))
+        if self.overwrite:
+            for shard_file in existing:
+                os.remove(shard_file)
+            existing = []
+        # continue with the last shard of the day
+        self._open_shard(max(len(existing) - 1, 0))
+        if "quadrant" in self._file and len(self._file["quadrant"]) >= self.max_samples_per_shard:
+            self._open_shard(self._shard + 1)
+
+    def _open_shard(self, shard):
+        if self._file is not None:
+            self._file.close()
+        self._shard = shard
+        shard_file = get_shard_path(self.out_path, self.out_basename, self._date, shard)
+        os.makedirs(os.path.dirname(shard_file), exist_ok=True)
+        self._file = h5py.File(shard_file, "a")
+
+    def _create_datasets(self, crop):
+        n_time, n_lat, n_lon = crop.sizes['time'], crop.sizes['lat'], crop.sizes['lon']
+        variables = [var for var in crop.data_vars if set(crop[var].dims) == {'time', 'lat', 'lon'}]
+        for var in variables:
+            # one chunk per sample, a sample is read with a single chunk per variable
+            dataset = self._file.create_dataset(var, shape=(0, n_time, n_lat, n_lon), maxshape=(None, n_time, n_lat, n_lon),
+                                                dtype=crop[var].dtype, chunks=(1, n_time, n_lat, n_lon))
+            for name, value in crop[var].attrs.items():
+                dataset.attrs[name] = value
+        self._file.create_dataset("time", shape=(0, n_time), maxshape=(None, n_time), dtype=np.int64, chunks=(256, n_time))
+        self._file.create_dataset("lat", shape=(0, n_lat), maxshape=(None, n_lat), dtype=crop.lat.dtype, chunks=(256, n_lat))
+        self._file.create_dataset("lon", shape=(0, n_lon), maxshape=(None, n_lon), dtype=crop.lon.dtype, chunks=(256, n_lon))
+        for name in ["quadrant", "idx_lon", "idx_lat"]:
+            self._file.create_dataset(name, shape=(0,), maxshape=(None,), dtype=np.int32, chunks=(1024,))
+        self._file.attrs["variables"] = variables
+        for name, value in crop.attrs.items():
+            self._file.attrs[name] = value
+
+# %%
+def build_crop_index(out_path, out_basename, index_file=None):
+    """Build the index of all samples in the shards of the output directory, only the metadata of the shards is read
+    :param out_path: Path of the shards
+    :param out_basename: Basename of the shards
+    :param index_file: Parquet file to save the index to. If None, INDEX_FILE in out_path
+    :return: DataFrame with one row per sample: shard (relative to out_path), row in the shard, time of the first timestamp, quadrant, idx_lon, idx_lat
+    """
+    index_file = f"{out_path}/{INDEX_FILE}" if index_file is None else index_file
+    tables = []
+    for shard_file in sorted(glob.glob(f"{out_path}/*/*/{out_basename}_*_shard*.h5")):
+        with h5py.File(shard_file, "r") as f:
+            if "quadrant" not in f:
+                continue
+            n_samples = len(f["quadrant"])
+            tables.append(pd.DataFrame({
+                "shard": os.path.relpath(shard_file, out_path),
+                "row": np.arange(n_samples),
+                "time": f["time"][:, 0].astype("datetime64[ns]"),
+                "quadrant": f["quadrant"][:],
+                "idx_lon": f["idx_lon"][:],
+                "idx_lat": f["idx_lat"][:],
+            }))
+    index = pd.concat(tables, ignore_index=True) if len(tables) > 0 else \
+            pd.DataFrame(columns=["shard", "row", "time", "quadrant", "idx_lon", "idx_lat"])
+    index = index.sort_values(["time", "quadrant"], ignore_index=True)
+
+    # write to a temporary file first, so readers never see a partial index
+    index.to_parquet(f"{index_file}.tmp", index=False)
+    os.replace(f"{index_file}.tmp", index_file)
+    return index
+
+class CropShardReader:
+    """Read single samples of the shards through the index, keeping the most recently used shards open"""
+
+    def __init__(self, out_path, index_file=None, max_open=8):
+        """
+        :param out_path: Path of the shards
+        :param index_file: Parquet file of the index, see build_crop_index. If None, INDEX_FILE in out_path
+        :param max_open: Maximum number of shards that are kept open
+        """
+        self.out_path = out_path
+        self.index = pd.read_parquet(f"{out_path}/{INDEX_FILE}" if index_file is None else index_file)
+        self.max_open = max_open
+        self._files = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        """Get sample i of the index as xarray dataset, like a crop saved as single netcdf file"""
+        sample = self.index.iloc[i]
+        f = self._open(sample["shard"])
+        row = int(sample["row"])
+
+        coords = {"time": f["time"][row].astype("datetime64[ns]"), "lat": f["lat"][row], "lon": f["lon"][row]}
+        data_vars = {var: (("time", "lat", "lon"), f[var][row], dict(f[var].attrs)) for var in f.attrs["variables"]}
+        attrs = {name: value for name, value in f.attrs.items() if name != "variables"}
+        attrs.update({"quadrant": int(sample["quadrant"]), "idx_lon": int(sample["idx_lon"]), "idx_lat": int(sample["idx_lat"])})
+        return xr.Dataset(data_vars, coords=coords, attrs=attrs)
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _open(self, shard):
+        if shard in self._files:
+            self._files.move_to_end(shard)
+            return self._files[shard]
+        self._files[shard] = h5py.File(f"{self.out_path}/{shard}", "r")
+        # close the least recently used shards
+        while len(self._files) > self.max_open:
+            _, evicted = self._files.popitem(last=False)
+            evicted.close()
+        return self._files[shard]
+
+# %%
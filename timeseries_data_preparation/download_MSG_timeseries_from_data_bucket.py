@@ -1,18 +1,13 @@
 # script to upload MSG timeseries data to the data bucket
 # %%
 import os
-import boto3
 from botocore.exceptions import ClientError
 from s3_bucket_credentials import S3_ACCESS_KEY, S3_SECRET_ACCESS_KEY, S3_ENDPOINT_URL
+from data_buckets_read_and_write import Initialize_s3_client, dump_transfer_metrics
 
 BUCKETS = ["expats-msg-training", 'expats-random-msg-timeseries-100pix-8frames']
 
-s3 = boto3.client(
-    's3',
-    endpoint_url=S3_ENDPOINT_URL,
-    aws_access_key_id=S3_ACCESS_KEY,
-    aws_secret_access_key=S3_SECRET_ACCESS_KEY
-)
+s3 = Initialize_s3_client(S3_ENDPOINT_URL, S3_ACCESS_KEY, S3_SECRET_ACCESS_KEY)
 
 # %%
 S3_BUCKET_NAME = BUCKETS[1]
@@ -66,4 +61,7 @@ for year in years:
             print("n_day =", n_day)
 print("\nn_total =", n_total)
 
+# print number of requests, bytes and latencies of the S3 calls
+dump_transfer_metrics()
+
 # %%
@@ -3,9 +3,12 @@
 # %%
 import time
 from glob import glob
+import sys
+sys.path.append('..')
 
 from s3_bucket_credentials import S3_BUCKET_TIMESERIES_NAME, S3_ACCESS_KEY, S3_SECRET_ACCESS_KEY, S3_ENDPOINT_URL
-from data_buckets_read_and_write import Initialize_s3_client, upload_file
+from data_buckets_read_and_write import Initialize_s3_client, dump_transfer_metrics
+from data_buckets_IO.bulk_upload import upload_files_concurrently
 
 # %%
 #Directory with the data to upload
@@ -14,8 +17,12 @@ months = range(4, 10)
 days = range(1, 32) #[9, 10, 11]
 path_to_data = "output/data/timeseries_crops"
 
+# settings of the concurrent upload
+max_workers = 32
+manifest_path = f"{path_to_data}/upload_manifest.jsonl"
+
 # initialize the S3 client to upload the data to bucket
-s3 = Initialize_s3_client(S3_ENDPOINT_URL, S3_ACCESS_KEY, S3_SECRET_ACCESS_KEY)
+s3 = Initialize_s3_client(S3_ENDPOINT_URL, S3_ACCESS_KEY, S3_SECRET_ACCESS_KEY, max_pool_connections=max_workers)
 
 # %%
 # Upload the data to the bucket
@@ -24,25 +31,29 @@ total = 0
 for year in years:
     print()
     print("Year: ", year, flush=True)
+    year_files = []
     for month in months:
         count_month = 0
         for day in days:
             data_filepattern = f"{path_to_data}/{year:04d}/{month:02d}/{day:02d}/*.nc"
             file_list = sorted(glob(data_filepattern))
-            if len(file_list) > 0:
-                count_month += len(file_list)
-
-                for file in file_list:
-                    #Uploading a file to the bucket (make sure you have write access)
-                    #file_size = os.path.getsize(file)  # Get file size in bytes
-                    # Open file in binary mode and upload
-                    upload_file(s3, file, S3_BUCKET_TIMESERIES_NAME, file)
+            count_month += len(file_list)
+            year_files.extend(file_list)
 
         print("Month: ", month, " files found: ", count_month, flush=True)	
         total += count_month
+
+    #Uploading the files of this year to the bucket (make sure you have write access)
+    # the file paths are used as object names, files listed in the manifest are skipped
+    upload_files_concurrently(s3, year_files, S3_BUCKET_TIMESERIES_NAME, object_names=year_files, 
+                              manifest_path=manifest_path, max_workers=max_workers)
+
 print("Total files to upload: ", total, flush=True)   
 print("Time taken to upload files: ", time.time() - start_time, flush=True) 
 
+# print number of requests, bytes, retries and latencies of the S3 calls
+dump_transfer_metrics()
+
 # %%
 # # List the objects in our bucket to check if the files were uploaded
 # response = s3.list_objects(Bucket=S3_BUCKET_TIMESERIES_NAME)